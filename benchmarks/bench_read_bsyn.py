@@ -0,0 +1,41 @@
+"""
+Compare reading a bsyn_lu output spectrum with np.loadtxt and synthesizer.read_bsyn_output.
+
+Usage: python benchmarks/bench_read_bsyn.py [N_pixels]
+"""
+import numpy as np
+import os, sys, time, tempfile, shutil
+from tssynth import synthesizer
+
+def write_fake_bsyn_output(fname, wmin, dw, N):
+    wave = wmin + dw*np.arange(N)
+    norm = 1 - 0.5*np.abs(np.sin(wave))
+    flux = 1e15*norm
+    np.savetxt(fname, np.array([wave, norm, flux]).T, fmt=["%11.3f", "%10.5f", "%12.5E"])
+
+def best_of(func, N_repeat=3):
+    times = []
+    for i in range(N_repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+if __name__ == "__main__":
+    N = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    wmin, dw = 3700.0, 0.01
+    wmax = wmin + (N-1)*dw
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, "bsyn.out")
+        write_fake_bsyn_output(fname, wmin, dw, N)
+        t_loadtxt = best_of(lambda: np.loadtxt(fname))
+        t_read = best_of(lambda: synthesizer.read_bsyn_output(fname, wmin, wmax, dw))
+        t_read32 = best_of(lambda: synthesizer.read_bsyn_output(fname, wmin, wmax, dw,
+                                                                columns=("wave", "flux"), dtype=np.float32))
+        print(f"{N} pixels")
+        print(f"np.loadtxt:                        {t_loadtxt:.3f} s")
+        print(f"read_bsyn_output:                  {t_read:.3f} s ({t_loadtxt/t_read:.1f}x)")
+        print(f"read_bsyn_output (wave,flux f32):  {t_read32:.3f} s ({t_loadtxt/t_read32:.1f}x)")
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,292 @@
+"""
+Microbenchmarks of the hot paths of tssynth, with results that can be compared between commits.
+
+The inputs are described in benchmarks/fixtures/cases.json and come from files in the repo
+(a MARCS model, data/model_list.txt, a VALD line list). The MARCS grid for find_marcs_models
+is a directory of empty files named after data/model_list.txt, so no MARCS models are needed.
+Turbospectrum is not run.
+
+Usage:
+  python benchmarks/run_benchmarks.py [-o results.json] [-k pattern] [--repeat N]
+  python benchmarks/run_benchmarks.py --compare old.json new.json [--threshold 0.1]
+
+Each benchmark calls its function in a loop long enough to be timed reliably (number calls)
+and repeats that --repeat times. The JSON output has the time per call (s) of every repeat,
+with min/median/mean/stdev, plus the git commit, Python/numpy versions and machine.
+--compare prints the ratio of the medians and exits with status 1 if anything got slower
+by more than the threshold.
+"""
+import numpy as np
+import os, sys, io, json, time, shutil, platform, argparse, subprocess, tempfile, contextlib, statistics
+from tssynth import marcs, synthesizer, linelists
+
+BENCHMARKS_VERSION = 1
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+_benchmarks = {}
+def benchmark(name):
+    """
+    Register a benchmark. The decorated function gets the Fixtures and returns the function to time.
+    """
+    def decorator(setup):
+        _benchmarks[name] = setup
+        return setup
+    return decorator
+
+class Fixtures:
+    """
+    Inputs of the benchmarks, made once and shared. Files are written to a temporary directory.
+    """
+    def __init__(self, tmpdir):
+        self.tmpdir = tmpdir
+        with open(os.path.join(BENCHMARK_DIR, "fixtures", "cases.json")) as fp:
+            self.cases = json.load(fp)
+        self._marcs_filenames = None
+        self._marcs_grid = None
+
+    def path(self, relpath):
+        return os.path.join(REPO_DIR, relpath)
+
+    def marcs_filenames(self):
+        if self._marcs_filenames is None:
+            with open(self.path(self.cases["marcs_model_list"])) as fp:
+                self._marcs_filenames = [line.strip() for line in fp if line.strip()]
+        return self._marcs_filenames
+
+    def marcs_points(self, spherical):
+        """
+        (N, 3) array of Teff, logg, MH like find_marcs_models makes for _find_surrounding_points.
+        """
+        sstr = "s" if spherical else "p"
+        points = []
+        for fname in self.marcs_filenames():
+            if not (fname.startswith(sstr) and "_t02_st_" in fname): continue
+            parts = fname.split("_")
+            points.append((int(parts[0][1:]), float(parts[1][1:]), float(parts[5][1:])))
+        return np.array(sorted(points))
+
+    def marcs_grid(self):
+        """
+        Directory of empty files with the names of all the MARCS models.
+        """
+        if self._marcs_grid is None:
+            self._marcs_grid = os.path.join(self.tmpdir, "marcs")
+            os.makedirs(self._marcs_grid)
+            for fname in self.marcs_filenames():
+                open(os.path.join(self._marcs_grid, fname), "w").close()
+        return self._marcs_grid
+
+    def twd(self, name):
+        twd = os.path.join(self.tmpdir, name)
+        os.makedirs(twd, exist_ok=True)
+        return twd
+
+@contextlib.contextmanager
+def _quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+@benchmark("parse_marcs_model")
+def bench_parse_marcs_model(fixtures):
+    fname = fixtures.path(fixtures.cases["parse_marcs_model"])
+    return lambda: marcs.parse_marcs_model(fname)
+
+def _find_surrounding_points_benchmark(case):
+    def setup(fixtures):
+        params = fixtures.cases["find_surrounding_points"][case]
+        points = fixtures.marcs_points(params["spherical"])
+        def run():
+            with _quiet():
+                marcs._find_surrounding_points(points, params["Teff"], params["logg"], params["MH"])
+        return run
+    return setup
+for case in ("interior", "expansion", "expansion_planeparallel"):
+    benchmark(f"find_surrounding_points[{case}]")(_find_surrounding_points_benchmark(case))
+
+@benchmark("find_marcs_models")
+def bench_find_marcs_models(fixtures):
+    params = fixtures.cases["find_marcs_models"]
+    marcs_grid = fixtures.marcs_grid()
+    def run():
+        old = os.environ.get("ALLMARCS_PATH")
+        os.environ["ALLMARCS_PATH"] = marcs_grid
+        try:
+            with _quiet():
+                selected = marcs.find_marcs_models(params["Teff"], params["logg"], params["MH"],
+                                                   spherical=params["spherical"])
+        finally:
+            if old is None: del os.environ["ALLMARCS_PATH"]
+            else: os.environ["ALLMARCS_PATH"] = old
+        assert len(selected) == 8, selected
+    return run
+
+@benchmark("interpolate_marcs_models")
+def bench_interpolate_marcs_models(fixtures):
+    params = fixtures.cases["interpolate_marcs_models"]
+    corners = [fixtures.path(fname) for fname in params["corners"]]
+    marcs_model_lists = [corners]*params["n"]
+    rng = np.random.default_rng(0)
+    Teff, logg, MH = (rng.uniform(lo, hi, params["n"]) for lo, hi in ((5000, 7000), (2.0, 3.0), (-2.0, 0.0)))
+    return lambda: marcs.interpolate_marcs_models(Teff, logg, MH, marcs_model_lists=marcs_model_lists)
+
+def _write_script_benchmark(bsyn):
+    def setup(fixtures):
+        params = fixtures.cases["write_script"]
+        twd = fixtures.twd("write_script")
+        indiv_abu = {int(Z): abund for Z, abund in params["indiv_abu"].items()}
+        linelist_filenames = [fixtures.path(fixtures.cases["linelist"])]
+        scriptfilename = os.path.join(twd, "bsyn.par" if bsyn else "babsma.par")
+        return lambda: synthesizer._write_script(
+            scriptfilename, params["wmin"], params["wmax"], params["dw"], 1.0,
+            os.path.join(twd, "model.mod"), True, os.path.join(twd, "mopac"),
+            params["metals"], params["alphafe"], indiv_abu, params["vmicro"], True,
+            os.path.join(twd, "bsyn.out"), {}, linelist_filenames, bsyn=bsyn)
+    return setup
+benchmark("write_script[babsma]")(_write_script_benchmark(False))
+benchmark("write_script[bsyn]")(_write_script_benchmark(True))
+
+@benchmark("build_linelist_catalog")
+def bench_build_linelist_catalog(fixtures):
+    fname = fixtures.path(fixtures.cases["linelist"])
+    return lambda: linelists.build_linelist_catalog(fname)
+
+@benchmark("trim_linelist")
+def bench_trim_linelist(fixtures):
+    fname = fixtures.path(fixtures.cases["linelist"])
+    wmin, wmax = fixtures.cases["linelist_trim"]
+    outfname = os.path.join(fixtures.twd("trim_linelist"), "trimmed.list")
+    linelists.get_linelist_catalog(fname, cache_dir=fixtures.twd("linelist_catalogs"))
+    return lambda: linelists.trim_linelist(fname, wmin, wmax, outfname)
+
+@benchmark("linelist_store_query")
+def bench_linelist_store_query(fixtures):
+    fname = fixtures.path(fixtures.cases["linelist"])
+    wmin, wmax = fixtures.cases["linelist_trim"]
+    store_directory = fixtures.twd("linelist_store")
+    linelists.get_linelist_catalog(fname, cache_dir=fixtures.twd("linelist_catalogs"))
+    linelists.compile_linelist_store([fname], store_directory)
+    store = linelists.LineListStore(store_directory)
+    return lambda: store.query(wmin, wmax)
+
+@benchmark("read_bsyn_output")
+def bench_read_bsyn_output(fixtures):
+    from bench_read_bsyn import write_fake_bsyn_output
+    params = fixtures.cases["read_bsyn_output"]
+    wmin, dw, npix = params["wmin"], params["dw"], params["npix"]
+    fname = os.path.join(fixtures.twd("read_bsyn_output"), "bsyn.out")
+    write_fake_bsyn_output(fname, wmin, dw, npix)
+    wmax = wmin + (npix - 1)*dw
+    return lambda: synthesizer.read_bsyn_output(fname, wmin, wmax, dw)
+
+def time_function(func, repeat=5, min_time=0.2):
+    """
+    Seconds per call of func for each of repeat repeats.
+    Each repeat calls func number times, with number chosen so a repeat takes at least min_time.
+    """
+    func() # warm up caches and imports
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number): func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1000000: break
+        number *= 10 if elapsed < min_time/10 else 2
+    times = [elapsed/number]
+    for i in range(repeat - 1):
+        start = time.perf_counter()
+        for j in range(number): func()
+        times.append((time.perf_counter() - start)/number)
+    return number, times
+
+def run_benchmarks(pattern=None, repeat=5, min_time=0.2):
+    """
+    Run the benchmarks whose names contain pattern. Returns the results as a dict.
+    """
+    sys.path.insert(0, BENCHMARK_DIR)
+    results = dict(version=BENCHMARKS_VERSION, metadata=machine_info(), benchmarks={})
+    tmpdir = tempfile.mkdtemp(prefix="tssynth_bench_")
+    try:
+        fixtures = Fixtures(tmpdir)
+        for name, setup in _benchmarks.items():
+            if pattern is not None and pattern not in name: continue
+            func = setup(fixtures)
+            number, times = time_function(func, repeat=repeat, min_time=min_time)
+            results["benchmarks"][name] = dict(
+                number=number, repeat=repeat, times=times, min=min(times),
+                median=statistics.median(times), mean=statistics.mean(times),
+                stdev=statistics.stdev(times) if len(times) > 1 else 0.0)
+            print(f"{name:<50}{_format_time(statistics.median(times)):>12} (x{number}, {repeat} repeats)")
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+def machine_info():
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=REPO_DIR, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    status = git("status", "--porcelain", "--untracked-files=no")
+    return dict(commit=git("rev-parse", "HEAD"), dirty=None if status is None else len(status) > 0,
+                date=time.strftime("%Y-%m-%dT%H:%M:%S%z"), python=platform.python_version(),
+                numpy=np.__version__, platform=platform.platform(), machine=platform.machine(),
+                processor=platform.processor(), cpu_count=os.cpu_count())
+
+def compare(old, new, threshold=0.1):
+    """
+    Table comparing the median times of two results. Returns the table and the names of
+    the benchmarks that got slower by more than threshold (a fraction).
+    """
+    lines = [f"old: {old['metadata'].get('commit')}  new: {new['metadata'].get('commit')}",
+             f"{'benchmark':<50}{'old':>12}{'new':>12}{'new/old':>9}"]
+    slower = []
+    for name in list(old["benchmarks"]) + [name for name in new["benchmarks"] if name not in old["benchmarks"]]:
+        if name not in old["benchmarks"] or name not in new["benchmarks"]:
+            t_old = old["benchmarks"].get(name, {}).get("median")
+            t_new = new["benchmarks"].get(name, {}).get("median")
+            lines.append(f"{name:<50}{_format_time(t_old):>12}{_format_time(t_new):>12}")
+            continue
+        t_old, t_new = old["benchmarks"][name]["median"], new["benchmarks"][name]["median"]
+        ratio = t_new/t_old
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  slower"
+            slower.append(name)
+        elif ratio < 1/(1 + threshold):
+            flag = "  faster"
+        lines.append(f"{name:<50}{_format_time(t_old):>12}{_format_time(t_new):>12}{ratio:>9.2f}{flag}")
+    return "\n".join(lines), slower
+
+def _format_time(t):
+    if t is None: return "-"
+    if t >= 1: return f"{t:.3f} s"
+    if t >= 1e-3: return f"{t*1e3:.3f} ms"
+    return f"{t*1e6:.1f} us"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the tssynth microbenchmarks or compare two results.")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    parser.add_argument("-k", "--pattern", help="Only run benchmarks whose names contain this")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of repeats (default: 5)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum time of one repeat in s (default: 0.2)")
+    parser.add_argument("--list", action="store_true", help="List the benchmarks")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Fraction by which a benchmark must be slower to count as a regression (default: 0.1)")
+    args = parser.parse_args()
+    if args.list:
+        print("\n".join(_benchmarks))
+    elif args.compare:
+        with open(args.compare[0]) as fp: old = json.load(fp)
+        with open(args.compare[1]) as fp: new = json.load(fp)
+        table, slower = compare(old, new, threshold=args.threshold)
+        print(table)
+        sys.exit(1 if slower else 0)
+    else:
+        results = run_benchmarks(args.pattern, repeat=args.repeat, min_time=args.min_time)
+        if args.output:
+            with open(args.output, "w") as fp:
+                json.dump(results, fp, indent=1)
+            print(f"Wrote {args.output}")
@@ -1,12 +1,12 @@
 import os, shutil
 
-## HARDCODE during development
-os.environ["TSEXEC_PATH"] = "/Users/alexji/lib/Turbospectrum_NLTE/exec-gf"
-os.environ["TSINTERP_PATH"] = "/Users/alexji/lib/tssynth/fortran"
-os.environ["TWD_BASE"] = "/Users/alexji/.tssynth"
-os.environ["TSLINELIST_PATH"] = "/Users/alexji/lib/tssynth/data/linelists"
-os.environ["TSDEPCOEFF_PATH"] = "/Users/alexji/bergemann_departure_coefficients"
-os.environ["ALLMARCS_PATH"] = "/Users/alexji/MARCS/MARCS"
+## HARDCODE during development, environment variables that are already set take precedence
+os.environ.setdefault("TSEXEC_PATH", "/Users/alexji/lib/Turbospectrum_NLTE/exec-gf")
+os.environ.setdefault("TSINTERP_PATH", "/Users/alexji/lib/tssynth/fortran")
+os.environ.setdefault("TWD_BASE", "/Users/alexji/.tssynth")
+os.environ.setdefault("TSLINELIST_PATH", "/Users/alexji/lib/tssynth/data/linelists")
+os.environ.setdefault("TSDEPCOEFF_PATH", "/Users/alexji/bergemann_departure_coefficients")
+os.environ.setdefault("ALLMARCS_PATH", "/Users/alexji/MARCS/MARCS")
 
 TSEXEC_PATH = os.environ.get('TSEXEC_PATH', None)
 if TSEXEC_PATH is None:
@@ -61,5 +61,15 @@ from .solar_abundances import solar_abundances, periodic_table
 from .solar_isotopes import solar_isotopes
 
 ## Import basic interface
-from .synthesizer import run_synth_lte
+from .synthesizer import run_synth_lte, run_synth_lte_batch, run_synth_lte_chunked, run_synth_lte_abundance_sweep
+from .pipeline import SynthesisPipeline, run_synth_lte_pipeline
+from .async_synthesizer import async_run_synth_lte, async_run_synth_lte_batch
+from .cache import MopacCache, SpectrumCache
+from .workdir import WorkdirPool
+from .grid import build_grid, SpectralGrid
+from .emulator import SpectralEmulator
+from .broadening import broaden
+from .resampling import resample, FluxRebinner
+from .workqueue import WorkQueue, run_worker
+from .utils import TurbospectrumError
 from . import utils
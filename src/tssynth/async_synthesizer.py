@@ -0,0 +1,233 @@
+"""
+asyncio versions of the synthesis functions in synthesizer.py and marcs.py.
+
+The Fortran executables are run with asyncio.create_subprocess_exec, so one event loop
+can keep many syntheses in flight without a thread per job. Cancelling a task (or hitting
+its timeout) kills the Fortran child process it is waiting on.
+
+Everything else that touches files (writing scripts, hashing model atmospheres for the
+mopac cache, copying files) runs in the default executor, so it does not block the loop.
+"""
+import asyncio
+import os, sys, shutil, functools, subprocess, tempfile
+from . import utils, marcs
+from .synthesizer import (_resolve_model_atmosphere, _setup_twd, _babsma_lu_kwargs, _bsyn_lu_kwargs,
+                          _copy_modelopac_file, _check_mopac_cache, _check_spectrum_cache, _write_script,
+                          read_bsyn_output)
+
+TSEXEC_PATH = os.environ.get('TSEXEC_PATH', None)
+
+async def async_run_synth_lte(wmin, wmax, dw,
+                              Teff=None, logg=None, vt=2.0, MH=None, aFe=None,
+                              model_atmosphere_file=None,
+                              linelist_filenames=None, trim_linelists=False, linelist_margin=10.0,
+                              XFedict=None,
+                              modelopac_file=None, mopac_cache=None, spectrum_cache=None,
+                              twd=None, delete_twd=False,
+                              spherical=None, verbose=False, stage_timeout=None,
+                              semaphore=None, timeout=None):
+    """
+    asyncio version of synthesizer.run_synth_lte, with the same parameters and return value.
+
+    Additional parameters:
+    semaphore (asyncio.Semaphore): Limits how many syntheses run at once (default: None, no limit)
+        The job waits for the semaphore before starting, and the wait does not count towards timeout.
+    timeout (float): Wall-clock time limit in seconds (default: None, no limit)
+        When it is exceeded the running Fortran process is killed and asyncio.TimeoutError is raised.
+    """
+    coro = _async_run_synth_lte(wmin, wmax, dw, Teff=Teff, logg=logg, vt=vt, MH=MH, aFe=aFe,
+                                model_atmosphere_file=model_atmosphere_file,
+                                linelist_filenames=linelist_filenames, trim_linelists=trim_linelists,
+                                linelist_margin=linelist_margin, XFedict=XFedict,
+                                modelopac_file=modelopac_file, mopac_cache=mopac_cache,
+                                spectrum_cache=spectrum_cache, twd=twd, delete_twd=delete_twd, spherical=spherical, verbose=verbose,
+                                stage_timeout=stage_timeout)
+    if semaphore is None:
+        return await asyncio.wait_for(coro, timeout)
+    async with semaphore:
+        return await asyncio.wait_for(coro, timeout)
+
+async def _async_run_synth_lte(wmin, wmax, dw, Teff, logg, vt, MH, aFe, model_atmosphere_file,
+                               linelist_filenames, trim_linelists, linelist_margin, XFedict,
+                               modelopac_file, mopac_cache, spectrum_cache, twd, delete_twd, spherical, verbose,
+                               stage_timeout):
+    spectrum_cache, spectrum_key, cached = await _run_in_executor(
+        _check_spectrum_cache, spectrum_cache, wmin, wmax, dw, Teff, logg, vt, MH, aFe, model_atmosphere_file,
+        linelist_filenames, trim_linelists, linelist_margin, XFedict, modelopac_file, spherical)
+    if cached is not None:
+        return cached
+
+    if twd is None:
+        twd = utils.mkdtemp()
+        sys.stdout.write(f"Temporary working directory: {twd}")
+
+    ## Model Atmosphere File
+    atmosphere = await _run_in_executor(_resolve_model_atmosphere, twd, Teff, logg, vt, MH, aFe,
+                                        model_atmosphere_file, spherical)
+    if atmosphere["interpolate"]:
+        await async_interpolate_marcs_model(atmosphere["Teff"], atmosphere["logg"], atmosphere["MH"],
+                                            atmosphere["modelfilename"], spherical=atmosphere["spherical"],
+                                            timeout=utils.get_stage_timeout(stage_timeout, "interpol_modeles"))
+
+    ## Line Lists, Individual Abundances, and the working directory
+    linelist_filenames, indiv_abu = await _run_in_executor(_setup_twd, twd, wmin, wmax, linelist_filenames,
+                                                           trim_linelists, linelist_margin, XFedict)
+
+    ## Run babsma_lu for Model Opacity
+    kws_babsma_lu = _babsma_lu_kwargs(twd, wmin, wmax, dw, atmosphere, indiv_abu, verbose)
+    if modelopac_file is None:
+        modelopac_file = await async_run_babsma_lu(**kws_babsma_lu, mopac_cache=mopac_cache,
+                                                   timeout=utils.get_stage_timeout(stage_timeout, "babsma_lu"))
+    else:
+        modelopac_file = await _run_in_executor(_copy_modelopac_file, modelopac_file, twd)
+
+    ## Run bsyn_lu for Spectrum
+    kws_bsyn_lu = _bsyn_lu_kwargs(kws_babsma_lu, modelopac_file, linelist_filenames)
+    outfilename = await async_run_bsyn_lu(**kws_bsyn_lu, timeout=utils.get_stage_timeout(stage_timeout, "bsyn_lu"))
+
+    ## Read the spectrum output
+    wave, norm, flux = await _run_in_executor(read_bsyn_output, outfilename, wmin=wmin, wmax=wmax, dw=dw)
+    if spectrum_cache is not None:
+        await _run_in_executor(spectrum_cache.put, spectrum_key, (wave, norm, flux))
+
+    if delete_twd:
+        await _run_in_executor(shutil.rmtree, twd, ignore_errors=True)
+    return wave, norm, flux
+
+async def async_run_synth_lte_batch(jobs, max_concurrency=None, timeout=None, delete_twd=True):
+    """
+    Run many syntheses on the current event loop, like synthesizer.run_synth_lte_batch.
+
+    Parameters:
+    jobs (iterable of dict): Keyword arguments for async_run_synth_lte, one dict per job.
+    max_concurrency (int): Maximum number of jobs running at once (default: None, uses os.cpu_count())
+    timeout (float): Time limit in seconds for each job (default: None, no limit)
+    delete_twd (bool): Delete the working directory of each job that succeeds (default: True)
+
+    Returns:
+    list: One entry per job, in the same order as jobs. Either (wave, norm, flux)
+        or the exception raised by the job (e.g. asyncio.TimeoutError).
+    """
+    if max_concurrency is None:
+        max_concurrency = os.cpu_count() or 1
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks = []
+    for job in jobs:
+        job = dict(job)
+        job.setdefault("delete_twd", delete_twd)
+        job.setdefault("timeout", timeout)
+        tasks.append(async_run_synth_lte(**job, semaphore=semaphore))
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+async def async_run_babsma_lu(twd, wmin, wmax, dwl,
+                              modelfilename, modelopacname,
+                              MH, aFe, indiv_abu, vt, spherical,
+                              is_marcsfile=True,
+                              verbose=False, mopac_cache=None, timeout=None):
+    """
+    asyncio version of synthesizer.run_babsma_lu
+    """
+    scriptfilename = os.path.join(twd, 'babsma.par')
+    modelopacname = os.path.join(twd, 'mopac')
+    await _run_in_executor(_write_script, scriptfilename, wmin, wmax, dwl, None, modelfilename, is_marcsfile,
+                           modelopacname, MH, aFe, indiv_abu, vt, spherical, None, None, None, bsyn=False)
+    mopac_cache, cache_key, cache_hit = await _run_in_executor(_check_mopac_cache, mopac_cache, scriptfilename,
+                                                               modelfilename, spherical, modelopacname)
+    if cache_hit:
+        return modelopacname
+    await _async_run_turbospectrum('babsma_lu', twd, scriptfilename, verbose=verbose, timeout=timeout,
+                                   outputs=[modelopacname])
+    if mopac_cache is not None:
+        await _run_in_executor(mopac_cache.put, cache_key, modelopacname)
+    return modelopacname
+
+async def async_run_bsyn_lu(twd, wmin, wmax, dwl, costheta, modelfilename, is_marcsfile,
+                            modelopacname, MH, aFe, indiv_abu, vt, spherical,
+                            isotopes, linelistfilenames, verbose=False, timeout=None):
+    """
+    asyncio version of synthesizer.run_bsyn_lu (without saving a tarball of twd)
+    """
+    scriptfilename = os.path.join(twd, 'bsyn.par')
+    outfilename = os.path.join(twd, 'bsyn.out')
+    await _run_in_executor(_write_script, scriptfilename, wmin, wmax, dwl, costheta, modelfilename, is_marcsfile,
+                           modelopacname, MH, aFe, indiv_abu, vt, spherical, outfilename, isotopes,
+                           linelistfilenames, bsyn=True)
+    await _async_run_turbospectrum('bsyn_lu', twd, scriptfilename, verbose=verbose, timeout=timeout,
+                                   outputs=[outfilename])
+    return outfilename
+
+async def async_interpolate_marcs_model(Teff, logg, MH, outpath, spherical=True, verbose=False, timeout=None):
+    """
+    asyncio version of marcs.interpolate_marcs_model
+    """
+    selected_files = await _run_in_executor(marcs.find_marcs_models, Teff, logg, MH, spherical=spherical)
+    # Same as marcs._run_interpolator_lte: it runs in a scratch directory, since it also writes
+    # modele.sm into its working directory
+    outpath = os.path.abspath(outpath)
+    selected_files = [os.path.abspath(fname) for fname in selected_files]
+    interpol_config = marcs._interpolator_config_lte(Teff, logg, MH, selected_files, outpath)
+    executable = os.path.join(os.environ.get("TSINTERP_PATH"), 'interpol_modeles')
+    cwd = await _run_in_executor(tempfile.mkdtemp)
+    try:
+        await _async_run_executable(executable, interpol_config, cwd=cwd,
+                                    verbose=verbose, timeout=timeout, outputs=[outpath])
+    finally:
+        await _run_in_executor(shutil.rmtree, cwd, ignore_errors=True)
+    return outpath
+
+async def _async_run_turbospectrum(executable, twd, scriptfilename, verbose=False, timeout=None, outputs=()):
+    script = await _run_in_executor(_read_text, scriptfilename)
+    return await _async_run_executable(os.path.join(TSEXEC_PATH, executable), script, cwd=twd, verbose=verbose,
+                                       timeout=timeout, outputs=outputs)
+
+async def _async_run_executable(executable, stdin_text, cwd=None, verbose=False, timeout=None, outputs=()):
+    """
+    Run an executable with stdin_text on stdin and wait for it to finish.
+    If the waiting task is cancelled (including by a timeout), the process is killed first.
+    Like utils.run_executable, raises utils.TurbospectrumError if it exits with an error,
+    runs longer than timeout (s) or does not write outputs. Returns the exit code.
+    """
+    name = os.path.basename(executable)
+    await _run_in_executor(_remove_outputs, outputs)
+    if verbose:
+        stdout, stderr = None, None
+    else:
+        stdout, stderr = subprocess.DEVNULL, subprocess.STDOUT
+    proc = await asyncio.create_subprocess_exec(executable, cwd=cwd, stdin=subprocess.PIPE,
+                                                stdout=stdout, stderr=stderr)
+    try:
+        await asyncio.wait_for(proc.communicate(stdin_text.encode('utf-8')), timeout)
+    except asyncio.TimeoutError:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise utils.TurbospectrumError(f"{name} did not finish in {timeout} s and was killed (in {cwd})",
+                                       executable=name, returncode=proc.returncode, timed_out=True, cwd=cwd)
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise utils.TurbospectrumError(f"{name} failed with exit code {proc.returncode} (in {cwd})",
+                                       executable=name, returncode=proc.returncode, cwd=cwd)
+    missing = await _run_in_executor(_missing_outputs, outputs)
+    if missing:
+        raise utils.TurbospectrumError(f"{name} did not write {', '.join(missing)} (in {cwd})",
+                                       executable=name, returncode=proc.returncode, cwd=cwd)
+    return proc.returncode
+
+def _remove_outputs(outputs):
+    for output in outputs:
+        if os.path.isfile(output): os.remove(output)
+
+def _missing_outputs(outputs):
+    return [output for output in outputs if not os.path.exists(output)]
+
+def _read_text(fname):
+    with open(fname, 'r') as fp:
+        return fp.read()
+
+async def _run_in_executor(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
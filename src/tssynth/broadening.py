@@ -0,0 +1,155 @@
+"""
+Broadening of synthesized spectra: instrumental resolution, rotation and macroturbulence.
+
+All kernels are in velocity, so the spectra are resampled to a uniform grid in log(wavelength)
+(constant velocity step), convolved with FFTs and resampled back to the input wavelengths.
+Every function works on one spectrum (npix,) or a batch of spectra (N, npix) on the same
+wavelength grid, without a Python loop over the spectra.
+"""
+import numpy as np
+import math
+from .utils import SPEED_OF_LIGHT
+
+def broaden(wave, flux, R=None, vsini=None, epsilon=0.6, vmacro=None):
+    """
+    Broaden spectra with a Gaussian instrumental profile, rotation and radial-tangential macroturbulence.
+
+    Parameters:
+    wave (array): Wavelengths (A), increasing. Need not be uniform.
+    flux (array): Spectrum (npix,) or batch of spectra (N, npix) on wave, e.g. norm or flux from run_synth_lte.
+    R (float or array): Resolving power lambda/FWHM of the Gaussian instrumental profile (default: None, no
+        instrumental broadening). An array of length npix gives a resolving power that changes with wavelength.
+    vsini (float): Projected rotational velocity (km/s) (default: None, no rotation)
+    epsilon (float): Linear limb darkening coefficient of the rotation kernel (default: 0.6)
+    vmacro (float): Radial-tangential macroturbulence zeta_RT (km/s) (default: None, no macroturbulence)
+
+    Returns:
+    array: Broadened spectra with the same shape as flux, on wave.
+
+    Example:
+    >>> wave, norm, flux = run_synth_lte(5000, 5100, 0.01, Teff=5000, logg=2.0, MH=-2.0)
+    >>> norm_obs = broaden(wave, norm, R=40000, vsini=5.0, vmacro=4.0)
+    """
+    wave = np.asarray(wave, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    if flux.shape[-1] != len(wave):
+        raise ValueError(f"flux has {flux.shape[-1]} pixels but wave has {len(wave)}")
+    if np.any(np.diff(wave) <= 0):
+        raise ValueError("wave must be increasing")
+    variable_R = R is not None and np.ndim(R) > 0
+    if variable_R and len(R) != len(wave):
+        raise ValueError(f"R has {len(R)} values but wave has {len(wave)}")
+
+    ## Uniform grid in log(wavelength), with the smallest velocity step of the input
+    lnwave = np.log(wave)
+    dlnwave = np.min(np.diff(lnwave))
+    nlog = int(np.ceil((lnwave[-1] - lnwave[0])/dlnwave)) + 1
+    lnwave_log = lnwave[0] + dlnwave*np.arange(nlog)
+    lnwave_log[-1] = min(lnwave_log[-1], lnwave[-1])
+    uniform = nlog == len(wave) and np.allclose(lnwave_log, lnwave, rtol=0, atol=1e-3*dlnwave)
+    if uniform:
+        flux_log = flux
+    else:
+        flux_log = _interp_rows(lnwave, flux, lnwave_log)
+    dv = SPEED_OF_LIGHT*dlnwave
+
+    kernels = []
+    if R is not None and not variable_R:
+        kernels.append(gaussian_kernel(dv, SPEED_OF_LIGHT/R))
+    if vsini is not None and vsini > 0:
+        kernels.append(rotation_kernel(dv, vsini, epsilon))
+    if vmacro is not None and vmacro > 0:
+        kernels.append(macroturbulence_kernel(dv, vmacro))
+    if kernels:
+        flux_log = convolve_fft(flux_log, kernels)
+    if variable_R:
+        R_log = np.interp(lnwave_log, lnwave, np.asarray(R, dtype=float))
+        flux_log = _convolve_variable_gaussian(flux_log, dv, SPEED_OF_LIGHT/R_log)
+
+    if uniform:
+        return flux_log
+    return _interp_rows(lnwave_log, flux_log, lnwave)
+
+def gaussian_kernel(dv, fwhm):
+    """
+    Gaussian kernel with full width at half maximum fwhm (km/s), sampled every dv (km/s) and normalized to sum 1.
+    """
+    sigma = fwhm/(2*np.sqrt(2*np.log(2)))
+    v = _kernel_velocities(dv, 5*sigma)
+    kernel = np.exp(-0.5*(v/sigma)**2)
+    return kernel/kernel.sum()
+
+def rotation_kernel(dv, vsini, epsilon=0.6):
+    """
+    Rotational broadening kernel (Gray, The Observation and Analysis of Stellar Photospheres)
+    with linear limb darkening epsilon, sampled every dv (km/s) and normalized to sum 1.
+    """
+    v = _kernel_velocities(dv, vsini)
+    x2 = np.clip(1 - (v/vsini)**2, 0, None)
+    kernel = 2*(1 - epsilon)*np.sqrt(x2) + 0.5*np.pi*epsilon*x2
+    if kernel.sum() <= 0: # vsini much smaller than dv
+        return np.ones(1)
+    return kernel/kernel.sum()
+
+def macroturbulence_kernel(dv, vmacro):
+    """
+    Radial-tangential macroturbulence kernel (Gray) with equal radial and tangential parts
+    and zeta_RT = vmacro (km/s), sampled every dv (km/s) and normalized to sum 1.
+    """
+    v = _kernel_velocities(dv, 5*vmacro)
+    u = np.abs(v)/vmacro
+    erfc = np.array([math.erfc(x) for x in u])
+    kernel = np.exp(-u**2) - np.sqrt(np.pi)*u*erfc
+    return kernel/kernel.sum()
+
+def convolve_fft(flux, kernels):
+    """
+    Convolve the rows of flux (npix,) or (N, npix) with one or more kernels (odd length, centered)
+    using FFTs. The spectra are padded with their edge values so the ends do not wrap around.
+    """
+    if isinstance(kernels, np.ndarray):
+        kernels = [kernels]
+    npad = sum(len(kernel)//2 for kernel in kernels)
+    npix = flux.shape[-1]
+    nfft = 1 << int(np.ceil(np.log2(npix + 2*npad + max(len(kernel) for kernel in kernels))))
+    pad_width = [(0, 0)]*(flux.ndim - 1) + [(npad, npad)]
+    padded = np.pad(flux, pad_width, mode="edge")
+    transform = np.fft.rfft(padded, n=nfft, axis=-1)
+    for kernel in kernels:
+        ## Put the center of the kernel at index 0
+        shifted = np.zeros(nfft)
+        half = len(kernel)//2
+        shifted[:half+1] = kernel[half:]
+        if half > 0: shifted[-half:] = kernel[:half]
+        transform *= np.fft.rfft(shifted)
+    return np.fft.irfft(transform, n=nfft, axis=-1)[..., npad:npad+npix]
+
+def _kernel_velocities(dv, vmax):
+    half = max(int(np.ceil(vmax/dv)), 1)
+    return dv*np.arange(-half, half + 1)
+
+def _convolve_variable_gaussian(flux, dv, fwhm):
+    """
+    Convolve with a Gaussian whose FWHM (km/s) is given for every pixel.
+    Loops over the offsets within the widest kernel, each step working on all pixels and spectra.
+    """
+    sigma = fwhm/(2*np.sqrt(2*np.log(2)))/dv # pixels
+    half = max(int(np.ceil(5*np.max(sigma))), 1)
+    npix = flux.shape[-1]
+    pad_width = [(0, 0)]*(flux.ndim - 1) + [(half, half)]
+    padded = np.pad(flux, pad_width, mode="edge")
+    total = np.zeros_like(flux)
+    norm = np.zeros(npix)
+    for offset in range(-half, half + 1):
+        weight = np.exp(-0.5*(offset/sigma)**2)
+        total += weight*padded[..., half+offset:half+offset+npix]
+        norm += weight
+    return total/norm
+
+def _interp_rows(x, y, xnew):
+    """
+    np.interp of every row of y (npix,) or (N, npix) from x to xnew.
+    """
+    i = np.clip(np.searchsorted(x, xnew, side="right") - 1, 0, len(x) - 2)
+    w = np.clip((xnew - x[i])/(x[i+1] - x[i]), 0, 1)
+    return y[..., i]*(1 - w) + y[..., i+1]*w
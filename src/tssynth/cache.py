@@ -0,0 +1,342 @@
+import os, shutil, hashlib, threading, json, zipfile
+from collections import OrderedDict
+import numpy as np
+
+TWD_BASE = os.environ.get('TWD_BASE', None)
+
+def hash_file(fname, h=None):
+    """
+    Update (or create) a sha256 hash with the contents of a file.
+    """
+    if h is None: h = hashlib.sha256()
+    with open(fname, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            h.update(chunk)
+    return h
+
+def file_identity(fname):
+    """
+    Cheap identifier for a file: path, size and modification time.
+    """
+    st = os.stat(fname)
+    return f"{os.path.realpath(fname)}:{st.st_size}:{st.st_mtime_ns}"
+
+def executable_identity(fname):
+    """
+    Cheap identifier for a compiled executable (see file_identity).
+    Recompiling Turbospectrum changes this, which invalidates anything cached with it.
+    """
+    return file_identity(fname)
+
+def mopac_cache_key(scriptfilename, modelfilename, spherical, executable=None):
+    """
+    Hash of everything that determines the babsma_lu output.
+
+    This is the babsma_lu script written by _write_script(bsyn=False), with the
+    model atmosphere and model opacity paths replaced by the model atmosphere contents.
+    The paths point into the twd so they differ between otherwise identical runs.
+    """
+    h = hashlib.sha256()
+    with open(scriptfilename, "r") as fp:
+        for line in fp:
+            if line.startswith("'MODELINPUT:'") or line.startswith("'MODELOPAC:'"):
+                continue
+            h.update(line.encode("utf-8"))
+    h.update(f"spherical={bool(spherical)}\n".encode("utf-8"))
+    if executable is not None:
+        h.update(f"executable={executable_identity(executable)}\n".encode("utf-8"))
+    hash_file(modelfilename, h)
+    return h.hexdigest()
+
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+class _DiskCache:
+    """
+    Directory of cache entries, one file per key, evicted least recently used first.
+
+    The modification time of an entry is updated on every hit, and the least recently used
+    entries are removed once there are more than max_entries files or more than max_bytes on disk.
+    Writes go through a temporary file and os.replace, so several processes can share
+    one cache directory.
+
+    Listing a big cache directory is slow on shared filesystems, so put does not do it every time.
+    Each object keeps a running count of the entries and bytes, and only lists the directory when
+    that count goes over a limit or every evict_interval puts (to notice entries written by other
+    processes). It then evicts down to 90% of the limits, so the next puts do not evict again.
+    evict() always lists the directory.
+    """
+    suffix = None
+    default_dir = None
+    evict_interval = 100
+
+    def __init__(self, cache_dir=None, max_entries=1000, max_bytes=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(TWD_BASE, self.default_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._evict_lock = threading.Lock()
+        self._n_entries = None # running count since the directory was last listed, None before that
+        self._n_bytes = 0
+        self._puts_since_evict = 0
+
+    @classmethod
+    def shared(cls, cache_dir):
+        """
+        The cache for cache_dir that is shared by every caller in this process
+        (e.g. run_synth_lte called with the cache as a path), created with the default limits.
+        Sharing keeps the memory level, hit/miss counts and eviction bookkeeping between calls.
+        """
+        key = (cls, os.path.realpath(cache_dir))
+        with _shared_caches_lock:
+            if key not in _shared_caches:
+                _shared_caches[key] = cls(cache_dir)
+            return _shared_caches[key]
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def _tmppath(self, path):
+        return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def entries(self):
+        """
+        List of (mtime, size, path) of all entries, oldest first.
+        """
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith(self.suffix): continue
+            path = os.path.join(self.cache_dir, fname)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is within max_entries and max_bytes.
+        """
+        self._evict(headroom=False)
+
+    def _evict(self, headroom):
+        entries = self.entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        max_entries, max_bytes = self.max_entries, self.max_bytes
+        over = (max_entries is not None and len(entries) > max_entries) or \
+               (max_bytes is not None and total_bytes > max_bytes)
+        if over and headroom:
+            if max_entries is not None: max_entries -= max_entries//10
+            if max_bytes is not None: max_bytes -= max_bytes//10
+        while entries and ((max_entries is not None and len(entries) > max_entries) or
+                           (max_bytes is not None and total_bytes > max_bytes)):
+            _, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+        with self._evict_lock:
+            self._n_entries, self._n_bytes, self._puts_since_evict = len(entries), total_bytes, 0
+
+    def _added(self, size, new):
+        """
+        Count an entry written by put, and evict if the cache may be over its limits (see the class docstring).
+        """
+        with self._evict_lock:
+            if self._n_entries is not None:
+                self._n_entries += int(new)
+                self._n_bytes += size
+                self._puts_since_evict += 1
+                due = (self.max_entries is not None and self._n_entries > self.max_entries) or \
+                      (self.max_bytes is not None and self._n_bytes > self.max_bytes) or \
+                      self._puts_since_evict >= self.evict_interval
+            else:
+                due = True
+        if due:
+            self._evict(headroom=True)
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._evict_lock:
+            self._n_entries, self._n_bytes, self._puts_since_evict = 0, 0, 0
+
+class MopacCache(_DiskCache):
+    """
+    Content-addressed on-disk cache of babsma_lu model opacity (mopac) files.
+
+    Entries are keyed by mopac_cache_key. Old entries are evicted as described in _DiskCache.
+
+    Parameters:
+    -----------
+    cache_dir : str, optional
+        Directory of the cache. Default is TWD_BASE/mopac_cache.
+    max_entries : int, optional
+        Maximum number of model opacities to keep. Default is 1000.
+    max_bytes : int, optional
+        Maximum total size of the cache. Default is None (no limit).
+    """
+    suffix = ".mopac"
+    default_dir = "mopac_cache"
+
+    def get(self, key, outpath):
+        """
+        Copy the cached mopac for key to outpath.
+        Returns True on a hit and False on a miss.
+        """
+        path = self._path(key)
+        try:
+            os.utime(path)
+            shutil.copy(path, outpath)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, mopacpath):
+        """
+        Store the mopac file at mopacpath under key, then evict old entries if needed.
+        """
+        path = self._path(key)
+        tmppath = self._tmppath(path)
+        shutil.copy(mopacpath, tmppath)
+        size = os.path.getsize(tmppath)
+        new = not os.path.exists(path)
+        os.replace(tmppath, path)
+        self._added(size, new)
+
+## Bump this when a change to the synthesis would change the spectra stored in a SpectrumCache
+SPECTRUM_CACHE_VERSION = 1
+
+def spectrum_cache_key(params, files=(), hashed_files=()):
+    """
+    Hash of all the inputs of a synthesized spectrum.
+
+    params is a JSON-serializable dict of the parameters (see synthesizer._check_spectrum_cache).
+    files (e.g. line lists and executables) are identified by file_identity, which is fast for
+    big files, while hashed_files (e.g. model atmospheres) are identified by their contents.
+    """
+    h = hashlib.sha256()
+    h.update(f"version={SPECTRUM_CACHE_VERSION}\n".encode("utf-8"))
+    h.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    for fname in files:
+        h.update(f"\nfile={file_identity(fname)}".encode("utf-8"))
+    for fname in hashed_files:
+        h.update(b"\nhashed_file=")
+        hash_file(fname, h)
+    return h.hexdigest()
+
+class SpectrumCache(_DiskCache):
+    """
+    Two level cache of synthesized spectra (wave, norm, flux): an LRU dict in memory
+    in front of compressed .npz files on disk.
+
+    Entries are keyed by spectrum_cache_key. The disk level is evicted as described in
+    _DiskCache and can be shared by several processes; each process has its own memory level.
+    hits/misses count the lookups made through this object (see stats).
+
+    Parameters:
+    -----------
+    cache_dir : str, optional
+        Directory of the disk cache. Default is TWD_BASE/spectrum_cache.
+    max_memory_entries : int, optional
+        Number of spectra kept in memory. Default is 128; 0 turns off the memory level.
+    max_entries : int, optional
+        Maximum number of spectra kept on disk. Default is 10000.
+    max_bytes : int, optional
+        Maximum total size of the disk cache. Default is None (no limit).
+
+    Example:
+    --------
+    >>> spectrum_cache = SpectrumCache()
+    >>> wave, norm, flux = run_synth_lte(5000, 5100, 0.01, Teff=5000, logg=2.0, MH=-2.0,
+    ...                                  spectrum_cache=spectrum_cache)
+    >>> spectrum_cache.stats()
+    """
+    suffix = ".npz"
+    default_dir = "spectrum_cache"
+
+    def __init__(self, cache_dir=None, max_memory_entries=128, max_entries=10000, max_bytes=None):
+        super().__init__(cache_dir=cache_dir, max_entries=max_entries, max_bytes=max_bytes)
+        self.max_memory_entries = max_memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns (wave, norm, flux) cached under key, or None on a miss.
+        The arrays are copies, so they can be changed without changing the cache.
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return tuple(arr.copy() for arr in self._memory[key])
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                spectrum = (data["wave"], data["norm"], data["flux"])
+            os.utime(path)
+        except FileNotFoundError:
+            spectrum = None
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # Unreadable entry, e.g. written by an incompatible version
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            spectrum = None
+        with self._lock:
+            if spectrum is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, spectrum)
+        return tuple(arr.copy() for arr in spectrum)
+
+    def put(self, key, spectrum):
+        """
+        Store spectrum = (wave, norm, flux) under key in memory and on disk, then evict old entries if needed.
+        """
+        wave, norm, flux = [np.array(arr) for arr in spectrum]
+        with self._lock:
+            self._remember(key, (wave, norm, flux))
+        path = self._path(key)
+        tmppath = self._tmppath(path)
+        with open(tmppath, "wb") as fp:
+            np.savez_compressed(fp, wave=wave, norm=norm, flux=flux)
+            size = fp.tell()
+        new = not os.path.exists(path)
+        os.replace(tmppath, path)
+        self._added(size, new)
+
+    def _remember(self, key, spectrum):
+        if self.max_memory_entries <= 0: return
+        self._memory[key] = spectrum
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        """
+        Dict with the number of memory_hits, disk_hits, misses and the hit_rate.
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return dict(memory_hits=self.memory_hits, disk_hits=self.disk_hits, misses=self.misses,
+                        hit_rate=(self.memory_hits + self.disk_hits)/lookups if lookups else 0.0,
+                        memory_entries=len(self._memory))
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        super().clear()
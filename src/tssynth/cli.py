@@ -0,0 +1,60 @@
+"""
+Command line interface: tssynth worker|submit|status QUEUE
+
+  tssynth submit QUEUE jobs.jsonl   add jobs (one JSON dict of run_synth_lte arguments per line)
+  tssynth worker QUEUE              claim and run jobs until the queue is empty
+  tssynth status QUEUE              number of jobs with each status (and the errors with --failed)
+"""
+import argparse, json, sys
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="tssynth", description="Run tssynth work queues.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    worker = commands.add_parser("worker", help="Claim and run jobs from a queue")
+    worker.add_argument("queue", help="Queue database")
+    worker.add_argument("--threads", type=int, default=1, help="Jobs to run at the same time (default: 1)")
+    worker.add_argument("--max-jobs", type=int, default=None, help="Stop after this many jobs")
+    worker.add_argument("--wait", action="store_true", help="Keep waiting for new jobs when the queue is empty")
+    worker.add_argument("--poll-interval", type=float, default=10.0, help="Seconds between polls (default: 10)")
+    worker.add_argument("--lease", type=float, default=600, help="Lease of a claimed job in seconds (default: 600)")
+    worker.add_argument("--retries", type=int, default=0, help="Retries of transient failures (default: 0)")
+    worker.add_argument("--quarantine-dir", default=None, help="Move the twd of failed jobs here")
+    worker.add_argument("--keep-twd", action="store_true", help="Keep the twd of jobs that succeed")
+
+    submit = commands.add_parser("submit", help="Add jobs to a queue")
+    submit.add_argument("queue", help="Queue database (created if needed)")
+    submit.add_argument("jobs", help="File with one JSON dict of run_synth_lte arguments per line, or - for stdin")
+
+    status = commands.add_parser("status", help="Show the jobs in a queue")
+    status.add_argument("queue", help="Queue database")
+    status.add_argument("--failed", action="store_true", help="Show the errors of failed jobs")
+    status.add_argument("--retry-failed", action="store_true", help="Put failed jobs back in the queue")
+
+    args = parser.parse_args(argv)
+    from .workqueue import WorkQueue, run_worker, JOB_FAILED
+    if args.command == "worker":
+        queue = WorkQueue(args.queue, lease_seconds=args.lease)
+        stats = run_worker(queue, n_threads=args.threads, max_jobs=args.max_jobs, wait=args.wait,
+                           poll_interval=args.poll_interval, delete_twd=not args.keep_twd,
+                           retries=args.retries, quarantine_dir=args.quarantine_dir)
+        return 1 if stats["failed"] else 0
+    if args.command == "submit":
+        fp = sys.stdin if args.jobs == "-" else open(args.jobs)
+        with fp:
+            jobs = [json.loads(line) for line in fp if line.strip()]
+        ids = WorkQueue(args.queue).submit(jobs)
+        print(f"Submitted {len(ids)} jobs to {args.queue}")
+        return 0
+    if args.command == "status":
+        queue = WorkQueue(args.queue)
+        if args.retry_failed:
+            print(f"Put {queue.retry_failed()} failed jobs back in the queue")
+        print(" ".join(f"{status}={n}" for status, n in queue.counts().items()))
+        if args.failed:
+            for job in queue.jobs(JOB_FAILED):
+                print(f"--- job {job['id']} ({job['worker']}): {json.dumps(job['job'])}\n{job['error']}")
+        return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
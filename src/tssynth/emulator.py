@@ -0,0 +1,142 @@
+"""
+Interpolate spectra from a grid made by grid.build_grid instead of running Turbospectrum.
+"""
+import numpy as np
+from .grid import SpectralGrid, GRID_STATUS_DONE
+from .synthesizer import run_synth_lte_batch
+
+class SpectralEmulator:
+    """
+    Multilinear interpolation of the spectra in a SpectralGrid.
+
+    Queries are vectorized: N parameter vectors give N spectra with one gather and a
+    weighted sum over the 2^ndim corners of the grid cell around each query.
+    A query outside the grid, or whose corners are not all done, either falls back to
+    run_synth_lte (fallback=True) or gives NaN.
+
+    Parameters:
+    -----------
+    grid : SpectralGrid or str
+        The grid, or the directory of one.
+    column : str, optional
+        "norm" (default) or "flux".
+    in_memory : bool, optional
+        Read the whole column into memory (default: True). If False, rows are read from the
+        memory map when needed, which is slower but works for grids bigger than memory.
+    fallback : bool, optional
+        Run run_synth_lte for queries the grid cannot answer (default: False, gives NaN).
+    fallback_kwargs : dict, optional
+        run_synth_lte arguments for fallback runs. Default is the fixed arguments stored with
+        the grid; set this if they included objects (e.g. a MopacCache) that were not saved.
+    n_workers : int, optional
+        Number of fallback runs at the same time (default: None, uses os.cpu_count()).
+
+    Example:
+    --------
+    >>> emulator = SpectralEmulator("grids/giants")
+    >>> emulator.names
+    ['Teff', 'logg', 'MH', 'Eu']
+    >>> norm = emulator([[4510, 1.6, -2.4, 0.1], [4720, 1.2, -2.1, 0.3]])  # shape (2, npix)
+    >>> norm = emulator(Teff=4510, logg=1.6, MH=-2.4, Eu=0.1)  # shape (npix,)
+    """
+    def __init__(self, grid, column="norm", in_memory=True, fallback=False, fallback_kwargs=None,
+                 n_workers=None):
+        if not isinstance(grid, SpectralGrid):
+            grid = SpectralGrid(grid)
+        if column not in ("norm", "flux"):
+            raise ValueError(f"column must be norm or flux, got {column}")
+        self.grid = grid
+        self.column = column
+        self.names = list(grid.names)
+        self.wave = grid.wave
+        self.data = getattr(grid, column)
+        if in_memory:
+            self.data = np.array(self.data)
+        self.done = np.array(grid.status) == GRID_STATUS_DONE
+        self.fallback = fallback
+        self.fallback_kwargs = grid.metadata["kwargs"] if fallback_kwargs is None else fallback_kwargs
+        self.n_workers = n_workers
+        ## Sorted axis values and where they are in the grid
+        self._order = [np.argsort(values) for name, values in grid.axes]
+        self._values = [values[order] for (name, values), order in zip(grid.axes, self._order)]
+        self._strides = np.array([int(np.prod(grid.shape[i+1:])) for i in range(len(grid.shape))])
+
+    def __call__(self, params=None, **kwparams):
+        """
+        Interpolated spectra.
+
+        params is a parameter vector in the order of names, or an (N, ndim) array of them.
+        The parameters can also be given as keywords (scalars or arrays of length N).
+        Returns an (npix,) array for one vector and an (N, npix) array otherwise.
+        """
+        if kwparams:
+            if params is not None: raise ValueError("Give params or keywords, not both")
+            if set(kwparams) != set(self.names):
+                raise ValueError(f"Need values for exactly {self.names}, got {list(kwparams)}")
+            params = np.stack(np.broadcast_arrays(*[np.asarray(kwparams[name], dtype=float)
+                                                    for name in self.names]), axis=-1)
+        params = np.asarray(params, dtype=float)
+        single = params.ndim == 1
+        params = np.atleast_2d(params)
+        if params.shape[1] != len(self.names):
+            raise ValueError(f"Expected {len(self.names)} parameters {self.names}, got {params.shape[1]}")
+        spectra, inside = self.interpolate(params)
+        if not np.all(inside):
+            outside = np.where(~inside)[0]
+            if self.fallback:
+                spectra[outside] = self._run_fallback(params[outside])
+            else:
+                spectra[outside] = np.nan
+        return spectra[0] if single else spectra
+
+    def interpolate(self, params):
+        """
+        Multilinear interpolation of an (N, ndim) array of parameters.
+        Returns the (N, npix) spectra and a boolean array that is False for queries
+        the grid cannot answer (their spectra are garbage).
+        """
+        nquery, ndim = params.shape
+        inside = np.ones(nquery, dtype=bool)
+        lower = np.zeros((nquery, ndim), dtype=int)
+        frac = np.zeros((nquery, ndim))
+        for k, values in enumerate(self._values):
+            x = params[:, k]
+            if len(values) == 1:
+                inside &= np.isclose(x, values[0], rtol=0, atol=1e-6)
+                continue
+            inside &= (x >= values[0] - 1e-6) & (x <= values[-1] + 1e-6)
+            i0 = np.clip(np.searchsorted(values, x, side="right") - 1, 0, len(values) - 2)
+            lower[:, k] = i0
+            frac[:, k] = np.clip((x - values[i0])/(values[i0+1] - values[i0]), 0, 1)
+
+        dims = [k for k, values in enumerate(self._values) if len(values) > 1]
+        spectra = np.zeros((nquery, self.data.shape[1]), dtype=np.result_type(self.data.dtype, np.float32))
+        for corner in range(2**len(dims)):
+            index = np.zeros(nquery, dtype=int)
+            weight = np.ones(nquery)
+            for k, values in enumerate(self._values):
+                if k in dims:
+                    bit = (corner >> dims.index(k)) & 1
+                    i = lower[:, k] + bit
+                    weight *= frac[:, k] if bit else 1 - frac[:, k]
+                else:
+                    i = lower[:, k]
+                index += self._order[k][i]*self._strides[k]
+            used = weight > 0
+            inside &= ~used | self.done[index]
+            if not np.any(used): continue
+            spectra[used] += weight[used, None]*self.data[index[used]]
+        return spectra, inside
+
+    def _run_fallback(self, params):
+        jobs = [self.grid.job_for_params({name: float(value) for name, value in zip(self.names, row)},
+                                         **self.fallback_kwargs)
+                for row in params]
+        spectra = np.full((len(jobs), len(self.wave)), np.nan)
+        icolumn = 1 if self.column == "norm" else 2
+        for i, result in enumerate(run_synth_lte_batch(jobs, n_workers=self.n_workers)):
+            if isinstance(result, Exception):
+                print(f"Fallback run_synth_lte failed for {dict(zip(self.names, params[i]))}: {result}")
+                continue
+            spectra[i] = result[icolumn]
+        return spectra
@@ -0,0 +1,222 @@
+"""
+Resumable grids of synthetic spectra.
+
+A grid lives in one directory:
+  grid.json   axes, wavelength range and the fixed run_synth_lte arguments
+  wave.npy    wavelength of every pixel
+  norm.npy    (N_models, N_pixels) normalized spectra, memory-mapped while building
+  flux.npy    (N_models, N_pixels) fluxes, memory-mapped while building
+  status.npy  (N_models,) GRID_STATUS_MISSING/DONE/FAILED of every cell
+A cell is only marked done after its spectrum has been flushed to disk, so build_grid
+can be stopped at any time and rerun to compute only the cells that are missing.
+"""
+import numpy as np
+import os, sys, json
+from .synthesizer import iter_synth_lte_batch
+from .solar_abundances import periodic_table
+
+GRID_VERSION = 1
+GRID_STATUS_MISSING, GRID_STATUS_DONE, GRID_STATUS_FAILED = 0, 1, 2
+GRID_PARAMETERS = ("Teff", "logg", "MH", "aFe", "vt")
+## run_synth_lte arguments that do not change the spectra, so they are not compared when resuming
+_UNRECORDED_KWARGS = ("mopac_cache", "spectrum_cache", "verbose", "delete_twd", "stage_timeout")
+
+def build_grid(output_directory, axes, wmin, wmax, dw,
+               n_workers=None, use_processes=False, twd_pool=None,
+               dtype=np.float32, retry_failed=False,
+               retries=0, retry_backoff=1.0, quarantine_dir=None, **kwargs):
+    """
+    Synthesize a grid of spectra over the outer product of axes, or finish a partly built one.
+
+    Parameters:
+    output_directory (str): Directory of the grid. Created if needed.
+        If it already has a grid, the axes and arguments must be the same; only the
+        cells that are not done yet are computed.
+    axes (dict or list of (name, values)): Grid axes, in order (the last varies fastest).
+        Names are run_synth_lte parameters in GRID_PARAMETERS (Teff, logg, MH, aFe, vt)
+        or element symbols, which are put in the XFedict of each cell.
+    wmin (float): Minimum wavelength (A)
+    wmax (float): Maximum wavelength (A)
+    dw (float): Wavelength step (A)
+    n_workers (int): Number of cells to run at the same time (default: None, uses os.cpu_count())
+    use_processes (bool): Same as for synthesizer.run_synth_lte_batch
+    twd_pool (workdir.WorkdirPool): Same as for synthesizer.run_synth_lte_batch
+    dtype: dtype of the stored spectra (default: np.float32)
+    retry_failed (bool): Also rerun cells that failed in an earlier build (default: False)
+    retries, retry_backoff, quarantine_dir: Same as for synthesizer.run_synth_lte_batch
+    **kwargs: Passed to run_synth_lte for every cell (e.g. linelist_filenames, XFedict, spherical).
+        Set stage_timeout so a Fortran program that hangs on one cell does not stall the grid.
+
+    Returns:
+    SpectralGrid: The grid, opened read-only.
+
+    Example:
+    >>> grid = build_grid("grids/giants", dict(Teff=np.arange(4000, 5501, 100), logg=[1.0, 1.5, 2.0],
+    ...                   MH=[-3.0, -2.5, -2.0], Eu=[-0.5, 0.0, 0.5]), 4000, 4200, 0.01)
+    >>> flux = grid.flux[grid.index(Teff=4500, logg=1.5, MH=-2.5, Eu=0.0)]
+    """
+    if "twd" in kwargs:
+        raise ValueError("Each cell runs in its own twd, twd cannot be specified.")
+    axes = _normalize_axes(axes)
+    metadata = dict(version=GRID_VERSION, axes=axes,
+                    wmin=float(wmin), wmax=float(wmax), dw=float(dw),
+                    npix=int(round((wmax-wmin)/dw)) + 1, dtype=np.dtype(dtype).str,
+                    kwargs=json.loads(json.dumps({key: value for key, value in kwargs.items()
+                                                  if key not in _UNRECORDED_KWARGS}, default=str)))
+    metafile = os.path.join(output_directory, "grid.json")
+    if os.path.exists(metafile):
+        with open(metafile) as fp:
+            existing = json.load(fp)
+        if existing != metadata:
+            different = [key for key in metadata if existing.get(key) != metadata[key]]
+            raise ValueError(f"{output_directory} has a different grid, {different} do not match")
+    else:
+        _create_grid(output_directory, metadata)
+
+    grid = SpectralGrid(output_directory, mode="r+")
+    todo = np.where(grid.status == GRID_STATUS_MISSING)[0]
+    if retry_failed:
+        todo = np.where(grid.status != GRID_STATUS_DONE)[0]
+    print(f"Grid {output_directory}: {len(grid)-len(todo)}/{len(grid)} cells done, computing {len(todo)}")
+    jobs = [grid.job(i, **kwargs) for i in todo]
+    nfailed = 0
+    for ndone, (j, result) in enumerate(iter_synth_lte_batch(jobs, n_workers=n_workers,
+                                                              use_processes=use_processes,
+                                                              twd_pool=twd_pool, retries=retries,
+                                                              retry_backoff=retry_backoff,
+                                                              quarantine_dir=quarantine_dir), start=1):
+        i = todo[j]
+        if isinstance(result, Exception):
+            grid.status[i] = GRID_STATUS_FAILED
+            nfailed += 1
+        else:
+            wave, norm, flux = result
+            grid.norm[i] = norm
+            grid.flux[i] = flux
+            ## Make sure the spectrum is on disk before the cell is marked done
+            grid.norm.flush()
+            grid.flux.flush()
+            grid.status[i] = GRID_STATUS_DONE
+        grid.status.flush()
+        sys.stdout.write(f"\rGrid {output_directory}: {ndone}/{len(todo)} computed, {nfailed} failed")
+        sys.stdout.flush()
+    sys.stdout.write("\n")
+    del grid
+    return SpectralGrid(output_directory)
+
+def _normalize_axes(axes):
+    if isinstance(axes, dict):
+        axes = list(axes.items())
+    normalized = []
+    for name, values in axes:
+        if name not in GRID_PARAMETERS and name not in periodic_table:
+            raise ValueError(f"Grid axis {name} must be one of {GRID_PARAMETERS} or an element symbol")
+        values = [float(value) for value in np.atleast_1d(values)]
+        if len(values) == 0: raise ValueError(f"Grid axis {name} has no values")
+        if len(set(values)) != len(values): raise ValueError(f"Grid axis {name} has repeated values")
+        normalized.append([name, values])
+    names = [name for name, values in normalized]
+    if len(set(names)) != len(names): raise ValueError(f"Repeated grid axes: {names}")
+    return normalized
+
+def _create_grid(output_directory, metadata):
+    os.makedirs(output_directory, exist_ok=True)
+    nmodels = int(np.prod([len(values) for name, values in metadata["axes"]]))
+    npix = metadata["npix"]
+    wave = metadata["wmin"] + metadata["dw"]*np.arange(npix)
+    np.save(os.path.join(output_directory, "wave.npy"), wave)
+    for name in ["norm", "flux"]:
+        arr = np.lib.format.open_memmap(os.path.join(output_directory, f"{name}.npy"), mode="w+",
+                                        dtype=np.dtype(metadata["dtype"]), shape=(nmodels, npix))
+        del arr
+    status = np.lib.format.open_memmap(os.path.join(output_directory, "status.npy"), mode="w+",
+                                       dtype=np.uint8, shape=(nmodels,))
+    status[:] = GRID_STATUS_MISSING
+    status.flush()
+    del status
+    ## Written last, so an interrupted _create_grid is redone
+    metafile = os.path.join(output_directory, "grid.json")
+    with open(metafile + ".tmp", "w") as fp:
+        json.dump(metadata, fp, indent=1)
+    os.replace(metafile + ".tmp", metafile)
+
+class SpectralGrid:
+    """
+    A grid of spectra made by build_grid.
+
+    norm and flux are memory-mapped (N_models, N_pixels) arrays, so grids bigger than
+    memory can be used. Only the rows with status GRID_STATUS_DONE hold spectra.
+    Cells are numbered in C order over the axes (the last axis varies fastest).
+
+    Parameters:
+    -----------
+    output_directory : str
+        Directory of the grid.
+    mode : str, optional
+        Memory map mode of norm, flux and status: "r" (default) or "r+".
+    """
+    def __init__(self, output_directory, mode="r"):
+        with open(os.path.join(output_directory, "grid.json")) as fp:
+            self.metadata = json.load(fp)
+        if self.metadata["version"] != GRID_VERSION:
+            raise ValueError(f"Grid version {self.metadata['version']} is not {GRID_VERSION}")
+        self.output_directory = output_directory
+        self.axes = [(name, np.array(values)) for name, values in self.metadata["axes"]]
+        self.names = [name for name, values in self.axes]
+        self.shape = tuple(len(values) for name, values in self.axes)
+        self.wave = np.load(os.path.join(output_directory, "wave.npy"))
+        self.norm = np.load(os.path.join(output_directory, "norm.npy"), mmap_mode=mode)
+        self.flux = np.load(os.path.join(output_directory, "flux.npy"), mmap_mode=mode)
+        self.status = np.load(os.path.join(output_directory, "status.npy"), mmap_mode=mode)
+
+    def __len__(self):
+        return len(self.status)
+
+    def params(self, i):
+        """
+        Dict of the axis values of cell i.
+        """
+        indices = np.unravel_index(i, self.shape)
+        return {name: float(values[j]) for (name, values), j in zip(self.axes, indices)}
+
+    def index(self, **params):
+        """
+        Cell number with the given axis values (all axes must be given).
+        """
+        if set(params) != set(self.names):
+            raise ValueError(f"Need values for exactly the axes {self.names}, got {list(params)}")
+        indices = []
+        for name, values in self.axes:
+            match = np.where(np.isclose(values, params[name], rtol=0, atol=1e-6))[0]
+            if len(match) == 0: raise ValueError(f"{name}={params[name]} is not in the grid")
+            indices.append(match[0])
+        return int(np.ravel_multi_index(indices, self.shape))
+
+    def missing(self):
+        """
+        Cell numbers that are not done.
+        """
+        return np.where(self.status != GRID_STATUS_DONE)[0]
+
+    def job(self, i, **kwargs):
+        """
+        run_synth_lte keyword arguments for cell i.
+        kwargs are the fixed arguments of the grid; element axes are added to its XFedict.
+        """
+        return self.job_for_params(self.params(i), **kwargs)
+
+    def job_for_params(self, params, **kwargs):
+        """
+        run_synth_lte keyword arguments for a dict of axis values, which need not be in the grid.
+        """
+        job = dict(kwargs)
+        job.update(wmin=self.metadata["wmin"], wmax=self.metadata["wmax"], dw=self.metadata["dw"])
+        XFedict = dict(job.get("XFedict") or {})
+        for name, value in params.items():
+            if name in GRID_PARAMETERS:
+                job[name] = value
+            else:
+                XFedict[name] = value
+        if XFedict:
+            job["XFedict"] = XFedict
+        return job
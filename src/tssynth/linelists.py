@@ -0,0 +1,393 @@
+import numpy as np
+import os, re, json, hashlib, threading
+from bisect import bisect_right
+
+TWD_BASE = os.environ.get('TWD_BASE', None)
+
+def build_linelist_catalog(linelist_filename, index_stride=256):
+    """
+    Scan a Turbospectrum line list and describe its species blocks.
+
+    A Turbospectrum line list is a sequence of blocks, each made of
+    - a header line with the species, ionization stage and number of lines,
+      e.g. '   3.000            '    1         8
+    - a comment line, e.g. 'Li I    LTE'
+    - the lines, one per row, starting with the wavelength and sorted by wavelength.
+
+    Parameters:
+    -----------
+    linelist_filename : str
+        Path to the line list.
+    index_stride : int, optional
+        Every index_stride-th line of each block is recorded with its byte offset,
+        so a wavelength range can be found without reading the whole block. Default is 256.
+
+    Returns:
+    --------
+    dict
+        filename, size, mtime_ns and a list of blocks. Each block is a dict with the
+        species, ion, header, comment, nlines, wmin, wmax, the byte range of its lines
+        (start, end) and the sparse index (index_waves, index_offsets).
+    """
+    st = os.stat(linelist_filename)
+    blocks = []
+    block = None
+    expect_comment = False
+    offset = 0
+    with open(linelist_filename, "rb") as fp:
+        for line in fp:
+            if expect_comment:
+                block["comment"] = line.decode("utf-8").rstrip("\n")
+                block["start"] = block["end"] = offset + len(line)
+                expect_comment = False
+            elif line.startswith(b"'"):
+                header = line.decode("utf-8").rstrip("\n")
+                species, rest = header[1:].split("'", 1)
+                block = dict(species=species.strip(), ion=int(rest.split()[0]),
+                             header=header, comment=None, nlines=0,
+                             wmin=None, wmax=None, start=None, end=None,
+                             index_waves=[], index_offsets=[])
+                blocks.append(block)
+                expect_comment = True
+            elif line.strip():
+                wave = float(line.split(None, 1)[0])
+                if block["nlines"] % index_stride == 0:
+                    block["index_waves"].append(wave)
+                    block["index_offsets"].append(offset)
+                if block["wmin"] is None: block["wmin"] = wave
+                block["wmax"] = wave
+                block["nlines"] += 1
+                block["end"] = offset + len(line)
+            offset += len(line)
+    return dict(filename=os.path.realpath(linelist_filename),
+                size=st.st_size, mtime_ns=st.st_mtime_ns, blocks=blocks)
+
+def get_linelist_catalog(linelist_filename, cache_dir=None):
+    """
+    Catalog of a line list (see build_linelist_catalog).
+
+    Catalogs are kept in memory and as JSON files in cache_dir
+    (default: TWD_BASE/linelist_catalogs), and rebuilt when the line list changes.
+    """
+    st = os.stat(linelist_filename)
+    realpath = os.path.realpath(linelist_filename)
+    key = (realpath, st.st_size, st.st_mtime_ns)
+    with _catalog_lock:
+        if key in _catalogs:
+            return _catalogs[key]
+    def is_current(catalog):
+        return (catalog["filename"], catalog["size"], catalog["mtime_ns"]) == key
+
+    if cache_dir is None:
+        cache_dir = os.path.join(TWD_BASE, "linelist_catalogs")
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_fname = os.path.join(cache_dir, hashlib.sha1(realpath.encode("utf-8")).hexdigest() + ".json")
+    catalog = None
+    try:
+        with open(cache_fname, "r") as fp:
+            catalog = json.load(fp)
+        if not is_current(catalog): catalog = None
+    except (FileNotFoundError, ValueError):
+        pass
+    if catalog is None:
+        catalog = build_linelist_catalog(linelist_filename)
+        tmpname = f"{cache_fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmpname, "w") as fp:
+            json.dump(catalog, fp)
+        os.replace(tmpname, cache_fname)
+    with _catalog_lock:
+        _catalogs[key] = catalog
+    return catalog
+_catalogs = {}
+_catalog_lock = threading.Lock()
+
+def get_linelist_wavelength_range(linelist_filename):
+    """
+    Minimum and maximum wavelength of the lines in a Turbospectrum line list file.
+    Returns (None, None) if there are no lines.
+    """
+    waves = [(block["wmin"], block["wmax"]) for block in get_linelist_catalog(linelist_filename)["blocks"]
+             if block["nlines"] > 0]
+    if len(waves) == 0: return None, None
+    return min(w[0] for w in waves), max(w[1] for w in waves)
+
+def linelist_overlaps(linelist_filename, wmin, wmax):
+    """
+    True if the line list has any lines in [wmin, wmax].
+    Hydrogen is always considered to overlap since its wings are very broad.
+    """
+    for block in get_linelist_catalog(linelist_filename)["blocks"]:
+        if block["nlines"] == 0: continue
+        if _is_hydrogen(block): return True
+        if block["wmin"] <= wmax and block["wmax"] >= wmin: return True
+    return False
+
+def trim_linelist(linelist_filename, wmin, wmax, outfname):
+    """
+    Write a copy of a line list with only the lines in [wmin, wmax].
+
+    Blocks with no lines left are dropped and the number of lines in each header is updated.
+    Hydrogen blocks are always copied whole, since the hydrogen line wings extend far beyond the line centers.
+
+    Returns:
+    --------
+    int
+        Number of lines written to outfname.
+    """
+    catalog = get_linelist_catalog(linelist_filename)
+    N_total = 0
+    with open(linelist_filename, "rb") as fin, open(outfname, "wb") as fout:
+        for block in catalog["blocks"]:
+            if block["nlines"] == 0: continue
+            if _is_hydrogen(block) or (block["wmin"] >= wmin and block["wmax"] <= wmax):
+                fin.seek(block["start"])
+                lines = fin.read(block["end"] - block["start"])
+                nlines = block["nlines"]
+            elif block["wmax"] < wmin or block["wmin"] > wmax:
+                continue
+            else:
+                i = max(bisect_right(block["index_waves"], wmin) - 1, 0)
+                fin.seek(block["index_offsets"][i])
+                offset = block["index_offsets"][i]
+                selected = []
+                while offset < block["end"]:
+                    line = fin.readline()
+                    offset += len(line)
+                    if not line.strip(): continue
+                    wave = float(line.split(None, 1)[0])
+                    if wave > wmax: break
+                    if wave >= wmin: selected.append(line)
+                lines = b"".join(selected)
+                nlines = len(selected)
+            if nlines == 0: continue
+            if not lines.endswith(b"\n"): lines += b"\n"
+            fout.write((_header_with_nlines(block["header"], nlines) + "\n").encode("utf-8"))
+            fout.write((block["comment"] + "\n").encode("utf-8"))
+            fout.write(lines)
+            N_total += nlines
+    return N_total
+
+def stage_trimmed_linelists(linelist_filenames, wmin, wmax, twd, margin=10.0):
+    """
+    Write trimmed copies of the line lists into twd, keeping lines within
+    [wmin - margin, wmax + margin] (see trim_linelist).
+
+    Returns:
+    --------
+    list
+        Paths of the trimmed line lists, in the same order. Line lists with no lines
+        in range are left out.
+    """
+    staged = []
+    for i, linelist_filename in enumerate(linelist_filenames):
+        outfname = os.path.join(twd, f"linelist_{i:02d}_{os.path.basename(linelist_filename)}")
+        if trim_linelist(linelist_filename, wmin - margin, wmax + margin, outfname) > 0:
+            staged.append(outfname)
+        else:
+            os.remove(outfname)
+    return staged
+
+def _is_hydrogen(block):
+    try:
+        return int(float(block["species"])) == 1
+    except ValueError:
+        return False
+
+def _header_with_nlines(header, nlines):
+    """
+    Replace the number of lines at the end of a block header, keeping the column alignment.
+    """
+    match = re.match(r"^(.*\D)(\d+)(\s*)$", header)
+    assert match is not None, header
+    prefix, old, trailing = match.groups()
+    return prefix + str(nlines).rjust(len(old)) + trailing
+
+LINELIST_STORE_VERSION = 1
+LINELIST_STORE_DTYPE = [("wave", "f8"), ("chi", "f4"), ("loggf", "f4"), ("offset", "i8"), ("length", "i4")]
+
+def compile_linelist_store(linelist_filenames, output_directory):
+    """
+    Compile Turbospectrum line lists into a binary store that can be memory-mapped by LineListStore.
+
+    Lines are grouped by species block (species, ion and comment line, so that e.g. LTE and NLTE
+    blocks of the same species stay separate), merged across files and sorted by wavelength.
+    Each group is saved as an uncompressed .npy structured array with wave, chi, loggf and the
+    position of the original text of the line in lines.txt, where the lines of each group are
+    stored contiguously in wavelength order. index.json describes the groups and source files.
+
+    Parameters:
+    -----------
+    linelist_filenames : list
+        Paths of the line lists to compile.
+    output_directory : str
+        Directory to write the store into. Created if needed.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    groups = {}
+    sources = []
+    for linelist_filename in linelist_filenames:
+        catalog = get_linelist_catalog(linelist_filename)
+        sources.append(dict(filename=catalog["filename"], size=catalog["size"], mtime_ns=catalog["mtime_ns"]))
+        with open(linelist_filename, "rb") as fp:
+            for block in catalog["blocks"]:
+                if block["nlines"] == 0: continue
+                key = (block["species"], block["ion"], block["comment"])
+                if key not in groups:
+                    groups[key] = dict(header=block["header"], rows=[], lines=[])
+                fp.seek(block["start"])
+                lines = fp.read(block["end"] - block["start"]).splitlines(keepends=True)
+                # Hydrogen line lists have the lower/upper levels before the energies and log gf
+                ichi, iloggf = (3, 5) if _is_hydrogen(block) else (1, 2)
+                for line in lines:
+                    if not line.strip(): continue
+                    if not line.endswith(b"\n"): line += b"\n"
+                    cols = line.split(None, iloggf + 1)
+                    groups[key]["rows"].append((float(cols[0]), float(cols[ichi]), float(cols[iloggf])))
+                    groups[key]["lines"].append(line)
+
+    index = dict(version=LINELIST_STORE_VERSION, sources=sources, groups=[])
+    offset = 0
+    with open(os.path.join(output_directory, "lines.txt"), "wb") as fblob:
+        for igroup, ((species, ion, comment), group) in enumerate(groups.items()):
+            rows = np.array(group["rows"], dtype=float).reshape(-1, 3)
+            order = np.argsort(rows[:, 0], kind="stable")
+            data = np.zeros(len(rows), dtype=LINELIST_STORE_DTYPE)
+            data["wave"] = rows[order, 0]
+            data["chi"] = rows[order, 1]
+            data["loggf"] = rows[order, 2]
+            for i, j in enumerate(order):
+                line = group["lines"][j]
+                data["offset"][i] = offset
+                data["length"][i] = len(line)
+                fblob.write(line)
+                offset += len(line)
+            fname = f"group_{igroup:04d}.npy"
+            np.save(os.path.join(output_directory, fname), data)
+            index["groups"].append(dict(species=species, ion=ion, header=group["header"],
+                                        comment=comment, file=fname, nlines=len(data),
+                                        wmin=float(data["wave"][0]), wmax=float(data["wave"][-1])))
+    with open(os.path.join(output_directory, "index.json"), "w") as fp:
+        json.dump(index, fp, indent=1)
+    return output_directory
+
+class LineListStore:
+    """
+    Memory-mapped line list store written by compile_linelist_store.
+
+    All arrays are opened with mmap, so processes on a node share the page-cached data.
+
+    Example:
+    --------
+    >>> store = LineListStore("/path/to/store")
+    >>> for group, lines in store.query(5000, 5010, species=26, loggf_min=-3):
+    ...     print(group["comment"], len(lines))
+    >>> store.write_turbospectrum("subset.list", 5000, 5010)
+    """
+    def __init__(self, store_directory):
+        self.store_directory = store_directory
+        with open(os.path.join(store_directory, "index.json"), "r") as fp:
+            self.index = json.load(fp)
+        if self.index["version"] != LINELIST_STORE_VERSION:
+            raise ValueError(f"{store_directory} has line list store version {self.index['version']}, "
+                             f"expected {LINELIST_STORE_VERSION}. Please recompile it.")
+        self.groups = self.index["groups"]
+        self._group_wmin = np.array([group["wmin"] for group in self.groups])
+        self._group_wmax = np.array([group["wmax"] for group in self.groups])
+        self._group_ion = np.array([group["ion"] for group in self.groups])
+        self._data = [None] * len(self.groups)
+        self._blob = None
+
+    def data(self, igroup):
+        """
+        Structured array (wave, chi, loggf, offset, length) of one group, sorted by wavelength.
+        """
+        if self._data[igroup] is None:
+            self._data[igroup] = np.load(os.path.join(self.store_directory, self.groups[igroup]["file"]),
+                                         mmap_mode="r")
+        return self._data[igroup]
+
+    @property
+    def blob(self):
+        if self._blob is None:
+            self._blob = np.memmap(os.path.join(self.store_directory, "lines.txt"), dtype=np.uint8, mode="r")
+        return self._blob
+
+    def _match_species(self, group, species):
+        if species is None: return True
+        if not isinstance(species, (list, tuple, set)): species = [species]
+        for sp in species:
+            if isinstance(sp, str):
+                if sp.strip() == group["species"]: return True
+            elif int(float(group["species"])) == sp:
+                return True
+        return False
+
+    def query(self, wmin, wmax, species=None, ion=None, loggf_min=None):
+        """
+        Find lines with wmin <= wave <= wmax.
+
+        Parameters:
+        -----------
+        wmin, wmax : float
+            Wavelength range (A).
+        species : int, str or list, optional
+            Atomic number (or molecule code, e.g. 106 for CH) or the exact species
+            string from the line list header (e.g. "26.000"). Default is all species.
+        ion : int, optional
+            Ionization stage as in the line list header (1 for neutral). Default is all.
+        loggf_min : float, optional
+            Only return lines with log gf >= loggf_min.
+
+        Returns:
+        --------
+        list
+            (group, lines) for each group with matching lines, where group is the
+            entry of index.json and lines is a structured array view into the store.
+        """
+        out = []
+        ii = (self._group_wmax >= wmin) & (self._group_wmin <= wmax)
+        if ion is not None: ii &= self._group_ion == ion
+        for igroup in np.where(ii)[0]:
+            group = self.groups[igroup]
+            if not self._match_species(group, species): continue
+            data = self.data(igroup)
+            i0 = np.searchsorted(data["wave"], wmin, side="left")
+            i1 = np.searchsorted(data["wave"], wmax, side="right")
+            lines = data[i0:i1]
+            if loggf_min is not None:
+                lines = lines[lines["loggf"] >= loggf_min]
+            if len(lines) > 0:
+                out.append((group, lines))
+        return out
+
+    def _text(self, lines):
+        """
+        Original text of the selected lines.
+        """
+        if len(lines) == 0: return b""
+        start, end = lines["offset"][0], lines["offset"][-1] + lines["length"][-1]
+        if end - start == lines["length"].sum():
+            return self.blob[start:end].tobytes()
+        # Not contiguous, gather byte indices of all lines at once
+        lengths = lines["length"].astype(np.int64)
+        starts = np.repeat(lines["offset"] - np.cumsum(lengths) + lengths, lengths)
+        return self.blob[starts + np.arange(lengths.sum())].tobytes()
+
+    def write_turbospectrum(self, outfname, wmin, wmax, species=None, ion=None, loggf_min=None):
+        """
+        Write the lines selected as in query to outfname in Turbospectrum line list format.
+        As in trim_linelist, hydrogen is not cut in wavelength.
+        Returns the number of lines written.
+        """
+        N_total = 0
+        selected = self.query(wmin, wmax, species=species, ion=ion, loggf_min=loggf_min)
+        for igroup, group in enumerate(self.groups):
+            if _is_hydrogen(group) and self._match_species(group, species) and (ion is None or group["ion"] == ion):
+                selected = [x for x in selected if x[0] is not group] + [(group, self.data(igroup))]
+        with open(outfname, "wb") as fout:
+            for group, lines in selected:
+                fout.write((_header_with_nlines(group["header"], len(lines)) + "\n").encode("utf-8"))
+                fout.write((group["comment"] + "\n").encode("utf-8"))
+                fout.write(self._text(lines))
+                N_total += len(lines)
+        return N_total
@@ -1,79 +1,249 @@
 import numpy as np
-import os, re, time, glob
+import os, re, json, time, glob, hashlib, tempfile, functools
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from astropy.table import Table
-from . import utils
+from . import utils, timing
 
-def compress_marcs_standard_models(output_directory):
+MARCS_STORE_VERSION = 1
+_MARCS_STORE_ARRAYS = ["headers", "structures", "abundances", "partial_pressures"]
+
+def compress_marcs_standard_models(output_directory, marcs_path=None, n_workers=None, chunksize=64):
     """
-    Compresses the standard MARCS models into a single file.
-    This is not used right now, but someday I would like to replace
-    the fortran interpolators with python interpolators, and this will
-    be helpful for that.
+    Converts the standard MARCS models into a MarcsGridStore in output_directory,
+    so that they can be used without reading the ~15k .mod files again.
+
+    The store is a set of uncompressed .npy files, which MarcsGridStore memory-maps:
+      headers.npy            (N,) structured array of the parse_marcs_model headers, and the filename
+      structures.npy         (N, 56) structured array of the model structures
+      abundances.npy         (N, 92) logarithmic abundances of elements 1-92
+      partial_pressures.npy  (N, 56) structured array of the logarithmic partial pressures
+      marcs_store.json       version, number of models, where they came from, models that could not be read
+    The models are sorted by filename.
+
+    Parameters:
+    -----------
+    output_directory : str
+        Existing directory to write the store in.
+    marcs_path : str, optional
+        Directory of the MARCS models. Default is ALLMARCS_PATH.
+    n_workers : int, optional
+        Number of processes that read the models. Default is None, which uses os.cpu_count().
+        With 1 the models are read in this process.
+    chunksize : int, optional
+        Number of models sent to a process at a time. Default is 64.
+
+    Returns:
+    --------
+    MarcsGridStore
     """
     N_layer = 56
 
-    ALLMARCS_PATH = os.environ.get("ALLMARCS_PATH")
-    fnames = np.sort(glob.glob(f"{ALLMARCS_PATH}/*_st_*.mod"))
+    if marcs_path is None:
+        marcs_path = os.environ.get("ALLMARCS_PATH")
+    fnames = np.sort(glob.glob(f"{marcs_path}/*_st_*.mod"))
     assert os.path.exists(output_directory), output_directory
-    print(f"Compressing {len(fnames)} Standard MARCS models in {ALLMARCS_PATH} to {os.path.abspath(output_directory)}.")
-    all_headers_spherical = []
-    all_stellarparams_spherical = []
-    all_model_structures_spherical = []
-    all_headers_planeparallel = []
-    all_stellarparams_planeparallel = []
-    all_model_structures_planeparallel = []
+    print(f"Compressing {len(fnames)} Standard MARCS models in {marcs_path} to {os.path.abspath(output_directory)}.")
+    headers, structures, abundances, partial_pressures, failed = [], [], [], [], []
     start = time.time()
-    for i, fname in enumerate(fnames):
-        try:
-            header, model_structure = parse_marcs_model(fname)
-        except Exception as e:
-            print(f"======={i}=======")
-            print("FAILED ON", fname)
-            print(e)
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    executor = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 and len(fnames) > 1 else None
+    try:
+        results = map(_read_store_model, fnames) if executor is None else \
+                  executor.map(_read_store_model, fnames, chunksize=chunksize)
+        for i, (fname, result) in enumerate(zip(fnames, results)):
+            if isinstance(result, str):
+                print(f"======={i}=======")
+                print("FAILED ON", fname)
+                print(result)
+                failed.append(os.path.basename(fname))
+                continue
+            header, model_structure, model_abundances, model_partial_pressures = result
+            headers.append(header)
+            structures.append(model_structure)
+            abundances.append(model_abundances)
+            partial_pressures.append(model_partial_pressures)
+            if i % 1000 == 0 and i > 0:
+                elapsed = time.time() - start
+                print(f"Processed {i} models in {elapsed:.2f} seconds.")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if len(headers) == 0:
+        raise ValueError(f"No MARCS models could be read from {marcs_path}")
+
+    arrays = dict(headers=_headers_to_array(headers),
+                  structures=np.array(structures, dtype=structures[0].dtype),
+                  abundances=np.array(abundances, dtype=float),
+                  partial_pressures=np.array(partial_pressures, dtype=partial_pressures[0].dtype))
+    for name in _MARCS_STORE_ARRAYS:
+        np.save(os.path.join(output_directory, f"{name}.npy"), arrays[name])
+    ## Written last, so a store is only complete once this exists
+    meta = dict(version=MARCS_STORE_VERSION, n_models=len(headers), n_layers=N_layer,
+                source=os.path.abspath(marcs_path), failed=failed)
+    with open(os.path.join(output_directory, "marcs_store.json"), "w") as fp:
+        json.dump(meta, fp, indent=1)
+    return MarcsGridStore(output_directory)
+
+def _read_store_model(fname, N_layer=56):
+    """
+    Everything compress_marcs_standard_models keeps from one model,
+    or the error message if it cannot be read (so that one bad model does not stop a process pool).
+    """
+    try:
+        header, model_structure, model_abundances, partial_pressures_lines = parse_marcs_model(fname, get_all=True)
         assert len(model_structure) == N_layer, len(model_structure)
-        if header["spherical"]:
-            assert os.path.basename(fname).startswith("s"), fname
-            all_headers_spherical.append(list(header.values()))
-            all_stellarparams_spherical.append([header["Teff"], header["logg"], header["feh"]])
-            all_model_structures_spherical.append(model_structure)
+        assert header["spherical"] == os.path.basename(fname).startswith("s"), fname
+        model_partial_pressures = _parse_partial_pressures(partial_pressures_lines, N_layer)
+    except Exception as e:
+        return str(e)
+    header["filename"] = os.path.basename(fname)
+    return header, model_structure, [model_abundances[Z] for Z in range(1, 93)], model_partial_pressures
+
+def _headers_to_array(headers):
+    dtype = []
+    for key, value in headers[0].items():
+        if isinstance(value, str):
+            dtype.append((key, f"U{max(len(header[key]) for header in headers)}"))
+        elif isinstance(value, (bool, np.bool_)):
+            dtype.append((key, bool))
         else:
-            assert os.path.basename(fname).startswith("p"), fname
-            all_headers_planeparallel.append(list(header.values()))
-            all_stellarparams_planeparallel.append([header["Teff"], header["logg"], header["feh"]])
-            all_model_structures_planeparallel.append(model_structure)
-        if i % 1000 == 0 and i > 0:
-            elapsed = time.time() - start
-            print(f"Processed {i} models in {elapsed:.2f} seconds.")
-        # break
-
-    colnames_headers = list(header.keys())
-
-    headers_spherical = Table(rows=all_headers_spherical, names=colnames_headers)
-    stellarparams_spherical = np.array(all_stellarparams_spherical, dtype=float)
-    N_spherical = len(all_model_structures_spherical)
-    model_structures_spherical = np.zeros((N_spherical, N_layer), dtype=all_model_structures_spherical[0].dtype)
-    for i, model_structure in enumerate(all_model_structures_spherical):
-        model_structures_spherical[i] = model_structure
-
-    headers_planeparallel = Table(rows=all_headers_planeparallel, names=colnames_headers)
-    stellarparams_planeparallel = np.array(all_stellarparams_planeparallel, dtype=float)
-    N_planeparallel = len(all_model_structures_planeparallel)
-    model_structures_planeparallel = np.zeros((N_planeparallel, N_layer), dtype=all_model_structures_planeparallel[0].dtype)
-    for i, model_structure in enumerate(all_model_structures_planeparallel):
-        model_structures_planeparallel[i] = model_structure
-
-    np.savez_compressed(
-        os.path.join(output_directory, "marcs_standard_models.npz"),
-        headers_spherical=headers_spherical,
-        model_structures_spherical=model_structures_spherical,
-        stellarparams_spherical=stellarparams_spherical,
-        headers_planeparallel=headers_planeparallel,
-        model_structures_planeparallel=model_structures_planeparallel,
-        stellarparams_planeparallel=stellarparams_planeparallel
-    )
+            dtype.append((key, float))
+    return np.array([tuple(header[key] for key, _ in dtype) for header in headers], dtype=dtype)
+
+def _parse_partial_pressures(partial_pressures_lines, num_depth_points):
+    """
+    Structured array of the 'Assorted logarithmic partial pressures' blocks of a MARCS model
+    (the lines returned by parse_marcs_model with get_all=True).
+    """
+    assert partial_pressures_lines[0].startswith("Assorted logarithmic partial pressures")
+    names, columns = [], []
+    i = 1
+    while i < len(partial_pressures_lines) and partial_pressures_lines[i].split()[:1] == ["k"]:
+        block_names = partial_pressures_lines[i].replace("H I ", "HI ").split()[1:]
+        ## Columns are 7 characters wide, and can touch
+        encoded = [line.encode() for line in partial_pressures_lines[i + 1:i + 1 + num_depth_points]]
+        has_stars = any(b"*" in line for line in encoded)
+        for column in _fixed_width_columns(encoded, 3 + 7*np.arange(len(block_names) + 1)):
+            if has_stars:
+                column = np.char.strip(column)
+                column[np.char.startswith(column, b"***")] = b"nan"
+            columns.append(column.astype(float))
+        names.extend(block_names)
+        i += 1 + num_depth_points
+    partial_pressures = np.zeros(num_depth_points, dtype=[(name, float) for name in names])
+    for name, column in zip(names, columns):
+        partial_pressures[name] = column
+    return partial_pressures
+
+class MarcsGridStore:
+    """
+    The standard MARCS models from compress_marcs_standard_models, memory-mapped.
+
+    Opening a store reads a few small files, and models are looked up by index or by
+    parameters without touching the .mod files.
+
+    Parameters:
+    -----------
+    path : str
+        Directory written by compress_marcs_standard_models.
+    mmap : bool, optional
+        Memory-map the arrays (default: True). Otherwise they are read into memory.
+
+    Attributes:
+    -----------
+    headers, structures, abundances, partial_pressures : ndarray
+        The arrays described in compress_marcs_standard_models.
+
+    Example:
+    --------
+    >>> store = MarcsGridStore("/data/marcs_store")
+    >>> header, model_structure = store.get(5000, 2.0, -2.0, spherical=True)
+    >>> models = interpolate_marcs_models(Teffs, loggs, MHs, store=store)
+    """
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with open(os.path.join(path, "marcs_store.json")) as fp:
+            self.meta = json.load(fp)
+        if self.meta.get("version") != MARCS_STORE_VERSION:
+            raise ValueError(f"{path} has MARCS store version {self.meta.get('version')}, "
+                             f"expected {MARCS_STORE_VERSION}. Rebuild it with compress_marcs_standard_models.")
+        for name in _MARCS_STORE_ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None))
+        headers = self.headers
+        self._index = {key: i for i, key in enumerate(zip(headers["spherical"].tolist(), headers["Teff"].tolist(),
+                                                          headers["logg"].tolist(), headers["feh"].tolist(),
+                                                          headers["vturb"].tolist(), headers["mass"].tolist()))}
+        self._cubes = {}
+
+    def __len__(self):
+        return len(self.headers)
+
+    def index(self, Teff, logg, MH, spherical=True, vturb=2.0, mass=None):
+        """
+        Index of the model with these parameters. The default mass is 1.0 for spherical
+        and 0.0 for plane-parallel models, as used by find_marcs_models.
+        """
+        if mass is None: mass = 1.0 if spherical else 0.0
+        key = (bool(spherical), float(Teff), round(float(logg), 2), round(float(MH), 2), float(vturb), float(mass))
+        try:
+            return self._index[key]
+        except KeyError:
+            raise ValueError(f"No MARCS model with Teff={Teff} logg={logg} MH={MH} spherical={spherical} "
+                             f"vturb={vturb} mass={mass} in {self.path}")
+
+    def header(self, i):
+        return {name: self.headers[name][i].item() for name in self.headers.dtype.names}
+
+    def model(self, i, get_all=False):
+        """
+        header, model_structure of model i, like parse_marcs_model.
+        With get_all, also its abundances ({Z: abundance}) and partial pressures.
+        """
+        header, model_structure = self.header(i), np.array(self.structures[i])
+        if get_all:
+            abundances = {Z: value for Z, value in enumerate(self.abundances[i].tolist(), start=1)}
+            return header, model_structure, abundances, np.array(self.partial_pressures[i])
+        return header, model_structure
+
+    def get(self, Teff, logg, MH, spherical=True, vturb=2.0, mass=None, get_all=False):
+        """
+        header, model_structure of the model with these parameters (see index and model).
+        """
+        return self.model(self.index(Teff, logg, MH, spherical, vturb, mass), get_all=get_all)
+
+    def filename(self, i):
+        return os.path.join(self.meta["source"], self.headers["filename"][i])
+
+    def marcs_points(self, spherical=True, vturb=2.0, mass=None):
+        """
+        (N, 3) array of Teff, logg, MH of the models with this geometry, vturb and mass, and their indices.
+        """
+        if mass is None: mass = 1.0 if spherical else 0.0
+        headers = self.headers
+        indices = np.where((headers["spherical"] == spherical) & (headers["vturb"] == vturb) &
+                           (headers["mass"] == mass))[0]
+        points = np.stack([headers["Teff"][indices], headers["logg"][indices], headers["feh"][indices]], axis=-1)
+        return points, indices
+
+    def find_corners(self, Teff, logg, MH, spherical=True):
+        """
+        Indices of the 8 models to interpolate between, in the order of find_marcs_models.
+        """
+        return self.find_corners_batch([Teff], [logg], [MH], spherical=spherical)[0].tolist()
+
+    def find_corners_batch(self, Teff, logg, MH, spherical=True):
+        """
+        (N, 8) indices of the models to interpolate between for N targets.
+        """
+        for T, g, m in zip(*np.broadcast_arrays(Teff, logg, MH)):
+            _check_marcs_parameters(T, g, m, spherical)
+        if spherical not in self._cubes:
+            self._cubes[spherical] = OccupancyCube(self.marcs_points(spherical)[0])
+        corners = find_surrounding_points_batch(self._cubes[spherical], Teff, logg, MH)
+        return np.array([[self.index(*point, spherical=spherical) for point in points] for points in corners.tolist()],
+                        dtype=int).reshape(-1, 8)
 
-    
 def parse_marcs_model(fname, get_all=False):
     with open(fname, "r") as fp:
         lines = [x[:-1] for x in fp.readlines()] # removes \n
@@ -122,26 +292,10 @@ def parse_marcs_model(fname, get_all=False):
     assert len(cols_2) == 8, cols_2
 
     # Extracting the model structure
-    def getfloat(x):
-        try: return float(x)
-        except Exception as e:
-            if x == "******": return np.nan # this happens sometimes for mu
-            else: raise e
-    def formatted_read_1(line):
-        try:
-            widths = [3, 6, 8, 11, 8, 11, 11, 11, 11]
-            return [getfloat(line[sum(widths[:i]):sum(widths[:i+1])].strip()) for i in range(len(widths))]
-        except Exception as e: # There are a handful of MARCS models that don't follow the right widths
-            return list(map(float, line.split()))
-    def formatted_read_2(line):
-        try:
-            widths = [3, 6, 11, 11, 6, 11, 8, 14]
-            return [getfloat(line[sum(widths[:i]):sum(widths[:i+1])].strip()) for i in range(len(widths))]
-        except Exception as e: # There are a handful of MARCS models that don't follow the right widths
-            return list(map(float, line.split()))
-
-    model_structure_1 = np.array([formatted_read_1(line) for line in lines[cols_1_index + 1:cols_1_index + 1 + num_depth_points]])
-    model_structure_2 = np.array([formatted_read_2(line) for line in lines[cols_2_index + 1:cols_2_index + 1 + num_depth_points]])
+    model_structure_1 = _read_structure_block(lines[cols_1_index + 1:cols_1_index + 1 + num_depth_points],
+                                              _STRUCTURE_WIDTHS_1)
+    model_structure_2 = _read_structure_block(lines[cols_2_index + 1:cols_2_index + 1 + num_depth_points],
+                                              _STRUCTURE_WIDTHS_2)
     
     # Concatenating model_structure_1 and model_structure_2 into a structured array
     dtype = [(name, float) for name in cols_1 + cols_2]
@@ -159,10 +313,58 @@ def parse_marcs_model(fname, get_all=False):
     else:
         return header, model_structure
 
+_STRUCTURE_WIDTHS_1 = [3, 6, 8, 11, 8, 11, 11, 11, 11]
+_STRUCTURE_WIDTHS_2 = [3, 6, 11, 11, 6, 11, 8, 14]
+
+def _read_structure_block(lines, widths):
+    """
+    (N, len(widths)) array of a fixed-width model structure block.
+
+    All the lines are converted at once: they are packed into one byte buffer and each column
+    is cut out of it at its precomputed offset. If that fails (a handful of MARCS models do not
+    follow the widths), the block is read line by line with _read_structure_line.
+    """
+    offsets = np.cumsum([0] + widths)
+    encoded = [line.encode() for line in lines]
+    if max(map(len, encoded)) <= offsets[-1]:
+        has_stars = any(b"*" in line for line in encoded)
+        try:
+            columns = []
+            for column in _fixed_width_columns(encoded, offsets):
+                if has_stars:
+                    column = np.char.strip(column)
+                    column[column == b"******"] = b"nan" # this happens sometimes for mu
+                columns.append(column.astype(float))
+            return np.stack(columns, axis=1)
+        except ValueError:
+            pass
+    return np.array([_read_structure_line(line, widths) for line in lines])
+
+def _fixed_width_columns(encoded_lines, offsets):
+    """
+    Cut the columns [offsets[i], offsets[i+1]) out of a list of byte strings, as arrays of bytes.
+    Lines are padded or truncated to offsets[-1].
+    """
+    width = offsets[-1]
+    buffer = np.array(encoded_lines, dtype=f"S{width}").view("S1").reshape(len(encoded_lines), width)
+    return [np.ascontiguousarray(buffer[:, start:stop]).view(f"S{stop - start}")[:, 0]
+            for start, stop in zip(offsets[:-1], offsets[1:])]
+
+def _read_structure_line(line, widths):
+    def getfloat(x):
+        try: return float(x)
+        except Exception as e:
+            if x == "******": return np.nan # this happens sometimes for mu
+            else: raise e
+    try:
+        return [getfloat(line[sum(widths[:i]):sum(widths[:i+1])].strip()) for i in range(len(widths))]
+    except Exception as e: # There are a handful of MARCS models that don't follow the right widths
+        return list(map(float, line.split()))
+
 def write_marcs_model(header, model_structure):
     raise NotImplementedError("This function is not implemented yet.")
 
-def interpolate_marcs_model(Teff, logg, MH, outpath, spherical=True):
+def interpolate_marcs_model(Teff, logg, MH, outpath, spherical=True, timeout=None, method="fortran", store=None):
     """
     Runs the fortran interpolator (in TSINTERP_PATH) to interpolate the MARCS models.
     Looks in the ALLMARCS_PATH for the MARCS models.
@@ -181,10 +383,19 @@ def interpolate_marcs_model(Teff, logg, MH, outpath, spherical=True):
         If True, use spherical MARCS models. If False, use plane-parallel MARCS models. Default is True.
         logg > 3.5 is not available for spherical models and logg < 3.0 is not available for plane-parallel models.
         We do not automatically specify which one, the user must choose correctly.
+    timeout : float, optional
+        Kill the interpolator if it runs longer than this many seconds. Default is None, no limit.
+    method : str, optional
+        "fortran" to run interpol_modeles, or "python" to use interpolate_marcs_models,
+        the NumPy version of it, which needs no subprocess. Default is "fortran".
+    store : MarcsGridStore or str, optional
+        With method="python", take the MARCS models from this store instead of ALLMARCS_PATH.
     Raises:
     -------
     ValueError
         If the input parameters are out of the valid range for MARCS models.
+    utils.TurbospectrumError
+        If the interpolator fails, times out or does not write outpath.
     Notes:
     ------
     This function calls the Fortran program `interpol_modeles` which is in Turbospectrum_NLTE/interpolator.
@@ -192,10 +403,190 @@ def interpolate_marcs_model(Teff, logg, MH, outpath, spherical=True):
     --------
     >>> interpolate_marcs_model(5777, 4.44, 0.0, "/path/to/output.interpol")
     """
+    if method not in ("fortran", "python"):
+        raise ValueError(f"method must be 'fortran' or 'python', not {method}")
+    if store is not None:
+        if method != "python": raise ValueError("A MarcsGridStore can only be used with method='python'")
+        store = _open_store(store)
+        corners = store.find_corners(Teff, logg, MH, spherical=spherical)
+        models = interpolate_marcs_models([Teff], [logg], [MH], spherical=spherical, store=store)
+        write_interpolated_model(outpath, models[0], logg, spherical, [store.filename(i) for i in corners])
+        return outpath
+
+    selected_files = find_marcs_models(Teff, logg, MH, spherical=spherical)
+    if method == "python":
+        models = interpolate_marcs_models([Teff], [logg], [MH], marcs_model_lists=[selected_files])
+        write_interpolated_model(outpath, models[0], logg, spherical, selected_files)
+        return outpath
+
+    ## Run the fortran interpolator
+    _run_interpolator_lte(Teff, logg, MH, selected_files,
+                          outpath, verbose=False, timeout=timeout)
+    return outpath
+
+@timing.timed_function("marcs_grid_lookup")
+def find_marcs_models(Teff, logg, MH, spherical=True):
+    """
+    Find the 8 MARCS models in ALLMARCS_PATH to interpolate between for interpolate_marcs_model.
+    Returns the list of filenames in the order the interpolator expects.
+    The models are looked up in the MarcsGridIndex of ALLMARCS_PATH (see get_marcs_grid_index).
+    """
+    _check_marcs_parameters(Teff, logg, MH, spherical)
+    index = get_marcs_grid_index()
+    points = _find_surrounding_points(index.occupancy_cube(spherical), Teff, logg, MH)
+    return [index.path(*point, spherical=spherical) for point in points]
+
+def find_marcs_models_batch(Teff, logg, MH, spherical=True):
+    """
+    find_marcs_models for N targets at once. Returns a list of N lists of 8 filenames.
+    """
+    for T, g, m in zip(*np.broadcast_arrays(Teff, logg, MH)):
+        _check_marcs_parameters(T, g, m, spherical)
+    index = get_marcs_grid_index()
+    corners = find_surrounding_points_batch(index.occupancy_cube(spherical), Teff, logg, MH)
+    return [[index.path(*point, spherical=spherical) for point in points] for points in corners.tolist()]
+
+MARCS_INDEX_VERSION = 1
+_MARCS_FILENAME = re.compile(r"^([sp])(\d+)_g([+-]\d+\.\d+)_m(\d+\.?\d*)_t(\d+)_([a-z]+)_z([+-]\d+\.\d+)_.*\.mod$")
+_marcs_grid_indices = {}
+
+class MarcsGridIndex:
+    """
+    Index of the MARCS models in a directory, from their filenames: maps
+    (geometry, Teff, logg, [M/H], microturbulence, mass, composition class) to the file.
+
+    The mass is part of the key because spherical models come in several masses.
+    Use MarcsGridIndex.load (or get_marcs_grid_index) rather than the constructor:
+    the index is cached on disk, so the directory is only listed again when it changes.
+
+    Parameters:
+    -----------
+    marcs_path : str
+        Directory of the MARCS models.
+    entries : list
+        [geometry, Teff, logg, MH, vturb, mass, composition, filename] of each model.
+    mtime_ns : int
+        Modification time of marcs_path when it was listed.
+    model_list_hash : str
+        sha256 of data/model_list.txt when it was listed.
+    """
+    def __init__(self, marcs_path, entries, mtime_ns, model_list_hash):
+        self.marcs_path = marcs_path
+        self.entries = entries
+        self.mtime_ns = mtime_ns
+        self.model_list_hash = model_list_hash
+        self._paths = {tuple(entry[:7]): entry[7] for entry in entries}
+        self._points = {}
+        self._cubes = {}
+
+    @classmethod
+    def build(cls, marcs_path, model_list_hash=None):
+        """
+        List marcs_path and parse the filenames of the models.
+        """
+        marcs_path = os.path.abspath(marcs_path)
+        mtime_ns = os.stat(marcs_path).st_mtime_ns
+        entries = []
+        for fname in sorted(os.listdir(marcs_path)):
+            match = _MARCS_FILENAME.match(fname)
+            if match is None: continue
+            geometry, Teff, logg, mass, vturb, composition, MH = match.groups()
+            entries.append([geometry, int(Teff), float(logg), float(MH), int(vturb), float(mass), composition, fname])
+        if model_list_hash is None:
+            model_list_hash = _model_list_hash()
+        return cls(marcs_path, entries, mtime_ns, model_list_hash)
+
+    @classmethod
+    def load(cls, marcs_path=None, cache_dir=None, model_list=None):
+        """
+        The index of marcs_path (default: ALLMARCS_PATH) from the cache in cache_dir
+        (default: TWD_BASE/marcs_index). It is rebuilt and saved if there is no cached index, or if
+        marcs_path has been modified or data/model_list.txt (or model_list) has changed since.
+        """
+        if marcs_path is None: marcs_path = os.environ.get("ALLMARCS_PATH")
+        if cache_dir is None: cache_dir = os.path.join(os.environ.get("TWD_BASE"), "marcs_index")
+        marcs_path = os.path.abspath(marcs_path)
+        model_list_hash = _model_list_hash(model_list)
+        cache_file = os.path.join(cache_dir, hashlib.sha256(marcs_path.encode()).hexdigest()[:16] + ".json")
+        try:
+            with open(cache_file) as fp:
+                cached = json.load(fp)
+            if cached["version"] == MARCS_INDEX_VERSION and cached["marcs_path"] == marcs_path and \
+               cached["mtime_ns"] == os.stat(marcs_path).st_mtime_ns and cached["model_list_hash"] == model_list_hash:
+                return cls(marcs_path, cached["entries"], cached["mtime_ns"], model_list_hash)
+        except (OSError, ValueError, KeyError):
+            pass
+        index = cls.build(marcs_path, model_list_hash)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmpfile = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmpfile, "w") as fp:
+            json.dump(dict(version=MARCS_INDEX_VERSION, marcs_path=marcs_path, mtime_ns=index.mtime_ns,
+                           model_list_hash=model_list_hash, entries=index.entries), fp)
+        os.replace(tmpfile, cache_file)
+        return index
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_current(self):
+        return os.stat(self.marcs_path).st_mtime_ns == self.mtime_ns
+
+    def path(self, Teff, logg, MH, spherical=True, vturb=2, mass=None, composition="st"):
+        """
+        Path of the model with these parameters. The default mass is 1.0 for spherical
+        and 0.0 for plane-parallel models, as interpolate_marcs_model uses.
+        """
+        if mass is None: mass = 1.0 if spherical else 0.0
+        key = ("s" if spherical else "p", int(round(Teff)), round(float(logg), 2), round(float(MH), 2),
+               int(vturb), float(mass), composition)
+        try:
+            return os.path.join(self.marcs_path, self._paths[key])
+        except KeyError:
+            raise ValueError(f"Could not find a MARCS model with {key} in {self.marcs_path}.")
 
-    ALLMARCS_PATH = os.environ.get("ALLMARCS_PATH")
+    def marcs_points(self, spherical=True, vturb=2, mass=None, composition="st"):
+        """
+        (N, 3) array of Teff, logg, MH of the models with this geometry, microturbulence, mass and composition.
+        """
+        if mass is None: mass = 1.0 if spherical else 0.0
+        key = ("s" if spherical else "p", int(vturb), float(mass), composition)
+        if key not in self._points:
+            self._points[key] = np.array([entry[1:4] for entry in self.entries
+                                          if (entry[0], entry[4], entry[5], entry[6]) == key], dtype=float).reshape(-1, 3)
+        return self._points[key]
+
+    def occupancy_cube(self, spherical=True):
+        """
+        OccupancyCube of marcs_points(spherical), for finding interpolation corners.
+        """
+        if spherical not in self._cubes:
+            self._cubes[spherical] = OccupancyCube(self.marcs_points(spherical))
+        return self._cubes[spherical]
 
-    ## Validate input parameters
+def get_marcs_grid_index(marcs_path=None):
+    """
+    MarcsGridIndex of marcs_path (default: ALLMARCS_PATH), kept in memory for the process.
+    Costs one stat of marcs_path per call, to notice when models are added or removed.
+    """
+    if marcs_path is None: marcs_path = os.environ.get("ALLMARCS_PATH")
+    marcs_path = os.path.abspath(marcs_path)
+    index = _marcs_grid_indices.get(marcs_path)
+    if index is None or not index.is_current():
+        index = _marcs_grid_indices[marcs_path] = MarcsGridIndex.load(marcs_path)
+    return index
+
+def _model_list_hash(model_list=None):
+    if model_list is None:
+        model_list = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "model_list.txt")
+    if not os.path.exists(model_list):
+        return ""
+    with open(model_list, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+def _check_marcs_parameters(Teff, logg, MH, spherical):
+    """
+    Raises ValueError if there are no MARCS models for these parameters.
+    """
     if spherical and logg > 3.5: raise ValueError("No spherical MARCS models for logg > 3.5.")
     if not spherical and logg < 3.0: raise ValueError("No plane-parallel MARCS models for logg < 3.0.")
     if logg > 5.5: raise ValueError("No MARCS models for logg > 5.5.")
@@ -205,50 +596,16 @@ def interpolate_marcs_model(Teff, logg, MH, outpath, spherical=True):
     if Teff > 8000: raise ValueError("No MARCS models for Teff > 8000.")
     if Teff < 2500: raise ValueError("No MARCS models for Teff < 2500.")
 
-    sstr = "s" if spherical else "p"
-    massstr = "1.0" if spherical else "0.0"
-    
-    ## Search through input model atmospheres for models to interpolate
-    fnames = np.sort(glob.glob(f"{ALLMARCS_PATH}/{sstr}*_t02_st_*.mod"))
-    def parse_marcs_filenames(fname):
-        """
-        Parses the MARCS filenames to extract the stellar parameters.
-        """
-        parts = os.path.basename(fname).split("_")
-        Teff = int(parts[0][1:])
-        logg = float(parts[1][1:])
-        MH = float(parts[5][1:])
-        return Teff, logg, MH
-    marcspoints = np.array([parse_marcs_filenames(fname) for fname in fnames])
-    
-    points = _find_surrounding_points(marcspoints, Teff, logg, MH)
-    selected_files = []
-    for point in points:
-        Teff_point, logg_point, MH_point = point
-        fname_start = f"{sstr}{Teff_point:4.0f}_g{logg_point:+4.1f}_m{massstr}_t02_st_z{MH_point:+5.2f}"
-        for fname in fnames:
-            if os.path.basename(fname).startswith(fname_start):
-                selected_files.append(fname)
-                break
-        else:
-            raise ValueError(f"Could not find {fname_start} in {ALLMARCS_PATH}.\n{points}")
-
-    ## Run the fortran interpolator
-    _run_interpolator_lte(Teff, logg, MH, selected_files,
-                          outpath, verbose=False)
-    
-    assert os.path.exists(outpath), f"Interpolator did not create the output file {outpath}."
-    return outpath
-
 def _find_surrounding_points(marcspoints, Teff, logg, MH, max_expansions=5):
     """
     Find the 8 surrounding points for interpolation in a 3D grid.
-    Needs to be a cuboid. Does a recursive search through the grid to find the smallest number of expansions that contains the points.
-    This is slow if it needs to expand many times due to the recursion.
+    Needs to be a cuboid whose 8 corners are all in the grid. Starts from the grid cell containing
+    the target and expands its faces outward (one grid step at a time) over holes in the grid,
+    taking the cuboid that needs the fewest expansions (see find_surrounding_points_batch).
 
     Parameters:
     -----------
-    marcspoints : ndarray
+    marcspoints : ndarray or OccupancyCube
         Array of available grid points with shape (N, 3), where each row is [Teff, logg, MH].
     Teff : float
         Target effective temperature.
@@ -257,7 +614,7 @@ def _find_surrounding_points(marcspoints, Teff, logg, MH, max_expansions=5):
     MH : float
         Target metallicity.
     max_expansions : int, optional
-        Maximum number of expansions to search for surrounding points. Default is 99.
+        Maximum number of expansions to search for surrounding points. Default is 5.
 
     Returns:
     --------
@@ -266,112 +623,136 @@ def _find_surrounding_points(marcspoints, Teff, logg, MH, max_expansions=5):
     
     Raises:
     -------
+    ValueError
+        If the target is outside the grid.
     RuntimeError
-        If 8 surrounding points are not found after the maximum number of expansions (default 3).
-    """
-    unique_Teffs = np.unique(marcspoints[:, 0])
-    unique_loggs = np.unique(marcspoints[:, 1])
-    unique_MHs = np.unique(marcspoints[:, 2])
-
-    ## Check if the target point is within the grid boundaries
-    if Teff < unique_Teffs[0] or Teff > unique_Teffs[-1]:
-        raise ValueError(f"Teff={Teff} is outside the range of available MARCS models: {unique_Teffs[0]} to {unique_Teffs[-1]}.")
-    if logg < unique_loggs[0] or logg > unique_loggs[-1]:
-        raise ValueError(f"logg={logg} is outside the range of available MARCS models: {unique_loggs[0]} to {unique_loggs[-1]}.")
-    if MH < unique_MHs[0] or MH > unique_MHs[-1]:
-        raise ValueError(f"MH={MH} is outside the range of available MARCS models: {unique_MHs[0]} to {unique_MHs[-1]}.")
-
-    def find_bounds(values, target):
-        """Find lower and upper bounds for a target value in sorted values."""
-        lower_idx = np.searchsorted(values, target, side="right") - 1
-        upper_idx = lower_idx + 1
-
-        lower_idx = max(lower_idx, 0)
-        upper_idx = min(upper_idx, len(values) - 1)
-        return lower_idx, upper_idx
-
-    # Initial faces for Teff, logg, and MH
-    Teff_lower_idx, Teff_upper_idx = find_bounds(unique_Teffs, Teff)
-    logg_lower_idx, logg_upper_idx = find_bounds(unique_loggs, logg)
-    MH_lower_idx, MH_upper_idx = find_bounds(unique_MHs, MH)
-    indices = [Teff_lower_idx, Teff_upper_idx, logg_lower_idx, logg_upper_idx, MH_lower_idx, MH_upper_idx]
-
-    ## Check that all the points are valid
-    def check_indices_in_grid(indices):
-        Teff_lower_idx, Teff_upper_idx, logg_lower_idx, logg_upper_idx, MH_lower_idx, MH_upper_idx = indices
-        Teff_lower, Teff_upper = unique_Teffs[Teff_lower_idx], unique_Teffs[Teff_upper_idx]
-        logg_lower, logg_upper = unique_loggs[logg_lower_idx], unique_loggs[logg_upper_idx]
-        MH_lower, MH_upper = unique_MHs[MH_lower_idx], unique_MHs[MH_upper_idx]
-        points = []
-        for T in [Teff_lower, Teff_upper]:
-            for g in [logg_lower, logg_upper]:
-                for m in [MH_lower, MH_upper]:
-                    iiT = marcspoints[:,0] == T
-                    iig = marcspoints[:,1] == g
-                    iiM = marcspoints[:,2] == m
-                    ii = iiT & iig & iiM
-                    if ii.sum() == 1: points.append((T, g, m))
-        return len(points) == 8, np.array(points)
-    valid, points = check_indices_in_grid(indices)
-    if valid: return points
-
-    ## Expand the cuboid until all points are found
-    ## Do it recursively
-    def find_best_cuboid(indices, N_left):
-        # Finish cases: all points in grid or face out of bounds or max exceeded
-        if N_left == 0: return 9999999, indices
-        Teff_lower_idx, Teff_upper_idx, logg_lower_idx, logg_upper_idx, MH_lower_idx, MH_upper_idx = indices
-        if Teff_lower_idx < 0 or Teff_upper_idx >= len(unique_Teffs) or \
-           logg_lower_idx < 0 or logg_upper_idx >= len(unique_loggs) or \
-           MH_lower_idx < 0 or MH_upper_idx >= len(unique_MHs):
-            return 9999999, indices
-        if check_indices_in_grid(indices)[0] == True: return 0, indices
-        
-        # Find the best expansion in all cases from this point
-        N_Teff_lower, indices_Teff_lower = find_best_cuboid([Teff_lower_idx - 1, Teff_upper_idx, logg_lower_idx, logg_upper_idx, MH_lower_idx, MH_upper_idx], N_left-1)
-        N_Teff_upper, indices_Teff_upper = find_best_cuboid([Teff_lower_idx, Teff_upper_idx + 1, logg_lower_idx, logg_upper_idx, MH_lower_idx, MH_upper_idx], N_left-1)
-        N_logg_lower, indices_logg_lower = find_best_cuboid([Teff_lower_idx, Teff_upper_idx, logg_lower_idx - 1, logg_upper_idx, MH_lower_idx, MH_upper_idx], N_left-1)
-        N_logg_upper, indices_logg_upper = find_best_cuboid([Teff_lower_idx, Teff_upper_idx, logg_lower_idx, logg_upper_idx + 1, MH_lower_idx, MH_upper_idx], N_left-1)
-        N_MH_lower, indices_MH_lower = find_best_cuboid([Teff_lower_idx, Teff_upper_idx, logg_lower_idx, logg_upper_idx, MH_lower_idx - 1, MH_upper_idx], N_left-1)
-        N_MH_upper, indices_MH_upper = find_best_cuboid([Teff_lower_idx, Teff_upper_idx, logg_lower_idx, logg_upper_idx, MH_lower_idx, MH_upper_idx + 1], N_left-1)
-
-        # These are sorted in order of preference, as we get the smallest index satisfying Ns==min(Ns)
-        Ns = np.array([N_MH_upper, N_MH_lower, N_Teff_upper, N_Teff_lower, N_logg_upper, N_logg_lower])
-        best_ix = np.where(np.min(Ns)==Ns)[0][0]
-        if best_ix == 0: return N_MH_upper + 1, indices_MH_upper
-        elif best_ix == 1: return N_MH_lower + 1, indices_MH_lower
-        elif best_ix == 2: return N_Teff_upper + 1, indices_Teff_upper
-        elif best_ix == 3: return N_Teff_lower + 1, indices_Teff_lower
-        elif best_ix == 4: return N_logg_upper + 1, indices_logg_upper
-        elif best_ix == 5: return N_logg_lower + 1, indices_logg_lower
-        else: raise RuntimeError("This should not happen.")
-    
-    N_best, indices_best = find_best_cuboid(indices, max_expansions)
-    print(f"Found best cuboid after {N_best} expansions.")
-    if N_best >= 9999999: raise RuntimeError("Failed to find 8 surrounding points for {Teff}, {logg}, {MH}.")
-    
-    ## Triple check
-    valid, points = check_indices_in_grid(indices_best)
-    assert valid, points
-    return points
+        If 8 surrounding points are not found after the maximum number of expansions.
+    """
+    cube = marcspoints if isinstance(marcspoints, OccupancyCube) else OccupancyCube(marcspoints)
+    points, expansions = cube.find([Teff], [logg], [MH], max_expansions=max_expansions)
+    if expansions[0] > 0:
+        print(f"Found best cuboid after {expansions[0]} expansions.")
+    return points[0]
+
+def find_surrounding_points_batch(marcspoints, Teff, logg, MH, max_expansions=5):
+    """
+    _find_surrounding_points for N targets at once.
+    Returns an (N, 8, 3) array of the corners of each target.
+    """
+    cube = marcspoints if isinstance(marcspoints, OccupancyCube) else OccupancyCube(marcspoints)
+    return cube.find(Teff, logg, MH, max_expansions=max_expansions)[0]
+
+class OccupancyCube:
+    """
+    Which points of the 3D grid of unique Teff, logg, MH values have a model, for finding
+    interpolation cuboids without scanning the list of models.
+
+    A cuboid is given by the lower and upper grid index along each axis, and is valid if
+    all 8 corners have exactly one model. The search starts from the cell containing the
+    target (lower = last grid value <= target, upper = the next one) and tries cuboids
+    expanded by up to max_expansions grid steps in total, over all 6 faces.
+    The cuboid with the fewest expansions wins. Ties go to the cuboid with the most
+    expansions of [M/H] upper, then [M/H] lower, Teff upper, Teff lower, logg upper,
+    logg lower, which is the preference of the recursive search this replaces.
 
+    Parameters:
+    -----------
+    marcspoints : ndarray
+        Array of available grid points with shape (N, 3), where each row is [Teff, logg, MH].
+    """
+    def __init__(self, marcspoints):
+        marcspoints = np.asarray(marcspoints, dtype=float)
+        self.axes = [np.unique(marcspoints[:, i]) for i in range(3)]
+        counts = np.zeros([len(axis) for axis in self.axes], dtype=int)
+        np.add.at(counts, tuple(np.searchsorted(axis, marcspoints[:, i]) for i, axis in enumerate(self.axes)), 1)
+        self.occupied = counts == 1
+
+    def find(self, Teff, logg, MH, max_expansions=5, chunk_size=4096):
+        """
+        Corners (N, 8, 3) of the cuboids for N targets, and the number of expansions each needed.
+        """
+        targets = np.stack(np.broadcast_arrays(*(np.atleast_1d(np.asarray(x, dtype=float)) for x in (Teff, logg, MH))),
+                           axis=-1)
+        for i, (name, axis) in enumerate(zip(["Teff", "logg", "MH"], self.axes)):
+            outside = (targets[:, i] < axis[0]) | (targets[:, i] > axis[-1])
+            if np.any(outside):
+                raise ValueError(f"{name}={targets[outside, i][0]} is outside the range of available MARCS models: "
+                                 f"{axis[0]} to {axis[-1]}.")
+        ## Starting cell, as (Teff lower, Teff upper, logg lower, logg upper, MH lower, MH upper) indices
+        start = np.zeros((len(targets), 6), dtype=int)
+        for i, axis in enumerate(self.axes):
+            lower = np.searchsorted(axis, targets[:, i], side="right") - 1
+            start[:, 2*i] = np.maximum(lower, 0)
+            start[:, 2*i + 1] = np.minimum(lower + 1, len(axis) - 1)
+
+        expansions, steps = _cuboid_expansions(max_expansions)
+        shape = np.array(self.occupied.shape)
+        corners = np.zeros((len(targets), 8, 3))
+        n_expansions = np.zeros(len(targets), dtype=int)
+        for chunk in range(0, len(targets), chunk_size):
+            cuboids = start[chunk:chunk + chunk_size, None, :] + steps[None, :, :] # (n, Ncandidate, 6)
+            valid = np.all((cuboids >= 0) & (cuboids < np.repeat(shape, 2)), axis=-1)
+            cuboids = np.minimum(np.maximum(cuboids, 0), np.repeat(shape, 2) - 1)
+            for iT in (0, 1):
+                for ig in (2, 3):
+                    for im in (4, 5):
+                        valid &= self.occupied[cuboids[..., iT], cuboids[..., ig], cuboids[..., im]]
+            best = np.argmax(valid, axis=1)
+            found = valid[np.arange(len(best)), best]
+            if not np.all(found):
+                Teff, logg, MH = targets[chunk + np.argmin(found)]
+                raise RuntimeError(f"Failed to find 8 surrounding points for {Teff}, {logg}, {MH}.")
+            best_cuboids = cuboids[np.arange(len(best)), best]
+            n_expansions[chunk:chunk + chunk_size] = expansions[best]
+            icorner = 0
+            for iT in (0, 1):
+                for ig in (2, 3):
+                    for im in (4, 5):
+                        corners[chunk:chunk + chunk_size, icorner] = np.stack([
+                            self.axes[0][best_cuboids[:, iT]], self.axes[1][best_cuboids[:, ig]],
+                            self.axes[2][best_cuboids[:, im]]], axis=-1)
+                        icorner += 1
+        return corners, n_expansions
+
+@functools.lru_cache(maxsize=None)
+def _cuboid_expansions(max_expansions):
+    """
+    All ways of expanding the 6 faces of a cuboid by up to max_expansions grid steps in total,
+    in the order they should be tried (see OccupancyCube).
+    Returns the number of expansions and the index offsets (Teff lower, Teff upper, logg lower,
+    logg upper, MH lower, MH upper) of each.
+    """
+    counts = np.array([c for c in np.ndindex(*(6*[max_expansions + 1])) if sum(c) <= max_expansions], dtype=int)
+    Tl, Tu, gl, gu, ml, mu = counts.T
+    order = np.lexsort((-gl, -gu, -Tl, -Tu, -ml, -mu, counts.sum(axis=1)))
+    counts = counts[order]
+    return counts.sum(axis=1), counts*np.array([-1, 1, -1, 1, -1, 1])
+
+@timing.timed_function("marcs_interpolator")
 def _run_interpolator_lte(Teff, logg, MH, marcs_model_list,
-                        outpath, verbose=False):
+                        outpath, verbose=False, timeout=None):
     """
     Runs the Fortran interpolator to interpolate the MARCS models.
     Based on https://github.com/TSFitPy-developers/TSFitPy/blob/main/scripts/turbospectrum_class_nlte.py
             _interpolate_one_atmosphere
+    Raises utils.TurbospectrumError if it fails, runs longer than timeout (s) or does not write outpath.
     """
     interp_exec_path = os.environ.get("TSINTERP_PATH")
-    
-    if verbose:
-        stdout = None
-        stderr = subprocess.STDOUT
-    else:
-        stdout = open('/dev/null', 'w')
-        stderr = subprocess.STDOUT
-    
-    # Write configuration input for interpolator
+    # It runs in a scratch directory, since it also writes modele.sm into its working directory
+    outpath = os.path.abspath(outpath)
+    marcs_model_list = [os.path.abspath(marcs_model) for marcs_model in marcs_model_list]
+    interpol_config = _interpolator_config_lte(Teff, logg, MH, marcs_model_list, outpath)
+
+    # Now we run the FORTRAN model interpolator
+    with tempfile.TemporaryDirectory() as cwd:
+        utils.run_executable(os.path.join(interp_exec_path, 'interpol_modeles'), interpol_config,
+                             cwd=cwd, timeout=timeout, verbose=verbose, outputs=[outpath])
+    return outpath
+
+def _interpolator_config_lte(Teff, logg, MH, marcs_model_list, outpath):
+    """
+    Configuration (stdin) for the Fortran interpolator interpol_modeles.
+    """
     interpol_config = ""
     for marcs_model in marcs_model_list:
         assert os.path.exists(marcs_model), marcs_model
@@ -384,19 +765,165 @@ def _run_interpolator_lte(Teff, logg, MH, marcs_model_list,
     interpol_config += ".false.\n"  
     interpol_config += ".false.\n"  
     interpol_config += "'/dev/null'\n" # .test output file, not needed
+    return interpol_config
 
-    # Now we run the FORTRAN model interpolator
+## Quantities interpolated by interpol_modeles, in its order (taus, tauR, T, Pe, Pg, xit, rr, xkapref)
+INTERPOLATED_QUANTITIES = ["lgTau5", "lgTauR", "T", "lgPe", "lgPg", "vturb", "rr", "lgKappaRoss"]
+
+def interpolate_marcs_models(Teff, logg, MH, spherical=True, marcs_model_lists=None, store=None):
+    """
+    NumPy version of the Fortran interpolator interpol_modeles, for many stars at once.
+
+    Uses the same scheme: the 8 corner models are interpolated depth point by depth point
+    (they are not resampled, the Fortran has that commented out), each quantity with
+    the empirical exponents of interpol_modeles in Teff, logg and [M/H].
+    The results agree with interpol_modeles to the precision of its output.
+
+    Parameters:
+    -----------
+    Teff, logg, MH : array_like
+        Stellar parameters of the N stars.
+    spherical : bool, optional
+        Use spherical or plane-parallel MARCS models, as in interpolate_marcs_model. Default is True.
+    marcs_model_lists : list of lists, optional
+        The 8 MARCS models to interpolate for each star, in the order of find_marcs_models.
+        Default is None, which finds them with find_marcs_models.
+    store : MarcsGridStore or str, optional
+        Find the 8 MARCS models and read them from this store instead (if marcs_model_lists is None).
+
+    Returns:
+    --------
+    ndarray
+        Structured array of shape (N, ndepth) with fields INTERPOLATED_QUANTITIES.
+        lgPe, lgPg and lgKappaRoss are log10 of Pe, Pg and KappaRoss, rr is the radius minus the depth.
+
+    Example:
+    --------
+    >>> models = interpolate_marcs_models(np.linspace(4500, 5000, 1000), 2.0, -2.0)
+    >>> write_interpolated_model("star0.interpol", models[0], 2.0, True, find_marcs_models(4500, 2.0, -2.0))
+    """
+    Teff, logg, MH = np.broadcast_arrays(*(np.atleast_1d(np.asarray(x, dtype=float)) for x in (Teff, logg, MH)))
+    if marcs_model_lists is None and store is not None:
+        store = _open_store(store)
+        corners = store.find_corners_batch(Teff, logg, MH, spherical=spherical)
+        headers = store.headers[corners]
+        corner_params = np.stack([headers["Teff"], headers["logg"], headers["feh"]], axis=-1)
+        corner_structures = _interpolation_quantities(store.structures[corners], headers["vturb"], headers["radius"])
+        return _to_interpolated_models(_interpolate_structures(corner_params, corner_structures, Teff, logg, MH))
+    if marcs_model_lists is None:
+        marcs_model_lists = find_marcs_models_batch(Teff, logg, MH, spherical=spherical)
+    if len(marcs_model_lists) != len(Teff):
+        raise ValueError(f"Got {len(marcs_model_lists)} lists of MARCS models for {len(Teff)} stars.")
+
+    corner_params, corner_structures = [], []
+    for marcs_model_list in marcs_model_lists:
+        if len(marcs_model_list) != 8:
+            raise ValueError(f"Need 8 MARCS models to interpolate, got {len(marcs_model_list)}")
+        corners = [_read_interpolation_model(os.path.abspath(fname)) for fname in marcs_model_list]
+        if len(set(corner[1] for corner in corners)) > 1:
+            raise ValueError(f"MARCS models do not all have the same geometry: {marcs_model_list}")
+        corner_params.append([corner[0] for corner in corners])
+        corner_structures.append([corner[2] for corner in corners])
     try:
-        p = subprocess.Popen([os.path.join(interp_exec_path, 'interpol_modeles')],
-                            stdin=subprocess.PIPE, stdout=stdout, stderr=stderr)
-        p.stdin.write(bytes(interpol_config, 'utf-8'))
-        stdout, stderr = p.communicate()
-    except subprocess.CalledProcessError as e:
-        print(e)
-        raise RuntimeError("MARCS model atmosphere interpolation failed. Config:\n"+interpol_config)
+        corner_structures = np.array(corner_structures, dtype=float) # (N, 8, Nquantity, ndepth)
+    except ValueError:
+        raise ValueError("MARCS models do not all have the same number of depth points.")
+
+    return _to_interpolated_models(_interpolate_structures(np.array(corner_params, dtype=float), corner_structures,
+                                                           Teff, logg, MH))
+
+def _to_interpolated_models(structures):
+    models = np.zeros(structures.shape[::2], dtype=[(name, float) for name in INTERPOLATED_QUANTITIES])
+    for i, name in enumerate(INTERPOLATED_QUANTITIES):
+        models[name] = structures[:, i]
+    return models
+
+def _interpolate_structures(corner_params, corner_structures, Teff, logg, MH):
+    """
+    The interpolation of interpol_modeles, vectorized over stars.
+    corner_params (N, 8, 3) are Teff, logg, MH of the corners, corner_structures (N, 8, Nquantity, ndepth).
+    Returns (N, Nquantity, ndepth).
+    """
+    target = np.stack([Teff, logg, MH], axis=-1)
+    lower, upper = corner_params.min(axis=1), corner_params.max(axis=1)
+    span = upper - lower
+    ## Position of the target in the cuboid, 0 along an axis where all corners are the same
+    point = np.where(span == 0, 0.0, (target - lower)/np.where(span == 0, 1.0, span))
+    if np.any((point < 0) | (point > 1)):
+        print("WARNING: extrapolating MARCS models")
+
+    ## Empirical constants of the "optimized" interpolation (lin_dif), scaled to the size of the cuboid
+    lin_dif = np.zeros((len(target), len(INTERPOLATED_QUANTITIES), 3))
+    lin_dif[:, 2] = [0.15, 0.3, 0]       # T
+    lin_dif[:, 3] = [0.15, 0.06, 0]      # log Pe
+    lin_dif[:, 4] = [-0.4, 0.06, 0]      # log Pg
+    lin_dif[:, 7] = [-0.15, -0.12, 0]    # log KappaRoss
+    lin_dif[:, 2, 2] = 1 - (Teff/4000)**2.0
+    lin_dif[:, 3, 2] = 1 - (Teff/3500)**2.5
+    lin_dif[:, 4, 2] = 1 - (Teff/4100)**4
+    lin_dif[:, 7, 2] = 1 - (Teff/3700)**3.5
+    power = 1 - lin_dif*(np.abs(span)/[7000 - 3800, 5 - 0.0, 0 - (-4)])[:, None, :]
+    with np.errstate(invalid="ignore"):
+        r, s, t = np.moveaxis(point[:, None, :]**power, -1, 0) # each (N, Nquantity)
+
+    ## Trilinear weights of the corners (blend_103), corners ordered Teff, logg, MH from lower to upper
+    weights = np.zeros(corner_structures.shape[:3])
+    for icorner in range(8):
+        iT, ig, im = (icorner >> 2) & 1, (icorner >> 1) & 1, icorner & 1
+        weights[:, icorner] = (r if iT else 1 - r)*(s if ig else 1 - s)*(t if im else 1 - t)
+    return np.einsum("ncq,ncqd->nqd", weights, corner_structures)
+
+@functools.lru_cache(maxsize=4096)
+def _read_interpolation_model(fname):
+    """
+    (Teff, logg, MH), spherical, and the INTERPOLATED_QUANTITIES of a MARCS model, as interpol_modeles reads them.
+    Cached, since the same corner models come up again and again when interpolating many stars.
+    """
+    header, model_structure = parse_marcs_model(fname)
+    ## interpol_modeles uses log10 of the surface gravity unrounded
+    with open(fname) as fp:
+        for i in range(4): line = fp.readline()
+    logg = np.log10(float(line.split()[0]))
+    structure = _interpolation_quantities(model_structure, header["vturb"], header["radius"])
+    structure.flags.writeable = False
+    return (header["Teff"], logg, header["feh"]), os.path.basename(fname).startswith("s"), structure
+
+def _interpolation_quantities(model_structures, vturb, radius):
+    """
+    INTERPOLATED_QUANTITIES, shape (..., Nquantity, ndepth), from model structures (..., ndepth)
+    and the microturbulence and radius of the models (...). rr = radius - depth for both geometries.
+    """
+    vturb, radius = np.asarray(vturb, dtype=float)[..., None], np.asarray(radius, dtype=float)[..., None]
+    return np.stack([model_structures["lgTau5"], model_structures["lgTauR"], model_structures["T"],
+                     np.log10(model_structures["Pe"]), np.log10(model_structures["Pg"]),
+                     np.broadcast_to(vturb, model_structures.shape), radius - model_structures["Depth"],
+                     np.log10(model_structures["KappaRoss"])], axis=-2)
+
+def _open_store(store):
+    return store if isinstance(store, MarcsGridStore) else MarcsGridStore(store)
 
+def write_interpolated_model(outpath, model, logg, spherical, marcs_model_list):
+    """
+    Write one model from interpolate_marcs_models in the format interpol_modeles writes (which babsma_lu reads).
+    """
+    name = "sphINTERPOL" if spherical else "ppINTERPOL"
+    with open(outpath, "w") as fp:
+        fp.write(f"'{name}' {len(model):3d}{5000:7d}.  {logg:4.2f} 0 0.00\n")
+        for row in model:
+            fp.write(f"{row['lgTau5']:8.4f} {row['T']:8.2f} {row['lgPe']:8.4f} {row['lgPg']:8.4f} "
+                     f"{row['vturb']:8.4f} {_fortran_exponential(row['rr']):>15s} {row['lgTauR']:8.4f}\n")
+        for fname in marcs_model_list:
+            fp.write(f"{fname:250s}\n")
     return outpath
 
+def _fortran_exponential(x, digits=6):
+    """
+    x in Fortran Ew.d format, e.g. 0.684938E+12
+    """
+    mantissa, exponent = f"{x:.{digits-1}E}".split("E")
+    sign = "-" if mantissa.startswith("-") else ""
+    return f"{sign}0.{mantissa.lstrip('-').replace('.', '')}E{int(exponent)+1:+03d}"
+
 def _run_interpolator_nlte(Teff, logg, MH, marcs_model_list):
     """
     Runs the Fortran interpolator for both the MARCS model atmospheres
@@ -0,0 +1,252 @@
+"""
+Staged pipeline for running many syntheses.
+
+run_synth_lte does its stages one after the other: model atmosphere interpolation,
+babsma_lu, bsyn_lu and reading the output. SynthesisPipeline gives every stage its own
+worker threads and a bounded queue in front of it, so e.g. babsma_lu for the next job
+runs while bsyn_lu is still busy with the previous one.
+"""
+import os, time, shutil, queue, threading, traceback, inspect
+from . import utils, marcs, timing
+from .synthesizer import (run_synth_lte, run_babsma_lu, run_bsyn_lu, read_bsyn_output,
+                          _resolve_model_atmosphere, _setup_twd, _babsma_lu_kwargs, _bsyn_lu_kwargs,
+                          _copy_modelopac_file, _check_spectrum_cache)
+
+PIPELINE_STAGES = ("atmosphere", "babsma", "bsyn", "read")
+
+def run_synth_lte_pipeline(jobs, n_workers=None, queue_size=None, delete_twd=True, twd_pool=None):
+    """
+    Run many LTE syntheses with a SynthesisPipeline.
+    Takes the same jobs and returns the same list as synthesizer.run_synth_lte_batch.
+    Use SynthesisPipeline directly to look at how busy each stage was.
+    """
+    pipeline = SynthesisPipeline(n_workers=n_workers, queue_size=queue_size,
+                                 delete_twd=delete_twd, twd_pool=twd_pool)
+    return pipeline.run(jobs)
+
+class SynthesisPipeline:
+    """
+    Run run_synth_lte jobs as a pipeline of stages with separate worker pools.
+
+    The stages are (see PIPELINE_STAGES):
+      atmosphere: interpolate the model atmosphere (if needed) and set up the twd
+      babsma: run babsma_lu (or copy modelopac_file)
+      bsyn: run bsyn_lu
+      read: read bsyn.out and clean up the twd
+    Each stage has its own worker threads and a bounded queue of jobs waiting for it,
+    so a slow stage holds back the ones before it instead of piling up finished work.
+
+    After run(), stats has for every stage the number of workers, jobs and failures, the
+    time spent working (busy) and waiting for room in the next queue (blocked), and the
+    utilization busy/(workers*wall). A stage with high utilization needs more workers;
+    a stage that is often blocked is waiting on the stage after it.
+
+    Parameters:
+    -----------
+    n_workers : int or dict, optional
+        Worker threads for each stage. An int is used for every stage; a dict maps stage names
+        to numbers and falls back to the defaults for the others. Default is os.cpu_count()
+        for bsyn, half of that for babsma, a quarter for atmosphere and 1 for read.
+    queue_size : int, optional
+        Maximum number of jobs waiting in front of each stage. Default is twice the number of
+        workers of that stage.
+    delete_twd : bool, optional
+        Delete the working directory of each job that succeeds. Default is True.
+        The directory of a failed job is always kept so it can be inspected.
+    twd_pool : workdir.WorkdirPool, optional
+        Lease working directories from this pool instead of creating one for every job.
+
+    Example:
+    --------
+    >>> pipeline = SynthesisPipeline(n_workers={"bsyn": 8})
+    >>> results = pipeline.run([dict(wmin=5000, wmax=5100, dw=0.01, Teff=T, logg=2.0, MH=-2.0)
+    ...                         for T in range(4500, 5500, 50)])
+    >>> print(pipeline.report())
+    """
+    def __init__(self, n_workers=None, queue_size=None, delete_twd=True, twd_pool=None):
+        ncpu = os.cpu_count() or 1
+        self.n_workers = dict(atmosphere=max(1, ncpu//4), babsma=max(1, ncpu//2), bsyn=ncpu, read=1)
+        if isinstance(n_workers, dict):
+            unknown = set(n_workers) - set(PIPELINE_STAGES)
+            if unknown: raise ValueError(f"Unknown pipeline stages {unknown}, must be in {PIPELINE_STAGES}")
+            self.n_workers.update(n_workers)
+        elif n_workers is not None:
+            self.n_workers = {stage: n_workers for stage in PIPELINE_STAGES}
+        for stage, n in self.n_workers.items():
+            if n < 1: raise ValueError(f"Need at least one worker for stage {stage}, got {n}")
+        self.queue_size = queue_size
+        self.delete_twd = delete_twd
+        self.twd_pool = twd_pool
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def run(self, jobs):
+        """
+        Run the jobs through the pipeline.
+
+        Parameters:
+        -----------
+        jobs : iterable of dict
+            Keyword arguments for run_synth_lte, one dict per job.
+
+        Returns:
+        --------
+        list
+            One entry per job, in the same order as jobs: (wave, norm, flux) if the job
+            succeeded, or the exception it raised.
+        """
+        signature = inspect.signature(run_synth_lte)
+        self._results = {}
+        states = []
+        for i, job in enumerate(jobs):
+            try:
+                params = signature.bind(**job)
+            except TypeError as e:
+                self._results[i] = e
+                continue
+            params.apply_defaults()
+            states.append(dict(index=i, params=params.arguments))
+        njobs = len(self._results) + len(states)
+
+        self.stats = {stage: dict(workers=self.n_workers[stage], jobs=0, failed=0, busy=0.0, blocked=0.0)
+                      for stage in PIPELINE_STAGES}
+        queues = []
+        for stage in PIPELINE_STAGES:
+            maxsize = self.queue_size if self.queue_size is not None else 2*self.n_workers[stage]
+            queues.append(queue.Queue(maxsize=maxsize))
+        queues.append(None)
+        start = time.perf_counter()
+        threads = []
+        for istage, stage in enumerate(PIPELINE_STAGES):
+            threads.append([threading.Thread(target=self._worker, args=(stage, queues[istage], queues[istage+1]),
+                                             name=f"tssynth-{stage}-{i}", daemon=True)
+                            for i in range(self.n_workers[stage])])
+            for thread in threads[-1]: thread.start()
+
+        for state in states:
+            queues[0].put(state)
+        # Shut down stage by stage: the stop signals queue up behind the last job
+        for istage, stage in enumerate(PIPELINE_STAGES):
+            for thread in threads[istage]: queues[istage].put(None)
+            for thread in threads[istage]: thread.join()
+
+        wall = time.perf_counter() - start
+        for stage, stats in self.stats.items():
+            stats["utilization"] = stats["busy"]/(stats["workers"]*wall) if wall > 0 else 0.0
+        self.stats["wall"] = wall
+        return [self._results[i] for i in range(njobs)]
+
+    def report(self):
+        """
+        Table of the stats of the last run.
+        """
+        lines = [f"{'stage':<12}{'workers':>8}{'jobs':>6}{'failed':>7}{'busy(s)':>10}{'blocked(s)':>12}{'util':>7}"]
+        for stage in PIPELINE_STAGES:
+            if stage not in self.stats: continue
+            s = self.stats[stage]
+            lines.append(f"{stage:<12}{s['workers']:>8d}{s['jobs']:>6d}{s['failed']:>7d}"
+                         f"{s['busy']:>10.2f}{s['blocked']:>12.2f}{s['utilization']:>7.0%}")
+        if "wall" in self.stats:
+            lines.append(f"wall time {self.stats['wall']:.2f}s")
+        return "\n".join(lines)
+
+    def _worker(self, stage, inqueue, outqueue):
+        run_stage = getattr(self, f"_stage_{stage}")
+        while True:
+            state = inqueue.get()
+            if state is None: return
+            start = time.perf_counter()
+            try:
+                with timing.job_context(**{name: state["params"][name] for name in timing.JOB_PARAMS}):
+                    run_stage(state)
+            except Exception as e:
+                busy = time.perf_counter() - start
+                with self._lock:
+                    self.stats[stage]["busy"] += busy
+                    self.stats[stage]["jobs"] += 1
+                    self.stats[stage]["failed"] += 1
+                self._fail(state, e)
+                continue
+            busy = time.perf_counter() - start
+            if outqueue is not None:
+                outqueue.put(state)
+            blocked = time.perf_counter() - start - busy
+            with self._lock:
+                self.stats[stage]["busy"] += busy
+                self.stats[stage]["blocked"] += blocked
+                self.stats[stage]["jobs"] += 1
+
+    def _fail(self, state, e):
+        # Recorded first, so the job has a result even if cleaning up fails
+        self._results[state["index"]] = e
+        twd = state.get("twd")
+        print(f"Job {state['index']} failed")
+        traceback.print_exception(type(e), e, e.__traceback__)
+        if state.get("leased"):
+            try:
+                twd = self.twd_pool.release(twd, keep=True)
+            except Exception:
+                print(f"Could not release twd {twd}")
+                traceback.print_exc()
+        print(f"Job {state['index']} failed, keeping twd {twd}")
+
+    def _stage_atmosphere(self, state):
+        p = state["params"]
+        spectrum_cache, spectrum_key, cached = _check_spectrum_cache(
+            p["spectrum_cache"], p["wmin"], p["wmax"], p["dw"], p["Teff"], p["logg"], p["vt"], p["MH"], p["aFe"],
+            p["model_atmosphere_file"], p["linelist_filenames"], p["trim_linelists"], p["linelist_margin"],
+            p["XFedict"], p["modelopac_file"], p["spherical"])
+        state["spectrum_cache"], state["spectrum_key"] = spectrum_cache, spectrum_key
+        if cached is not None:
+            ## Nothing to do in the other stages
+            state["cached"] = cached
+            return
+        twd = p["twd"]
+        state["leased"] = twd is None and self.twd_pool is not None
+        state["created"] = twd is None
+        if state["leased"]:
+            twd = self.twd_pool.acquire()
+        elif twd is None:
+            twd = utils.mkdtemp()
+        state["twd"] = twd
+        atmosphere = _resolve_model_atmosphere(twd, p["Teff"], p["logg"], p["vt"], p["MH"], p["aFe"],
+                                               p["model_atmosphere_file"], p["spherical"])
+        if atmosphere["interpolate"]:
+            marcs.interpolate_marcs_model(atmosphere["Teff"], atmosphere["logg"], atmosphere["MH"],
+                                          atmosphere["modelfilename"], spherical=atmosphere["spherical"],
+                                          timeout=utils.get_stage_timeout(p["stage_timeout"], "interpol_modeles"))
+        linelist_filenames, indiv_abu = _setup_twd(twd, p["wmin"], p["wmax"], p["linelist_filenames"],
+                                                   p["trim_linelists"], p["linelist_margin"], p["XFedict"])
+        state["linelist_filenames"] = linelist_filenames
+        state["kws_babsma_lu"] = _babsma_lu_kwargs(twd, p["wmin"], p["wmax"], p["dw"], atmosphere,
+                                                   indiv_abu, p["verbose"])
+
+    def _stage_babsma(self, state):
+        if "cached" in state: return
+        p = state["params"]
+        if p["modelopac_file"] is None:
+            state["modelopac_file"] = run_babsma_lu(**state["kws_babsma_lu"], mopac_cache=p["mopac_cache"],
+                                                    timeout=utils.get_stage_timeout(p["stage_timeout"], "babsma_lu"))
+        else:
+            state["modelopac_file"] = _copy_modelopac_file(p["modelopac_file"], state["twd"])
+
+    def _stage_bsyn(self, state):
+        if "cached" in state: return
+        kws_bsyn_lu = _bsyn_lu_kwargs(state["kws_babsma_lu"], state["modelopac_file"], state["linelist_filenames"])
+        state["outfilename"] = run_bsyn_lu(**kws_bsyn_lu,
+                                           timeout=utils.get_stage_timeout(state["params"]["stage_timeout"], "bsyn_lu"))
+
+    def _stage_read(self, state):
+        if "cached" in state:
+            self._results[state["index"]] = state["cached"]
+            return
+        p = state["params"]
+        result = read_bsyn_output(state["outfilename"], wmin=p["wmin"], wmax=p["wmax"], dw=p["dw"])
+        if state["spectrum_cache"] is not None:
+            state["spectrum_cache"].put(state["spectrum_key"], result)
+        twd = state["twd"]
+        if state["leased"]:
+            self.twd_pool.release(twd)
+        elif p["delete_twd"] or (state["created"] and self.delete_twd):
+            shutil.rmtree(twd, ignore_errors=True)
+        self._results[state["index"]] = result
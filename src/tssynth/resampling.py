@@ -0,0 +1,131 @@
+"""
+Flux-conserving resampling of synthesized spectra onto observed wavelength grids.
+
+Each target pixel is a wavelength bin, and its value is the average of the spectrum
+over the bin: the sum of the source pixels weighted by how much of their bin overlaps it.
+The overlaps are computed once per (source grid, target grid, radial velocity) and kept
+as a sparse matrix, which is then applied to whole batches of spectra.
+"""
+import numpy as np
+from .utils import SPEED_OF_LIGHT
+
+def resample(wave, flux, target_wave, rv=0.0, gap_factor=1.5):
+    """
+    Resample spectra onto one or several target wavelength grids.
+
+    Parameters:
+    wave (array): Wavelengths (A) of the spectra, increasing (e.g. from run_synth_lte)
+    flux (array): Spectrum (npix,) or batch of spectra (N, npix) on wave
+    target_wave (array or list of arrays): Target wavelengths (A), increasing, e.g. one echelle order.
+        A list gives a list of results, e.g. one per order.
+    rv (float or array): Radial velocity (km/s) to shift the spectra by before resampling (default: 0).
+        An array gives one radial velocity per spectrum in the batch.
+    gap_factor (float): A step between target pixels more than gap_factor times the step next to it
+        is a gap: the pixels on either side of it get bins as wide as their other neighbours (default: 1.5)
+
+    Returns:
+    array or list of arrays: Resampled spectra, (n_target,) or (N, n_target) for each target grid.
+        Target pixels not completely covered by wave are NaN.
+
+    Example:
+    >>> wave, norm, flux = run_synth_lte(5000, 5100, 0.01, Teff=5000, logg=2.0, MH=-2.0)
+    >>> norm_order = resample(wave, norm, order_wave, rv=-45.3)
+    """
+    if isinstance(target_wave, (list, tuple)):
+        return [resample(wave, flux, target, rv=rv, gap_factor=gap_factor) for target in target_wave]
+    flux = np.asarray(flux, dtype=float)
+    if np.ndim(rv) == 0:
+        return FluxRebinner(wave, target_wave, rv=rv, gap_factor=gap_factor)(flux)
+    rv = np.asarray(rv, dtype=float)
+    if flux.ndim != 2 or len(rv) != len(flux):
+        raise ValueError(f"Need one rv per spectrum, got {len(rv)} rv for flux of shape {flux.shape}")
+    out = np.empty((len(flux), len(target_wave)))
+    ## One matrix per distinct radial velocity
+    for value in np.unique(rv):
+        rows = np.where(rv == value)[0]
+        out[rows] = FluxRebinner(wave, target_wave, rv=value, gap_factor=gap_factor)(flux[rows])
+    return out
+
+class FluxRebinner:
+    """
+    Precomputed flux-conserving resampling from one wavelength grid to another.
+
+    Parameters:
+    -----------
+    wave : array
+        Wavelengths (A) of the spectra to resample, increasing.
+    target_wave : array
+        Target wavelengths (A), increasing. May be irregular and have gaps.
+    rv : float, optional
+        Radial velocity (km/s) to shift the spectra by. Default is 0.
+    gap_factor : float, optional
+        See resample. Default is 1.5.
+
+    Example:
+    --------
+    >>> rebin = FluxRebinner(wave, order_wave, rv=-45.3)
+    >>> norms_order = rebin(norms)  # (N, npix) -> (N, len(order_wave))
+    """
+    def __init__(self, wave, target_wave, rv=0.0, gap_factor=1.5):
+        wave = np.asarray(wave, dtype=float)
+        target_wave = np.asarray(target_wave, dtype=float)
+        if np.any(np.diff(wave) <= 0): raise ValueError("wave must be increasing")
+        if np.any(np.diff(target_wave) <= 0): raise ValueError("target_wave must be increasing")
+        self.npix = len(wave)
+        self.target_wave = target_wave
+        ## Shift the source instead of the spectra
+        wave = wave*(1 + rv/SPEED_OF_LIGHT)
+        edges = np.concatenate([[1.5*wave[0] - 0.5*wave[1]], 0.5*(wave[1:] + wave[:-1]),
+                                [1.5*wave[-1] - 0.5*wave[-2]]])
+        lower, upper = target_bin_edges(target_wave, gap_factor=gap_factor)
+
+        ## Source bins overlapping each target bin: first..last
+        first = np.clip(np.searchsorted(edges, lower, side="right") - 1, 0, self.npix - 1)
+        last = np.clip(np.searchsorted(edges, upper, side="left") - 1, 0, self.npix - 1)
+        counts = np.maximum(last - first + 1, 0)
+        self.rowptr = np.concatenate([[0], np.cumsum(counts)])
+        rows = np.repeat(np.arange(len(target_wave)), counts)
+        self.columns = first[rows] + np.arange(len(rows)) - self.rowptr[rows]
+        overlap = np.minimum(upper[rows], edges[self.columns + 1]) - np.maximum(lower[rows], edges[self.columns])
+        overlap = np.clip(overlap, 0, None)
+        width = upper - lower
+        self.weights = overlap/width[rows]
+        coverage = np.bincount(rows, weights=self.weights, minlength=len(target_wave))
+        self.covered = coverage > 1 - 1e-6
+
+    def __call__(self, flux):
+        """
+        Resample flux (npix,) or (N, npix). Target pixels that are not covered are NaN.
+        """
+        flux = np.asarray(flux, dtype=float)
+        if flux.shape[-1] != self.npix:
+            raise ValueError(f"flux has {flux.shape[-1]} pixels, expected {self.npix}")
+        out = np.full(flux.shape[:-1] + (len(self.target_wave),), np.nan)
+        if len(self.columns) == 0:
+            return out
+        ## Sum of weight*flux in each row of the sparse matrix (rows with no entries are not covered)
+        products = flux[..., self.columns]*self.weights
+        nonempty = self.rowptr[:-1] < self.rowptr[1:]
+        sums = np.add.reduceat(products, self.rowptr[:-1][nonempty], axis=-1)
+        out[..., nonempty] = sums
+        out[..., ~self.covered] = np.nan
+        return out
+
+def target_bin_edges(target_wave, gap_factor=1.5):
+    """
+    Lower and upper edges of the bin of every target pixel: halfway to the neighbouring pixels,
+    except across gaps (see resample), where the bin is as wide as on the other side.
+    """
+    target_wave = np.asarray(target_wave, dtype=float)
+    if len(target_wave) < 2:
+        raise ValueError("Need at least two target wavelengths")
+    step = np.diff(target_wave)
+    ## Step before and after each pixel, using the other one at the ends
+    before = np.concatenate([[step[0]], step])
+    after = np.concatenate([step, [step[-1]]])
+    ## A step is a gap if it is much bigger than the step on the other side of the pixel
+    gap_after = after > gap_factor*before
+    gap_before = before > gap_factor*after
+    lower = target_wave - 0.5*np.where(gap_before, after, before)
+    upper = target_wave + 0.5*np.where(gap_after, before, after)
+    return lower, upper
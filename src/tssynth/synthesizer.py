@@ -1,7 +1,11 @@
 import numpy as np
-import os, sys, shutil
+import os, sys, re, shutil, time, json, tempfile, errno
 import subprocess
-from . import utils, marcs
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from . import utils, marcs, linelists, timing
+from .utils import TurbospectrumError
+from .cache import MopacCache, mopac_cache_key, SpectrumCache, spectrum_cache_key
 from .solar_abundances import solar_abundances_Z
 
 TSEXEC_PATH = os.environ.get('TSEXEC_PATH', None)
@@ -11,14 +15,15 @@ TSLINELIST_PATH = os.environ.get('TSLINELIST_PATH', None)
 TSDEPCOEFF_PATH = os.environ.get('TSDEPCOEFF_PATH', None)
 ALLMARCS_PATH = os.environ.get('ALLMARCS_PATH', None)
 
+@timing.timed_function("run_synth_lte", job_params=timing.JOB_PARAMS)
 def run_synth_lte(wmin, wmax, dw,
                   Teff=None, logg=None, vt=2.0, MH=None, aFe=None,
                   model_atmosphere_file=None,
-                  linelist_filenames=None,
+                  linelist_filenames=None, trim_linelists=False, linelist_margin=10.0,
                   XFedict=None, 
-                  modelopac_file=None,
+                  modelopac_file=None, mopac_cache=None, spectrum_cache=None,
                   twd=None, delete_twd=False,
-                  spherical=None, verbose=False):
+                  spherical=None, verbose=False, stage_timeout=None):
     """
     Run LTE spectrum synthesis with Turbospectrum.
 
@@ -34,13 +39,27 @@ def run_synth_lte(wmin, wmax, dw,
     model_atmosphere_file (str): Path to the model atmosphere file (default: None)
     linelist_filenames (list or str): List of line list filenames or a single filename
         (default: None, uses get_default_linelist_filenames in TSLINELIST_PATH)
+    trim_linelists (bool): Give bsyn_lu trimmed copies of the line lists written in the twd (default: False)
+        Only lines within linelist_margin of [wmin, wmax] are kept (see linelists.trim_linelist),
+        which makes bsyn_lu much faster for narrow wavelength ranges.
+    linelist_margin (float): Wavelength margin (A) used by trim_linelists (default: 10)
     XFedict (dict): Dictionary of element abundances (default: None)
         Turbospectrum assumes [X/Fe] following the model atmosphere if not specified.
     modelopac_file (str): Path to the model opacity file (default: None)
         This is useful if you want to compute many spectra from one model atmosphere/composition.
+    mopac_cache (MopacCache or str): Cache of model opacity files (default: None, no caching)
+        If a str, it is the directory of a MopacCache, shared by all calls (see MopacCache.shared).
+        babsma_lu is skipped when the cache already holds a model opacity for the same inputs.
+    spectrum_cache (SpectrumCache or str): Cache of synthesized spectra (default: None, no caching)
+        If a str, it is the directory of a SpectrumCache, shared by all calls (see SpectrumCache.shared).
+        If the cache has a spectrum for the same inputs it is returned without running anything.
     twd (str): Temporary working directory (default: None, creates a new one with utils.mkdtemp)
         All the work is done in this directory.
     delete_twd (bool): Delete the temporary working directory after the function finishes (default: False)
+    stage_timeout (float or dict): Wall-clock time limit (s) for each Fortran program (default: None, no limit)
+        A dict gives limits by program, e.g. {"interpol_modeles": 60, "babsma_lu": 120, "bsyn_lu": 1800}.
+        A program that runs longer is killed and TurbospectrumError is raised; so is a program
+        that exits with an error or does not write its output.
 
     Turbospectrum runs in two steps.
     (1) babsma_lu: Computes the model opacity
@@ -51,11 +70,101 @@ def run_synth_lte(wmin, wmax, dw,
     tuple: wave (numpy array), norm (numpy array), flux (numpy array)
     """
 
+    spectrum_cache, spectrum_key, cached = _check_spectrum_cache(
+        spectrum_cache, wmin, wmax, dw, Teff, logg, vt, MH, aFe, model_atmosphere_file,
+        linelist_filenames, trim_linelists, linelist_margin, XFedict, modelopac_file, spherical)
+    if cached is not None:
+        return cached
+
     if twd is None:
         twd = utils.mkdtemp()
         sys.stdout.write(f"Temporary working directory: {twd}")
 
     ## Model Atmosphere File
+    atmosphere = _resolve_model_atmosphere(twd, Teff, logg, vt, MH, aFe, model_atmosphere_file, spherical)
+    if atmosphere["interpolate"]:
+        ## Interpolate a model atmosphere and save into the twd
+        marcs.interpolate_marcs_model(atmosphere["Teff"], atmosphere["logg"], atmosphere["MH"],
+                                      atmosphere["modelfilename"], spherical=atmosphere["spherical"],
+                                      timeout=utils.get_stage_timeout(stage_timeout, "interpol_modeles"))
+    
+    ## Line Lists, Individual Abundances, and the working directory
+    linelist_filenames, indiv_abu = _setup_twd(twd, wmin, wmax, linelist_filenames,
+                                               trim_linelists, linelist_margin, XFedict)
+
+    ## Run babsma_lu for Model Opacity
+    kws_babsma_lu = _babsma_lu_kwargs(twd, wmin, wmax, dw, atmosphere, indiv_abu, verbose)
+    if modelopac_file is None:
+        try:
+            modelopac_file = run_babsma_lu(**kws_babsma_lu, mopac_cache=mopac_cache,
+                                           timeout=utils.get_stage_timeout(stage_timeout, "babsma_lu"))
+        except Exception as e:
+            print("twd", twd)
+            print(e)
+            raise
+    else: ## This is if you want to compute many spectra from one model opacity
+        modelopac_file = _copy_modelopac_file(modelopac_file, twd)
+    
+    ## Run bsyn_lu for Spectrum
+    kws_bsyn_lu = _bsyn_lu_kwargs(kws_babsma_lu, modelopac_file, linelist_filenames)
+    outfilename = run_bsyn_lu(**kws_bsyn_lu, timeout=utils.get_stage_timeout(stage_timeout, "bsyn_lu"))
+
+    ## Read the spectrum output
+    wave, norm, flux = read_bsyn_output(outfilename, wmin=wmin, wmax=wmax, dw=dw)
+    if spectrum_cache is not None:
+        spectrum_cache.put(spectrum_key, (wave, norm, flux))
+
+    if delete_twd:
+        shutil.rmtree(twd, ignore_errors=True)
+
+    return wave, norm, flux
+
+def _check_spectrum_cache(spectrum_cache, wmin, wmax, dw, Teff, logg, vt, MH, aFe, model_atmosphere_file,
+                          linelist_filenames, trim_linelists, linelist_margin, XFedict, modelopac_file, spherical):
+    """
+    Look up the spectrum for the inputs of run_synth_lte in spectrum_cache.
+    Returns the cache (a SpectrumCache, or None if not caching), the key of the spectrum
+    and the cached (wave, norm, flux), or None if it has to be computed.
+    """
+    if isinstance(spectrum_cache, str):
+        spectrum_cache = SpectrumCache.shared(spectrum_cache)
+    if spectrum_cache is None:
+        return None, None, None
+    ## Resolve the defaults so that equivalent calls give the same key
+    atmosphere = _resolve_model_atmosphere("", Teff, logg, vt, MH, aFe, model_atmosphere_file, spherical)
+    if linelist_filenames is None:
+        linelist_filenames = get_default_linelist_filenames()
+    elif isinstance(linelist_filenames, str):
+        linelist_filenames = [linelist_filenames]
+    indiv_abu = {} if XFedict is None else utils.parse_XFe_dict(XFedict)
+    params = dict(wmin=float(wmin), wmax=float(wmax), dw=float(dw),
+                  vt=float(atmosphere["vt"]), spherical=bool(atmosphere["spherical"]),
+                  indiv_abu=sorted((int(Z), float(abund)) for Z, abund in indiv_abu.items()),
+                  linelists=[os.path.realpath(fname) for fname in linelist_filenames],
+                  linelist_margin=float(linelist_margin) if trim_linelists else None)
+    files = list(linelist_filenames)
+    files += [os.path.join(TSEXEC_PATH, 'babsma_lu'), os.path.join(TSEXEC_PATH, 'bsyn_lu')]
+    hashed_files = []
+    if atmosphere["interpolate"]:
+        params["atmosphere"] = dict(Teff=float(atmosphere["Teff"]), logg=float(atmosphere["logg"]),
+                                    MH=float(atmosphere["MH"]), aFe=float(atmosphere["aFe"]),
+                                    marcs_path=os.environ.get("ALLMARCS_PATH"))
+        files.append(os.path.join(os.environ.get("TSINTERP_PATH"), 'interpol_modeles'))
+    else:
+        hashed_files.append(atmosphere["modelfilename"])
+    if modelopac_file is not None:
+        files.append(modelopac_file)
+    key = spectrum_cache_key(params, files=files, hashed_files=hashed_files)
+    return spectrum_cache, key, spectrum_cache.get(key)
+
+def _resolve_model_atmosphere(twd, Teff, logg, vt, MH, aFe, model_atmosphere_file, spherical):
+    """
+    Work out the model atmosphere and its parameters for run_synth_lte.
+
+    Returns a dict with modelfilename, Teff, logg, vt, MH, aFe, spherical, is_marcsfile and interpolate.
+    If interpolate is True, the model still has to be interpolated into modelfilename
+    with marcs.interpolate_marcs_model.
+    """
     if any(param is not None for param in [Teff, logg, MH]):
         assert vt == 2.0, f"for now vt must be 2.0 for atmosphere interpolation, specified {vt}"
         ## Specify the parameters here
@@ -71,18 +180,24 @@ def run_synth_lte(wmin, wmax, dw,
             assert logg <= 3.5, f"for spherical models, logg <= 3.5, specified {logg}"
         else:
             assert logg >= 3.5, f"for plane parallel models, logg >= 3.5, specified {logg}"
-        
-        ## Interpolate a model atmosphere and save into the twd
         model_atmosphere_file = os.path.join(twd, "marcs.interp")
-        marcs.interpolate_marcs_model(Teff, logg, MH, model_atmosphere_file, spherical=spherical)
-        is_marcsfile=False
+        is_marcsfile = False
+        interpolate = True
     else:
         ## Specify a model atmosphere file
         assert model_atmosphere_file is not None, model_atmosphere_file
         assert os.path.exists(model_atmosphere_file), model_atmosphere_file
         Teff, logg, vt, MH, aFe, spherical = parse_model_atmosphere_file_params(model_atmosphere_file)
-        is_marcsfile=True
-    
+        is_marcsfile = True
+        interpolate = False
+    return dict(modelfilename=model_atmosphere_file, Teff=Teff, logg=logg, vt=vt, MH=MH, aFe=aFe,
+                spherical=spherical, is_marcsfile=is_marcsfile, interpolate=interpolate)
+
+def _setup_twd(twd, wmin, wmax, linelist_filenames, trim_linelists, linelist_margin, XFedict):
+    """
+    Check the line lists, parse the individual abundances and set up the working directory.
+    Returns the line list filenames to give bsyn_lu and the individual abundances.
+    """
     ## Line List
     if linelist_filenames is None:
         linelist_filenames = get_default_linelist_filenames()
@@ -100,60 +215,365 @@ def run_synth_lte(wmin, wmax, dw,
         indiv_abu = utils.parse_XFe_dict(XFedict)
     
     ## Set up the working directory
-    if not os.path.exists(os.path.join(twd, 'DATA')):
+    if not os.path.lexists(os.path.join(twd, 'DATA')):
         os.symlink(TSDATA_PATH, os.path.join(twd, 'DATA'))
 
-    ## Run babsma_lu for Model Opacity
-    kws_babsma_lu = dict(twd=twd,
-                         wmin=wmin, wmax=wmax, dwl=dw,
-                         modelfilename=model_atmosphere_file,
-                         modelopacname=None,
-                         MH=MH, aFe=aFe, indiv_abu=indiv_abu,
-                         vt=vt, spherical=spherical,
-                         is_marcsfile=is_marcsfile,
-                         verbose=verbose)
-    if modelopac_file is None:
-        try:
-            modelopac_file = run_babsma_lu(**kws_babsma_lu)
-        except Exception as e:
-            print("twd", twd)
-            print(e)
-            raise
-    else: ## This is if you want to compute many spectra from one model opacity
-        assert os.path.exists(modelopac_file), modelopac_file
-        sys.stdout.write(f"Using model opacity file: {modelopac_file}, copying to twd")
-        shutil.copy(modelopac_file,twd)
-        modelopac_file= os.path.join(twd,os.path.basename(modelopac_file))
-    
-    ## Run bsyn_lu for Spectrum
+    if trim_linelists:
+        linelist_filenames = linelists.stage_trimmed_linelists(linelist_filenames, wmin, wmax, twd,
+                                                               margin=linelist_margin)
+    return linelist_filenames, indiv_abu
+
+def _babsma_lu_kwargs(twd, wmin, wmax, dw, atmosphere, indiv_abu, verbose):
+    return dict(twd=twd,
+                wmin=wmin, wmax=wmax, dwl=dw,
+                modelfilename=atmosphere["modelfilename"],
+                modelopacname=None,
+                MH=atmosphere["MH"], aFe=atmosphere["aFe"], indiv_abu=indiv_abu,
+                vt=atmosphere["vt"], spherical=atmosphere["spherical"],
+                is_marcsfile=atmosphere["is_marcsfile"],
+                verbose=verbose)
+
+def _bsyn_lu_kwargs(kws_babsma_lu, modelopac_file, linelist_filenames):
     kws_bsyn_lu = kws_babsma_lu.copy()
     kws_bsyn_lu["modelopacname"] = modelopac_file
     kws_bsyn_lu["costheta"] = 1.0
     kws_bsyn_lu["isotopes"] = {}
     kws_bsyn_lu["linelistfilenames"] = linelist_filenames
+    return kws_bsyn_lu
 
-    outfilename = run_bsyn_lu(**kws_bsyn_lu)
+def _copy_modelopac_file(modelopac_file, twd):
+    assert os.path.exists(modelopac_file), modelopac_file
+    sys.stdout.write(f"Using model opacity file: {modelopac_file}, copying to twd")
+    shutil.copy(modelopac_file,twd)
+    return os.path.join(twd,os.path.basename(modelopac_file))
 
-    ## Read the spectrum output
-    turboOut= np.loadtxt(outfilename)
-    if len(turboOut) == 0:
-        raise RuntimeError("Turbospectrum output is empty: something did not work")
+def run_synth_lte_batch(jobs, n_workers=None, use_processes=False, delete_twd=True, twd_pool=None,
+                        retries=0, retry_backoff=1.0, quarantine_dir=None):
+    """
+    Run many LTE syntheses concurrently, one call to run_synth_lte per job.
+
+    Parameters:
+    jobs (iterable of dict): Keyword arguments for run_synth_lte, one dict per job.
+        Each dict needs at least wmin, wmax and dw.
+        Each job gets its own temporary working directory unless the dict sets twd.
+        Set stage_timeout in the jobs to kill Fortran programs that hang.
+    n_workers (int): Number of jobs to run at the same time (default: None, uses os.cpu_count())
+    use_processes (bool): Use a process pool instead of a thread pool (default: False)
+        The work is done by the Fortran subprocesses, so threads are usually enough.
+    delete_twd (bool): Delete the temporary working directory of each job that succeeds (default: True)
+        The directory of a failed job is always kept so it can be inspected.
+    twd_pool (workdir.WorkdirPool): Lease working directories from this pool instead of
+        creating a new one for every job (default: None). Only works with threads.
+    retries (int): Number of times to rerun a job after a transient failure (default: 0)
+        Transient failures are timeouts, Fortran programs killed by a signal
+        (see utils.TurbospectrumError.transient), and I/O errors such as EIO or ESTALE
+        (see TRANSIENT_ERRNOS). Missing files, permission errors and invalid inputs are not retried.
+        A Fortran program that exits by itself (with an error, or with status 0 but no output)
+        is not retried, since it would fail again.
+    retry_backoff (float): Seconds to wait before the first retry, doubled for every retry after it (default: 1)
+    quarantine_dir (str): Move the twd of every failed job into this directory, with a failure.json
+        describing the job and the error (default: None, failed twds are kept where they are)
+
+    Returns:
+    list: One entry per job, in the same order as jobs.
+        A job that succeeded gives (wave, norm, flux) like run_synth_lte.
+        A job that failed gives the exception it raised, so one bad job does not stop the batch.
+    """
+    results = {}
+    for i, result in iter_synth_lte_batch(jobs, n_workers=n_workers,
+                                          use_processes=use_processes,
+                                          delete_twd=delete_twd, twd_pool=twd_pool,
+                                          retries=retries, retry_backoff=retry_backoff,
+                                          quarantine_dir=quarantine_dir):
+        results[i] = result
+    return [results[i] for i in range(len(results))]
+
+def iter_synth_lte_batch(jobs, n_workers=None, use_processes=False, delete_twd=True, twd_pool=None,
+                         retries=0, retry_backoff=1.0, quarantine_dir=None):
+    """
+    Same as run_synth_lte_batch, but yields (index, result) for each job as soon as it finishes.
+    index is the position of the job in jobs.
+    """
+    if use_processes and twd_pool is not None:
+        raise ValueError("twd_pool cannot be shared between processes, use threads (use_processes=False).")
+    jobs = [dict(job) for job in jobs]
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, len(jobs)))
+    Executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with Executor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_run_synth_lte_job, job, delete_twd, twd_pool,
+                                   retries, retry_backoff, quarantine_dir): i
+                   for i, job in enumerate(jobs)}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            # If the caller stops early (e.g. KeyboardInterrupt), do not start the remaining jobs
+            for future in futures: future.cancel()
+
+# I/O errors that can go away on their own, e.g. on a shared filesystem
+TRANSIENT_ERRNOS = {errno.EIO, errno.ESTALE, errno.EAGAIN, errno.ETIMEDOUT}
+
+def _is_transient(e):
+    if isinstance(e, utils.TurbospectrumError): return e.transient
+    return isinstance(e, OSError) and e.errno in TRANSIENT_ERRNOS
+
+def _run_synth_lte_job(job, delete_twd=True, twd_pool=None, retries=0, retry_backoff=1.0, quarantine_dir=None):
+    """
+    Run one batch job in its own twd, retrying transient failures.
+    Returns the output of run_synth_lte, or the exception if it failed.
+    """
+    job = dict(job)
+    twd = job.pop("twd", None)
+    leased = twd is None and twd_pool is not None
+    if leased:
+        twd = twd_pool.acquire()
+        # The pool owns the directory, run_synth_lte must not delete it
+        job.pop("delete_twd", None)
+    elif twd is None:
+        twd = utils.mkdtemp()
+    attempt = 0
+    while True:
+        try:
+            result = run_synth_lte(twd=twd, **job)
+            break
+        except Exception as e:
+            if attempt < retries and _is_transient(e):
+                wait = retry_backoff*2**attempt
+                attempt += 1
+                print(f"Job failed ({e}), retry {attempt}/{retries} in {wait:.1f} s")
+                time.sleep(wait)
+                continue
+            try:
+                if leased:
+                    twd = twd_pool.release(twd, keep=True)
+                if quarantine_dir is not None and twd is not None:
+                    twd = _quarantine(twd, job, e, attempt + 1, quarantine_dir)
+            except Exception:
+                traceback.print_exc()
+            print(f"Job failed, keeping twd {twd}")
+            traceback.print_exc()
+            return e
+    try:
+        if leased:
+            twd_pool.release(twd)
+        elif delete_twd:
+            shutil.rmtree(twd, ignore_errors=True)
+    except Exception as e:
+        print(f"Job succeeded but its twd {twd} could not be released")
+        traceback.print_exc()
+        return e
+    return result
 
-    wave = turboOut[:,0]
-    norm = turboOut[:,1]
-    flux = turboOut[:,2]
+def _quarantine(twd, job, e, attempts, quarantine_dir):
+    """
+    Move the twd of a failed job into quarantine_dir and write failure.json into it.
+    Returns the new path of the twd.
+    """
+    os.makedirs(quarantine_dir, exist_ok=True)
+    dest = os.path.join(quarantine_dir, os.path.basename(os.path.normpath(twd)))
+    if os.path.exists(dest):
+        dest = tempfile.mkdtemp(prefix=os.path.basename(os.path.normpath(twd)) + "_", dir=quarantine_dir)
+        os.rmdir(dest)
+    shutil.move(twd, dest)
+    failure = dict(job=job, error=repr(e), error_type=type(e).__name__, attempts=attempts,
+                   traceback=traceback.format_exception(type(e), e, e.__traceback__),
+                   original_twd=twd, time=time.strftime("%Y-%m-%dT%H:%M:%S%z"))
+    if isinstance(e, utils.TurbospectrumError):
+        failure.update(executable=e.executable, returncode=e.returncode, timed_out=e.timed_out)
+    with open(os.path.join(dest, "failure.json"), "w") as fp:
+        json.dump(failure, fp, indent=1, default=str)
+    return dest
 
+def run_synth_lte_chunked(wmin, wmax, dw, chunk_width=100.0, overlap=5.0,
+                          linelist_filenames=None, linelist_margin=None,
+                          n_workers=None, use_processes=False, **kwargs):
+    """
+    Run LTE spectrum synthesis by splitting [wmin, wmax] into chunks that are synthesized concurrently.
+
+    Each chunk is extended by overlap on both sides and runs babsma_lu and bsyn_lu
+    in its own twd, using only the line lists that cover the chunk.
+    The chunks are then stitched back together on the same wavelength grid that
+    run_synth_lte(wmin, wmax, dw) would give, keeping only the central part of each chunk.
 
+    Parameters:
+    wmin (float): Minimum wavelength (A)
+    wmax (float): Maximum wavelength (A)
+    dw (float): Wavelength step (A)
+    chunk_width (float): Width of each chunk before adding the overlap (A) (default: 100)
+    overlap (float): Extra wavelength computed on each side of each chunk (A) (default: 5)
+        This should be large enough that lines just outside a chunk are not missed near its edges.
+    linelist_filenames (list or str): Same as for run_synth_lte
+    linelist_margin (float): A line list is used for a chunk if it has lines within
+        linelist_margin of the extended chunk (default: None, uses overlap).
+        This is also passed to run_synth_lte, so it sets the margin when trim_linelists=True.
+    n_workers (int): Number of chunks to run at the same time (default: None, uses os.cpu_count())
+    use_processes (bool): Use a process pool instead of a thread pool (default: False)
+    **kwargs: Passed to run_synth_lte (Teff, logg, MH, XFedict, model_atmosphere_file, etc.)
+
+    Returns:
+    tuple: wave (numpy array), norm (numpy array), flux (numpy array)
+    """
+    if "twd" in kwargs:
+        raise ValueError("Each chunk runs in its own twd, twd cannot be specified.")
+    if linelist_margin is None:
+        linelist_margin = overlap
+    if linelist_filenames is None:
+        linelist_filenames = get_default_linelist_filenames()
+    elif isinstance(linelist_filenames, str):
+        linelist_filenames = [linelist_filenames]
+    missing_files = [filename for filename in linelist_filenames if not os.path.exists(filename)]
+    if missing_files:
+        raise FileNotFoundError(f"Line list files not found: {', '.join(missing_files)}")
+
+    N_pix = round((wmax-wmin)/dw) + 1
+    N_chunk = max(1, round(chunk_width/dw))
+    N_pad = int(np.ceil(overlap/dw))
+    chunks = []
+    jobs = []
+    for start in range(0, N_pix, N_chunk):
+        stop = min(start + N_chunk, N_pix)
+        lo, hi = max(0, start - N_pad), min(N_pix - 1, stop - 1 + N_pad)
+        chunk_wmin, chunk_wmax = wmin + lo*dw, wmin + hi*dw
+        chunk_linelists = [fname for fname in linelist_filenames
+                           if linelists.linelist_overlaps(fname, chunk_wmin - linelist_margin, chunk_wmax + linelist_margin)]
+        chunks.append((start, stop))
+        jobs.append(dict(kwargs, wmin=chunk_wmin, wmax=chunk_wmax, dw=dw,
+                         linelist_filenames=chunk_linelists, linelist_margin=linelist_margin))
+
+    results = run_synth_lte_batch(jobs, n_workers=n_workers, use_processes=use_processes)
+
+    wave = wmin + dw*np.arange(N_pix)
+    norm = np.full(N_pix, np.nan)
+    flux = np.full(N_pix, np.nan)
+    for (start, stop), job, result in zip(chunks, jobs, results):
+        if isinstance(result, Exception):
+            raise RuntimeError(f"Chunk {job['wmin']:.3f}-{job['wmax']:.3f} failed") from result
+        chunk_wave, chunk_norm, chunk_flux = result
+        ix = np.rint((chunk_wave - wmin)/dw).astype(int)
+        ii = (ix >= start) & (ix < stop)
+        norm[ix[ii]] = chunk_norm[ii]
+        flux[ix[ii]] = chunk_flux[ii]
+    if np.any(np.isnan(norm)):
+        raise RuntimeError(f"Stitching chunks left {np.sum(np.isnan(norm))} pixels empty")
     return wave, norm, flux
 
+## Elements whose abundances change the babsma_lu continuum opacity: H, He, the main electron
+## donors (Na, Mg, Al, Si, K, Ca, Fe) and the C, N, O that set the molecular equilibrium
+OPACITY_ELEMENTS = (1, 2, 6, 7, 8, 11, 12, 13, 14, 19, 20, 26)
+
+def run_synth_lte_abundance_sweep(wmin, wmax, dw, XFedicts,
+                                  Teff=None, logg=None, vt=2.0, MH=None, aFe=None,
+                                  model_atmosphere_file=None,
+                                  linelist_filenames=None, trim_linelists=False, linelist_margin=10.0,
+                                  mopac_cache=None, opacity_elements=OPACITY_ELEMENTS,
+                                  n_workers=None, delete_twd=True,
+                                  spherical=None, verbose=False, stage_timeout=None):
+    """
+    Run LTE spectrum synthesis of one star for many abundance patterns.
+
+    The model atmosphere is interpolated once. The XFedicts are grouped by the abundances
+    of opacity_elements, babsma_lu runs once per group with only those abundances, and
+    bsyn_lu runs for every XFedict with the model opacity of its group.
+    So a sweep over e.g. [Eu/Fe] needs a single babsma_lu run.
+    Elements not in opacity_elements are left at their default abundance in babsma_lu,
+    which only changes the continuum negligibly for trace elements.
+
+    Parameters:
+    wmin, wmax, dw, Teff, logg, vt, MH, aFe, model_atmosphere_file, linelist_filenames,
+    trim_linelists, linelist_margin, mopac_cache, spherical, verbose, stage_timeout: Same as for run_synth_lte
+    XFedicts (list of dict): Abundance patterns, each like the XFedict of run_synth_lte (or None)
+    opacity_elements (iterable of int): Atomic numbers of the elements that are passed to babsma_lu
+        (default: OPACITY_ELEMENTS). Use all elements to reproduce run_synth_lte exactly.
+    n_workers (int): Number of babsma_lu/bsyn_lu runs at the same time (default: None, uses os.cpu_count())
+    delete_twd (bool): Delete the working directory if every run succeeds (default: True)
+
+    Returns:
+    list: One entry per XFedict, in the same order.
+        Either (wave, norm, flux) like run_synth_lte, or the exception raised for that XFedict.
+    """
+    opacity_elements = set(opacity_elements)
+    twd = utils.mkdtemp()
+    sys.stdout.write(f"Temporary working directory: {twd}")
+
+    ## One model atmosphere and one set of line lists for every run
+    atmosphere = _resolve_model_atmosphere(twd, Teff, logg, vt, MH, aFe, model_atmosphere_file, spherical)
+    if atmosphere["interpolate"]:
+        marcs.interpolate_marcs_model(atmosphere["Teff"], atmosphere["logg"], atmosphere["MH"],
+                                      atmosphere["modelfilename"], spherical=atmosphere["spherical"],
+                                      timeout=utils.get_stage_timeout(stage_timeout, "interpol_modeles"))
+    linelist_filenames, _ = _setup_twd(twd, wmin, wmax, linelist_filenames,
+                                       trim_linelists, linelist_margin, None)
+
+    ## Group the abundance patterns by what babsma_lu sees
+    indiv_abus = [{} if XFedict is None else utils.parse_XFe_dict(XFedict) for XFedict in XFedicts]
+    groups = {}
+    for i, indiv_abu in enumerate(indiv_abus):
+        opacity_abu = tuple(sorted((Z, abund) for Z, abund in indiv_abu.items() if Z in opacity_elements))
+        groups.setdefault(opacity_abu, []).append(i)
+    print(f"{len(groups)} babsma_lu runs for {len(indiv_abus)} abundance patterns")
+
+    def make_twd(name):
+        subtwd = os.path.join(twd, name)
+        os.makedirs(subtwd, exist_ok=True)
+        if not os.path.lexists(os.path.join(subtwd, 'DATA')):
+            os.symlink(TSDATA_PATH, os.path.join(subtwd, 'DATA'))
+        return subtwd
+    def run_babsma(igroup, opacity_abu):
+        kws_babsma_lu = _babsma_lu_kwargs(make_twd(f"opac{igroup:04d}"), wmin, wmax, dw, atmosphere,
+                                          dict(opacity_abu), verbose)
+        return run_babsma_lu(**kws_babsma_lu, mopac_cache=mopac_cache,
+                             timeout=utils.get_stage_timeout(stage_timeout, "babsma_lu"))
+    def run_bsyn(i, modelopac_file):
+        kws_babsma_lu = _babsma_lu_kwargs(make_twd(f"job{i:04d}"), wmin, wmax, dw, atmosphere,
+                                          indiv_abus[i], verbose)
+        outfilename = run_bsyn_lu(**_bsyn_lu_kwargs(kws_babsma_lu, modelopac_file, linelist_filenames),
+                                  timeout=utils.get_stage_timeout(stage_timeout, "bsyn_lu"))
+        return read_bsyn_output(outfilename, wmin=wmin, wmax=wmax, dw=dw)
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        babsma_futures = {executor.submit(run_babsma, igroup, opacity_abu): opacity_abu
+                          for igroup, opacity_abu in enumerate(groups)}
+        bsyn_futures = {}
+        ## Start the bsyn_lu runs of each group as soon as its model opacity is ready
+        for future in as_completed(babsma_futures):
+            members = groups[babsma_futures[future]]
+            try:
+                modelopac_file = future.result()
+            except Exception as e:
+                traceback.print_exc()
+                for i in members: results[i] = e
+                continue
+            for i in members:
+                bsyn_futures[executor.submit(run_bsyn, i, modelopac_file)] = i
+        for future in as_completed(bsyn_futures):
+            i = bsyn_futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                traceback.print_exc()
+                results[i] = e
+
+    results = [results[i] for i in range(len(indiv_abus))]
+    if any(isinstance(result, Exception) for result in results):
+        print(f"Some runs failed, keeping twd {twd}")
+    elif delete_twd:
+        shutil.rmtree(twd, ignore_errors=True)
+    return results
+
 def run_babsma_lu(twd, wmin, wmax, dwl,
                   modelfilename, modelopacname,
                   MH, aFe, indiv_abu, vt, spherical,
                   is_marcsfile=True,
-                  verbose=False):
+                  verbose=False, mopac_cache=None, timeout=None):
     """
     - create babsma_lu parameter file
-    - call basbma_lu from TSEXEC_PATH
+    - call basbma_lu from TSEXEC_PATH, unless mopac_cache has a matching model opacity
+      (killed after timeout seconds; raises TurbospectrumError if it fails)
     - return filename of modelopac
     """
     scriptfilename= os.path.join(twd,'babsma.par')
@@ -170,45 +590,30 @@ def run_babsma_lu(twd, wmin, wmax, dwl,
                     vt,
                     spherical,
                     None,None,None,bsyn=False)
+    # Check the cache
+    mopac_cache, cache_key, cache_hit = _check_mopac_cache(mopac_cache, scriptfilename, modelfilename,
+                                                           spherical, modelopacname)
+    if cache_hit:
+        return modelopacname
     # Run babsma
     sys.stdout.write('\r'+"Running Turbospectrum babsma_lu ...\r")
     sys.stdout.flush()
-    if verbose:
-        stdout= None
-        stderr= None
-    else:
-        stdout= open('/dev/null', 'w')
-        stderr= subprocess.STDOUT
     try:
-        p= subprocess.Popen([os.path.join(TSEXEC_PATH, 'babsma_lu')],
-                            cwd=twd,
-                            stdin=subprocess.PIPE,
-                            stdout=stdout,
-                            stderr=stderr)
-        with open(os.path.join(twd,'babsma.par'),'r') as parfile:
-            for line in parfile:
-                p.stdin.write(line.encode('utf-8'))
-        stdout, stderr= p.communicate()
-    except subprocess.CalledProcessError:
-        #for linelistfilename in linelistfilenames:
-        #    os.remove(linelistfilename,twd)
-        #if os.path.exists(os.path.join(twd,'DATA')):
-        #    os.remove(os.path.join(twd,'DATA'))
-        raise RuntimeError("Running babsma_lu failed ...")
+        _run_turbospectrum('babsma_lu', twd, scriptfilename, verbose=verbose, timeout=timeout,
+                           outputs=[modelopacname])
     finally:
-        #if os.path.exists(os.path.join(twd,'babsma.par')) \
-        #   and outfname is None: #not 'saveTurboInput' in kwargs:
-        #    os.remove(os.path.join(twd,'babsma.par'))
-        # sys.stdout.write('\r'+_ERASESTR+'\r')
         sys.stdout.flush()
-    #if isinstance(modelopac,str):
-    #    shutil.copy(modelopacname,modelopac)
+    if mopac_cache is not None:
+        mopac_cache.put(cache_key, modelopacname)
     return modelopacname
 
 def run_bsyn_lu(twd, wmin, wmax, dwl, costheta, modelfilename, is_marcsfile, 
                 modelopacname, MH, aFe, indiv_abu, vt, spherical,
-                isotopes, linelistfilenames, outfname=None, verbose=False):
+                isotopes, linelistfilenames, outfname=None, verbose=False, timeout=None):
     """
+    - create bsyn_lu parameter file
+    - call bsyn_lu from TSEXEC_PATH (killed after timeout seconds; raises TurbospectrumError if it fails)
+    - return filename of the spectrum
     """
     scriptfilename= os.path.join(twd,'bsyn.par')
     outfilename= os.path.join(twd,'bsyn.out')
@@ -230,24 +635,9 @@ def run_bsyn_lu(twd, wmin, wmax, dwl, costheta, modelfilename, is_marcsfile,
     # Run bsyn
     sys.stdout.write('\r'+"Running Turbospectrum bsyn_lu ...\r")
     sys.stdout.flush()
-    if verbose:
-        stdout= None
-        stderr= None
-    else:
-        stdout= open('/dev/null', 'w')
-        stderr= subprocess.STDOUT
     try:
-        p= subprocess.Popen([os.path.join(TSEXEC_PATH, 'bsyn_lu')],
-                            cwd=twd,
-                            stdin=subprocess.PIPE,
-                            stdout=stdout,
-                            stderr=stderr)
-        with open(os.path.join(twd,'bsyn.par'),'r') as parfile:
-            for line in parfile:
-                p.stdin.write(line.encode('utf-8'))
-        stdout, stderr= p.communicate()
-    except subprocess.CalledProcessError:
-        raise RuntimeError("Running bsyn_lu failed ...")
+        _run_turbospectrum('bsyn_lu', twd, scriptfilename, verbose=verbose, timeout=timeout,
+                           outputs=[outfilename])
     finally:
         if outfname is not None:
             turbosavefilename= outfname
@@ -262,6 +652,130 @@ def run_bsyn_lu(twd, wmin, wmax, dwl, costheta, modelfilename, is_marcsfile,
         sys.stdout.flush()
     return outfilename
 
+def _check_mopac_cache(mopac_cache, scriptfilename, modelfilename, spherical, modelopacname):
+    """
+    Look up the model opacity for a babsma_lu script in mopac_cache and copy it to modelopacname.
+    Returns the cache (a MopacCache, or None if not caching), the key of the model opacity
+    and whether it was found in the cache.
+    """
+    if isinstance(mopac_cache, str):
+        mopac_cache = MopacCache.shared(mopac_cache)
+    if mopac_cache is None:
+        return None, None, False
+    cache_key = mopac_cache_key(scriptfilename, modelfilename, spherical,
+                                executable=os.path.join(TSEXEC_PATH, 'babsma_lu'))
+    return mopac_cache, cache_key, mopac_cache.get(cache_key, modelopacname)
+
+def _run_turbospectrum(executable, twd, scriptfilename, verbose=False, timeout=None, outputs=()):
+    """
+    Run a Turbospectrum executable (babsma_lu or bsyn_lu) in twd, with the script file on stdin.
+    Raises TurbospectrumError if it fails, takes longer than timeout (s) or does not write outputs.
+    """
+    with open(scriptfilename,'r') as parfile:
+        script = parfile.read()
+    with timing.timed(executable, twd=twd):
+        return utils.run_executable(os.path.join(TSEXEC_PATH, executable), script, cwd=twd,
+                                    timeout=timeout, verbose=verbose, outputs=outputs)
+
+BSYN_OUTPUT_COLUMNS = ("wave", "norm", "flux")
+
+@timing.timed_function("read_bsyn_output")
+def read_bsyn_output(outfilename, wmin=None, wmax=None, dw=None,
+                     columns=BSYN_OUTPUT_COLUMNS, dtype=np.float64):
+    """
+    Read the spectrum written by bsyn_lu.
+
+    bsyn_lu writes fixed-format columns, so the file is read as one byte array and the
+    digits of each column are converted in bulk into preallocated output arrays
+    (see _parse_fixed_format). This is several times faster than np.loadtxt.
+    If the file does not have a fixed layout, this falls back to np.loadtxt.
+
+    Parameters:
+    outfilename (str): Path to the bsyn_lu output
+    wmin, wmax, dw (float): If all given, check that there are round((wmax-wmin)/dw)+1 rows
+    columns (tuple of str): Columns to return, any of "wave", "norm", "flux" (default: all three)
+    dtype: Data type of the returned arrays (default: np.float64, use np.float32 to save memory)
+
+    Returns:
+    tuple: one numpy array per requested column
+    """
+    usecols = [BSYN_OUTPUT_COLUMNS.index(column) for column in columns]
+    buf = np.fromfile(outfilename, dtype=np.uint8)
+    if len(buf) == 0:
+        raise RuntimeError(f"Turbospectrum output is empty: something did not work ({outfilename})")
+    data = _parse_fixed_format(buf, usecols, dtype)
+    if data is None:
+        data = np.loadtxt(outfilename, ndmin=2, usecols=usecols, dtype=dtype).T
+    if wmin is not None and wmax is not None and dw is not None:
+        N_expected = round((wmax-wmin)/dw) + 1
+        if len(data[0]) != N_expected:
+            raise RuntimeError(f"Turbospectrum output {outfilename} has {len(data[0])} rows, expected {N_expected}")
+    return tuple(data)
+
+_POW10 = 10.0**np.arange(-330, 309)
+
+def _parse_fixed_format(buf, usecols, dtype, chunksize=16384):
+    """
+    Parse whitespace separated, right-aligned, fixed-width float columns (Fortran F or E formats).
+    buf is the whole file as a uint8 array. Returns a list of arrays (one per column in usecols),
+    or None if the file does not have the same layout on every line.
+    """
+    N_line = int(np.argmax(buf == ord("\n"))) + 1
+    if buf[N_line-1] != ord("\n") or len(buf) % N_line != 0: return None
+    lines = buf.reshape(-1, N_line)
+    if not (lines[:, -1] == ord("\n")).all(): return None
+
+    ## Column layout from the first line: each column ends where a token ends
+    first_line = lines[0, :-1].tobytes().decode("ascii", errors="replace")
+    layout = []
+    lo = 0
+    for hi in [m.end() for m in re.finditer(r"\S+", first_line)]:
+        field = first_line[lo:hi]
+        if field.count(".") != 1: return None
+        dot = lo + field.index(".")
+        e = hi
+        for echar in "EeDd":
+            if echar in field: e = lo + field.index(echar)
+        layout.append((lo, hi, dot, e))
+        lo = hi
+    if len(layout) <= max(usecols): return None
+
+    N = len(lines)
+    out = [np.empty(N, dtype=dtype) for icol in usecols]
+    def to_int(chars):
+        ## chars has shape (width, n), returns the integers and whether they are negative
+        value = np.zeros(chars.shape[1], dtype=np.int64)
+        ok = True
+        for c in chars:
+            digit = c - np.uint8(ord("0"))
+            isdigit = digit < 10
+            ok = ok & (isdigit | (c == ord(" ")) | (c == ord("-")) | (c == ord("+"))).all()
+            digit[~isdigit] = 0
+            value *= 10
+            value += digit
+        return value, (chars == ord("-")).any(axis=0), ok
+    for start in range(0, N, chunksize):
+        chunk = np.ascontiguousarray(lines[start:start+chunksize].T)
+        for icol, column in zip(usecols, out):
+            lo, hi, dot, e = layout[icol]
+            if not (chunk[dot] == ord(".")).all(): return None
+            mantissa, negative, ok = to_int(np.concatenate([chunk[lo:dot], chunk[dot+1:e]]))
+            if not ok: return None
+            value = mantissa.astype(np.float64)
+            exponent = -(e - dot - 1)
+            if e < hi:
+                if not np.isin(chunk[e], np.frombuffer(b"EeDd", dtype=np.uint8)).all(): return None
+                exp_value, exp_negative, ok = to_int(chunk[e+1:hi])
+                if not ok: return None
+                exp_value[exp_negative] *= -1
+                value *= _POW10[exp_value + exponent + 330]
+            else:
+                value *= _POW10[exponent + 330]
+            value[negative] *= -1
+            column[start:start+chunksize] = value
+    return out
+
+@timing.timed_function("write_script")
 def _write_script(scriptfilename,
                   wmin,wmax,dw,
                   costheta,
@@ -360,13 +874,14 @@ def parse_model_atmosphere_file_params(model_atmosphere_file):
     spherical = header["spherical"]
     return Teff, logg, vt, MH, aFe, spherical
 
-def get_default_linelist_filenames(include_H=True, wmin=None, wmax=None):
+def get_default_linelist_filenames(include_H=True, wmin=None, wmax=None, margin=10.0):
     """
     Default linelists based on TSFitPy. This is GES for 4200-9200, VALD fills 3700-4200 and 9200-9800.
     I also added molecular lines for C to GES.
     https://keeper.mpdl.mpg.de/d/6eaecbf95b88448f98a4/?p=%2Flinelist&mode=list
     
-    TODO use wmin and wmax to cut lines appropriately
+    If wmin and wmax are given, only files with lines within margin of [wmin, wmax] are returned.
+    Use trim_linelists in run_synth_lte to also cut the lines within each file.
     TODO add a check for maximum number of lines allowable by Turbospectrum as it gets to be a lot
     """
     fnames = ["nlte_ges_linelist_jmg04sep2023_I_II",
@@ -386,7 +901,12 @@ def get_default_linelist_filenames(include_H=True, wmin=None, wmax=None):
     ]
     if include_H:
         fnames.append("Hlinedata")
-    return [os.path.join(TSLINELIST_PATH, x) for x in fnames]
+    fnames = [os.path.join(TSLINELIST_PATH, x) for x in fnames]
+    if wmin is not None and wmax is not None:
+        # Missing files are kept so that run_synth_lte reports them
+        fnames = [fname for fname in fnames if not os.path.exists(fname) or
+                  linelists.linelist_overlaps(fname, wmin - margin, wmax + margin)]
+    return fnames
 
 def get_vald_linelist_filenames(include_H=True):
     """
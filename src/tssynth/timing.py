@@ -0,0 +1,186 @@
+"""
+Timing events for the stages of a synthesis.
+
+Nothing is measured until a hook is registered with add_hook; until then the instrumented
+functions only check an empty list. Each event is a dict with
+  stage        e.g. "babsma_lu", "bsyn_lu", "write_script" (see STAGES)
+  wall         wall clock time (s)
+  cpu          CPU time of the calling thread (s)
+  cpu_children CPU time of finished subprocesses, e.g. the Fortran codes (s). This is per
+               process, so it is only exact when one synthesis runs at a time. None on Windows.
+  start        time.time() at the start
+  pid, thread  where it ran
+  error        name of the exception if the stage failed, else None
+plus the identifying parameters of the job (see JOB_PARAMS) and any stage details.
+
+Hooks are callables taking the event dict. JSONLinesHook and LoggingHook are provided.
+Setting the environment variable TSSYNTH_TIMING_FILE on import adds a JSONLinesHook.
+
+Example:
+>>> from tssynth import timing
+>>> collector = timing.EventCollector()
+>>> timing.add_hook(collector)
+>>> run_synth_lte(5000, 5100, 0.01, Teff=5000, logg=2.0, MH=-2.0)
+>>> print(collector.summary())
+"""
+import contextlib, contextvars, functools, inspect, json, logging, os, threading, time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+STAGES = ("run_synth_lte", "marcs_grid_lookup", "marcs_interpolator", "write_script",
+          "babsma_lu", "bsyn_lu", "read_bsyn_output")
+JOB_PARAMS = ("wmin", "wmax", "dw", "Teff", "logg", "vt", "MH", "aFe", "model_atmosphere_file", "XFedict")
+
+_hooks = []
+_job = contextvars.ContextVar("tssynth_timing_job", default=None)
+_NULL_CONTEXT = contextlib.nullcontext()
+
+def add_hook(hook):
+    """
+    Register a callable that gets every timing event (a dict).
+    """
+    _hooks.append(hook)
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+def clear_hooks():
+    del _hooks[:]
+
+def enabled():
+    return len(_hooks) > 0
+
+def timed(stage, **details):
+    """
+    Context manager that emits a timing event for stage, with details added to the event.
+    Does nothing if no hooks are registered.
+    """
+    if not _hooks: return _NULL_CONTEXT
+    return _Timer(stage, details)
+
+def job_context(**params):
+    """
+    Context manager that adds params to the events of everything run inside it (in this thread).
+    Does nothing if no hooks are registered.
+    """
+    if not _hooks: return _NULL_CONTEXT
+    return _JobContext(params)
+
+def timed_function(stage, job_params=None):
+    """
+    Decorator that emits a timing event for every call of the function.
+    job_params are names of arguments of the function that identify the job; they are added
+    to the events of the function and of everything it calls.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _hooks: return func(*args, **kwargs)
+            context = _NULL_CONTEXT
+            if job_params:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                context = _JobContext({name: bound.arguments[name] for name in job_params})
+            with context, _Timer(stage, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _children_cpu():
+    if resource is None: return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class _JobContext:
+    def __init__(self, params):
+        self.params = params
+    def __enter__(self):
+        job = dict(_job.get() or {})
+        job.update(self.params)
+        self.token = _job.set(job)
+    def __exit__(self, *exc):
+        _job.reset(self.token)
+
+class _Timer:
+    def __init__(self, stage, details):
+        self.stage = stage
+        self.details = details
+    def __enter__(self):
+        self.start = time.time()
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        self.cpu_children = _children_cpu()
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        cpu_children = _children_cpu()
+        if cpu_children is not None:
+            cpu_children -= self.cpu_children
+        event = dict(stage=self.stage, wall=wall, cpu=cpu, cpu_children=cpu_children,
+                     start=self.start, pid=os.getpid(), thread=threading.current_thread().name,
+                     error=None if exc_type is None else exc_type.__name__)
+        event.update(_job.get() or {})
+        event.update(self.details)
+        for hook in list(_hooks):
+            try:
+                hook(event)
+            except Exception as e:
+                print(f"Timing hook {hook} failed: {e}")
+
+class JSONLinesHook:
+    """
+    Append every event as one line of JSON to a file.
+    Each event is one write to a file opened for appending, so several processes can share the file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+    def __call__(self, event):
+        line = json.dumps(event, default=str) + "\n"
+        with self._lock:
+            with open(self.path, "a") as fp:
+                fp.write(line)
+
+class LoggingHook:
+    """
+    Log every event with the logging module.
+    """
+    def __init__(self, logger="tssynth.timing", level=logging.INFO):
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.level = level
+    def __call__(self, event):
+        self.logger.log(self.level, "%s wall=%.4fs cpu=%.4fs %s", event["stage"], event["wall"], event["cpu"],
+                        json.dumps(event, default=str))
+
+class EventCollector:
+    """
+    Keep events in a list, e.g. to look at them in a notebook or a test.
+    """
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
+    def summary(self):
+        """
+        Table of the number of events and total wall/CPU time of each stage.
+        """
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event["stage"], dict(count=0, wall=0.0, cpu=0.0, cpu_children=0.0))
+            total["count"] += 1
+            total["wall"] += event["wall"]
+            total["cpu"] += event["cpu"]
+            total["cpu_children"] += event["cpu_children"] or 0.0
+        lines = [f"{'stage':<20}{'count':>7}{'wall(s)':>10}{'cpu(s)':>10}{'children(s)':>13}"]
+        for stage, total in totals.items():
+            lines.append(f"{stage:<20}{total['count']:>7d}{total['wall']:>10.3f}{total['cpu']:>10.3f}"
+                         f"{total['cpu_children']:>13.3f}")
+        return "\n".join(lines)
+
+if os.environ.get("TSSYNTH_TIMING_FILE"):
+    add_hook(JSONLinesHook(os.environ["TSSYNTH_TIMING_FILE"]))
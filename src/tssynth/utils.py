@@ -1,6 +1,8 @@
-import tempfile, os
+import tempfile, os, subprocess
 from .solar_abundances import periodic_table
 
+SPEED_OF_LIGHT = 299792.458 # km/s
+
 def mkdtemp():
     """
     Create a temporary directory.
@@ -30,3 +32,74 @@ def element_to_atomic_number(element):
         print(f"Element {element} not found in periodic table, returning None.")
         return None
 
+
+class TurbospectrumError(RuntimeError):
+    """
+    A Fortran program (babsma_lu, bsyn_lu or interpol_modeles) exited with an error,
+    was killed after its timeout, or did not write its output.
+
+    executable, returncode, timed_out and cwd say what happened. transient is True for
+    failures that may not happen again (timeouts, being killed by a signal), and False when
+    the program exited by itself, which will happen again with the same input. That includes
+    exiting with status 0 without writing its output: Turbospectrum reports errors in its
+    input with a Fortran STOP, which exits with status 0.
+    """
+    def __init__(self, message, executable=None, returncode=None, timed_out=False, cwd=None):
+        super().__init__(message)
+        self.executable = executable
+        self.returncode = returncode
+        self.timed_out = timed_out
+        self.cwd = cwd
+
+    @property
+    def transient(self):
+        return self.timed_out or (self.returncode is not None and self.returncode < 0)
+
+def get_stage_timeout(timeout, executable):
+    """
+    Timeout (s) of one executable from a timeout that is a number (the same for all) or
+    a dict by executable name, e.g. {"bsyn_lu": 600}. None means no timeout.
+    """
+    if isinstance(timeout, dict):
+        return timeout.get(executable)
+    return timeout
+
+def run_executable(executable, stdin_text, cwd=None, timeout=None, verbose=False, outputs=()):
+    """
+    Run a Fortran program with stdin_text on stdin and check that it worked.
+
+    Raises TurbospectrumError if it exits with a non-zero status, runs longer than timeout
+    seconds (it is killed first), or any of the files in outputs does not exist afterwards.
+    Files in outputs are deleted before it starts so a stale output is not mistaken for a new one
+    (only regular files, so e.g. /dev/null can be an output).
+    Returns the exit code (0).
+    """
+    name = os.path.basename(executable)
+    for output in outputs:
+        if os.path.isfile(output): os.remove(output)
+    if verbose:
+        stdout, stderr = None, None
+    else:
+        stdout, stderr = subprocess.DEVNULL, subprocess.STDOUT
+    p = subprocess.Popen([executable], cwd=cwd, stdin=subprocess.PIPE, stdout=stdout, stderr=stderr)
+    try:
+        p.communicate(stdin_text.encode('utf-8'), timeout=timeout)
+    except subprocess.TimeoutExpired:
+        p.kill()
+        p.communicate()
+        raise TurbospectrumError(f"{name} did not finish in {timeout} s and was killed (in {cwd})",
+                                 executable=name, returncode=p.returncode, timed_out=True, cwd=cwd)
+    except BaseException:
+        # e.g. KeyboardInterrupt: do not leave the process running
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+        raise
+    if p.returncode != 0:
+        raise TurbospectrumError(f"{name} failed with exit code {p.returncode} (in {cwd})",
+                                 executable=name, returncode=p.returncode, cwd=cwd)
+    missing = [output for output in outputs if not os.path.exists(output)]
+    if missing:
+        raise TurbospectrumError(f"{name} did not write {', '.join(missing)} (in {cwd})",
+                                 executable=name, returncode=p.returncode, cwd=cwd)
+    return p.returncode
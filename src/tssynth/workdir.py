@@ -0,0 +1,187 @@
+import os, shutil, tempfile, threading
+from contextlib import contextmanager
+
+TSEXEC_PATH = os.environ.get('TSEXEC_PATH', None)
+TSDATA_PATH = os.environ.get('TSDATA_PATH', os.path.join(TSEXEC_PATH, '../DATA'))
+TWD_BASE = os.environ.get('TWD_BASE', None)
+
+class WorkdirPool:
+    """
+    Pool of reusable temporary working directories for run_synth_lte.
+
+    Each directory is created once with the DATA symlink Turbospectrum needs, leased to one
+    job at a time, and emptied (except for DATA) when the job is done, so a batch only ever
+    creates as many directories as jobs run at the same time.
+
+    Directories can be put on a RAM-backed filesystem such as /dev/shm with tmpfs_base.
+    tmpfs_max_bytes caps how much of it the pool uses; the size of each directory is measured
+    when it is released, and once the pool would exceed the cap (or the filesystem is
+    nearly full) new directories are created on disk in base instead.
+    Directories that are leased but not measured yet count as the largest size measured so far
+    (or tmpfs_reserve_bytes before anything is measured). Without either, only one unmeasured
+    directory at a time is put on tmpfs_base.
+
+    Parameters:
+    -----------
+    base : str, optional
+        Directory for disk-backed working directories. Default is TWD_BASE.
+    tmpfs_base : str, optional
+        Directory on a tmpfs (e.g. "/dev/shm") to prefer for working directories. Default is None (disk only).
+    tmpfs_max_bytes : int, optional
+        Maximum number of bytes the pool may use in tmpfs_base. Default is None (only limited by free space).
+    tmpfs_reserve_bytes : int, optional
+        Expected size of a working directory, reserved for each new directory on tmpfs_base
+        until one has been measured. Default is None.
+
+    Example:
+    --------
+    >>> pool = WorkdirPool(tmpfs_base="/dev/shm", tmpfs_max_bytes=2*1024**3)
+    >>> with pool.lease() as twd:
+    ...     wave, norm, flux = run_synth_lte(5000, 5100, 0.01, Teff=5000, logg=2.0, MH=-2.0, twd=twd)
+    >>> pool.close()
+    """
+    def __init__(self, base=None, tmpfs_base=None, tmpfs_max_bytes=None, tmpfs_reserve_bytes=None):
+        if base is None: base = TWD_BASE
+        self.base = base
+        self.tmpfs_base = tmpfs_base
+        self.tmpfs_max_bytes = tmpfs_max_bytes
+        self.tmpfs_reserve_bytes = tmpfs_reserve_bytes
+        self._lock = threading.Lock()
+        self._idle = []
+        self._sizes = {} # high water mark of the size of each directory, None until first released
+        self._leased = set()
+
+    def _is_tmpfs(self, twd):
+        return self.tmpfs_base is not None and os.path.dirname(twd) == os.path.abspath(self.tmpfs_base)
+
+    def _expected_bytes(self):
+        sizes = [size for size in self._sizes.values() if size]
+        return max(sizes) if sizes else self.tmpfs_reserve_bytes
+
+    def _tmpfs_bytes(self):
+        expected = self._expected_bytes() or 0
+        return sum(expected if size is None else size for twd, size in self._sizes.items() if self._is_tmpfs(twd))
+
+    def _tmpfs_has_room(self):
+        if self.tmpfs_base is None: return False
+        expected = self._expected_bytes()
+        if expected is None:
+            # Nothing to go by yet: measure one directory before putting more on tmpfs
+            if any(size is None and self._is_tmpfs(twd) for twd, size in self._sizes.items()):
+                return False
+            expected = 0
+        if self.tmpfs_max_bytes is not None and self._tmpfs_bytes() + expected > self.tmpfs_max_bytes:
+            return False
+        return shutil.disk_usage(self.tmpfs_base).free > 2*expected
+
+    def _create(self):
+        if self._tmpfs_has_room():
+            base = os.path.abspath(self.tmpfs_base)
+        else:
+            base = self.base
+        twd = tempfile.mkdtemp(prefix="tssynth_", dir=base)
+        os.symlink(TSDATA_PATH, os.path.join(twd, 'DATA'))
+        self._sizes[twd] = None
+        return twd
+
+    def acquire(self):
+        """
+        Lease a working directory. Prefer lease(), which also releases it.
+        """
+        with self._lock:
+            # Prefer idle tmpfs directories
+            self._idle.sort(key=self._is_tmpfs)
+            twd = self._idle.pop() if self._idle else self._create()
+            self._leased.add(twd)
+        return twd
+
+    def release(self, twd, keep=False):
+        """
+        Return a working directory to the pool.
+
+        If keep is True (e.g. the job failed), the directory is taken out of the pool and
+        its contents are kept for inspection; directories on tmpfs are moved to base first.
+        Returns the path of the kept directory, or None.
+        A directory that no longer exists (e.g. deleted by the job) is dropped from the pool.
+        """
+        if not os.path.isdir(twd):
+            with self._lock:
+                self._leased.discard(twd)
+                self._sizes.pop(twd, None)
+            return None
+        size = _directory_size(twd)
+        with self._lock:
+            self._leased.discard(twd)
+            if keep:
+                self._sizes.pop(twd, None)
+            else:
+                self._sizes[twd] = max(size, self._sizes.get(twd) or 0)
+                over_cap = self._is_tmpfs(twd) and self.tmpfs_max_bytes is not None and \
+                           self._tmpfs_bytes() > self.tmpfs_max_bytes
+                if over_cap: self._sizes.pop(twd)
+        if keep:
+            if self._is_tmpfs(twd):
+                kept = tempfile.mkdtemp(prefix="tssynth_failed_", dir=self.base)
+                os.rmdir(kept)
+                shutil.move(twd, kept)
+                return kept
+            return twd
+        if over_cap:
+            shutil.rmtree(twd, ignore_errors=True)
+            return None
+        _reset_directory(twd)
+        with self._lock:
+            self._idle.append(twd)
+        return None
+
+    @contextmanager
+    def lease(self):
+        """
+        Context manager yielding a working directory that is released afterwards.
+        If the block raises, the directory is kept for inspection (see release).
+        """
+        twd = self.acquire()
+        try:
+            yield twd
+        except BaseException:
+            kept = self.release(twd, keep=True)
+            print(f"Keeping twd {kept}")
+            raise
+        self.release(twd)
+
+    def close(self):
+        """
+        Delete all idle directories.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+            for twd in idle: self._sizes.pop(twd, None)
+        for twd in idle:
+            shutil.rmtree(twd, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _directory_size(twd):
+    total = 0
+    for entry in os.scandir(twd):
+        if entry.is_symlink(): continue
+        if entry.is_dir():
+            total += _directory_size(entry.path)
+        else:
+            total += entry.stat().st_size
+    return total
+
+def _reset_directory(twd):
+    """
+    Remove everything in twd except the DATA symlink.
+    """
+    for entry in os.scandir(twd):
+        if entry.name == 'DATA' and entry.is_symlink(): continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
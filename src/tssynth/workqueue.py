@@ -0,0 +1,314 @@
+"""
+Work queue for running run_synth_lte jobs on several nodes that share a filesystem.
+
+The queue is a SQLite database. Jobs are added with WorkQueue.submit, and any number of
+workers (run_worker, or `tssynth worker QUEUE` on the command line) on any node claim them
+one at a time, run them and write the results next to the database:
+  queue.db            the jobs, their status and leases
+  queue.db.results/   job_<id>.npz with wave, norm, flux of every finished job
+
+A claimed job is leased to its worker for lease_seconds, and the worker renews the lease
+while the job runs. If a worker dies, its lease runs out and the job goes back to pending;
+a job whose lease has run out max_attempts times is marked failed, so a job that kills
+its worker does not take down every worker in turn.
+
+SQLite needs working file locks (fcntl) on the shared filesystem; most NFS and Lustre
+setups have them, but check yours. The database is kept in rollback journal mode, since
+WAL mode does not work over network filesystems.
+"""
+import numpy as np
+import os, json, time, socket, sqlite3, threading, traceback
+from .synthesizer import _run_synth_lte_job
+
+WORKQUEUE_VERSION = 1
+JOB_PENDING, JOB_RUNNING, JOB_DONE, JOB_FAILED = "pending", "running", "done", "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    error TEXT,
+    submitted REAL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+"""
+
+class WorkQueue:
+    """
+    A queue of run_synth_lte jobs in a SQLite database.
+
+    Parameters:
+    -----------
+    path : str
+        Database file. Created if it does not exist.
+    lease_seconds : float, optional
+        How long a claimed job stays with its worker without a renewal (default: 600).
+        Workers renew the lease every lease_seconds/3 while the job runs.
+    max_attempts : int, optional
+        A job is marked failed after its lease has run out this many times (default: 3).
+    results_dir : str, optional
+        Directory of the results (default: path + ".results").
+
+    Example:
+    --------
+    >>> queue = WorkQueue("/shared/grids/giants.db")
+    >>> ids = queue.submit([dict(wmin=5000, wmax=5100, dw=0.01, Teff=T, logg=2.0, MH=-2.0)
+    ...                     for T in range(4500, 5500, 50)])
+    Then on each node: tssynth worker /shared/grids/giants.db --threads 16
+    >>> queue.counts()
+    {'pending': 0, 'running': 0, 'done': 20, 'failed': 0}
+    >>> wave, norm, flux = queue.result(ids[0])
+    """
+    def __init__(self, path, lease_seconds=600, max_attempts=3, results_dir=None):
+        self.path = os.path.abspath(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.results_dir = results_dir if results_dir is not None else self.path + ".results"
+        os.makedirs(self.results_dir, exist_ok=True)
+        db = self._connect()
+        try:
+            db.executescript(_SCHEMA)
+            db.execute("INSERT OR IGNORE INTO meta VALUES ('version', ?)", (str(WORKQUEUE_VERSION),))
+            version = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+        finally:
+            db.close()
+        if int(version) != WORKQUEUE_VERSION:
+            raise ValueError(f"{path} has work queue version {version}, expected {WORKQUEUE_VERSION}")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        db.execute("PRAGMA journal_mode=DELETE")
+        return db
+
+    def _transaction(self):
+        return _Transaction(self._connect())
+
+    def submit(self, jobs):
+        """
+        Add jobs (dicts of run_synth_lte keyword arguments) to the queue. Returns their ids.
+        The arguments must be JSON serializable; twd cannot be given, every job gets its own.
+        """
+        rows = []
+        now = time.time()
+        for job in jobs:
+            if "twd" in job:
+                raise ValueError("Each job runs in its own twd, twd cannot be specified.")
+            params = json.dumps(job)
+            if _decode_job(params) != job:
+                raise ValueError(f"Job does not survive JSON serialization: {job}")
+            rows.append((params, JOB_PENDING, now))
+        ids = []
+        with self._transaction() as db:
+            for row in rows:
+                ids.append(db.execute("INSERT INTO jobs (params, status, submitted) VALUES (?, ?, ?)", row).lastrowid)
+        return ids
+
+    def claim(self, worker):
+        """
+        Claim the next pending job for worker. Returns (id, job) or None if nothing is pending.
+        Jobs whose lease has run out are put back first.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET status = ?, error = 'lease expired ' || attempts || ' times', finished = ? "
+                       "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                       (JOB_FAILED, now, JOB_RUNNING, now, self.max_attempts))
+            db.execute("UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL "
+                       "WHERE status = ? AND lease_expires < ?", (JOB_PENDING, JOB_RUNNING, now))
+            row = db.execute("SELECT id, params FROM jobs WHERE status = ? ORDER BY id LIMIT 1",
+                             (JOB_PENDING,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                       "started = ? WHERE id = ?", (JOB_RUNNING, worker, now + self.lease_seconds, now, row[0]))
+        return row[0], _decode_job(row[1])
+
+    def renew(self, job_id, worker):
+        """
+        Extend the lease of a running job. Returns False if the job is no longer leased to worker.
+        """
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE jobs SET lease_expires = ? WHERE id = ? AND status = ? AND worker = ?",
+                                (time.time() + self.lease_seconds, job_id, JOB_RUNNING, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, result):
+        """
+        Save the result (wave, norm, flux) of a job and mark it done.
+        Returns False if the job was no longer leased to worker (e.g. its lease ran out and
+        another worker finished it); the result is saved anyway since it is the same spectrum.
+        """
+        wave, norm, flux = result
+        fname = self.result_filename(job_id)
+        tmpname = f"{fname}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(tmpname, wave=wave, norm=norm, flux=flux)
+        os.replace(tmpname, fname)
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE jobs SET status = ?, finished = ?, error = NULL, lease_expires = NULL "
+                                "WHERE id = ? AND worker = ? AND status = ?",
+                                (JOB_DONE, time.time(), job_id, worker, JOB_RUNNING))
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, error):
+        """
+        Mark a job failed with an error message.
+        """
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE jobs SET status = ?, finished = ?, error = ?, lease_expires = NULL "
+                                "WHERE id = ? AND worker = ? AND status = ?",
+                                (JOB_FAILED, time.time(), str(error), job_id, worker, JOB_RUNNING))
+        return cursor.rowcount == 1
+
+    def retry_failed(self):
+        """
+        Put every failed job back in the queue. Returns how many there were.
+        """
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE jobs SET status = ?, attempts = 0, worker = NULL, error = NULL "
+                                "WHERE status = ?", (JOB_PENDING, JOB_FAILED))
+        return cursor.rowcount
+
+    def counts(self):
+        """
+        Number of jobs with each status.
+        """
+        counts = {status: 0 for status in (JOB_PENDING, JOB_RUNNING, JOB_DONE, JOB_FAILED)}
+        with self._transaction() as db:
+            for status, n in db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+                counts[status] = n
+        return counts
+
+    def jobs(self, status=None):
+        """
+        List of dicts describing the jobs (id, job, status, attempts, worker, error, times),
+        optionally only those with a status.
+        """
+        query = "SELECT id, params, status, attempts, worker, error, submitted, started, finished FROM jobs"
+        args = ()
+        if status is not None:
+            query += " WHERE status = ?"
+            args = (status,)
+        with self._transaction() as db:
+            rows = db.execute(query + " ORDER BY id", args).fetchall()
+        return [dict(id=row[0], job=_decode_job(row[1]), status=row[2], attempts=row[3], worker=row[4],
+                     error=row[5], submitted=row[6], started=row[7], finished=row[8]) for row in rows]
+
+    def result_filename(self, job_id):
+        return os.path.join(self.results_dir, f"job_{job_id}.npz")
+
+    def result(self, job_id):
+        """
+        (wave, norm, flux) of a finished job.
+        """
+        with np.load(self.result_filename(job_id)) as data:
+            return data["wave"], data["norm"], data["flux"]
+
+class _Transaction:
+    """
+    BEGIN IMMEDIATE ... COMMIT on a connection, which is closed afterwards.
+    IMMEDIATE takes the write lock at the start, so two workers cannot claim the same job.
+    """
+    def __init__(self, db):
+        self.db = db
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.db.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            self.db.close()
+
+def _decode_job(params):
+    job = json.loads(params)
+    ## JSON turns atomic numbers in XFedict into strings
+    if isinstance(job.get("XFedict"), dict):
+        job["XFedict"] = {int(key) if key.isdigit() else key: value for key, value in job["XFedict"].items()}
+    return job
+
+def run_worker(queue, n_threads=1, max_jobs=None, wait=False, poll_interval=10.0, delete_twd=True,
+               retries=0, retry_backoff=1.0, quarantine_dir=None, worker_name=None):
+    """
+    Claim and run jobs from a WorkQueue until it is empty.
+
+    Parameters:
+    queue (WorkQueue or str): The queue, or the path of its database
+    n_threads (int): Number of jobs to run at the same time in this process (default: 1)
+    max_jobs (int): Stop after this many jobs (default: None, no limit)
+    wait (bool): Keep polling for new jobs when the queue is empty instead of stopping (default: False)
+        Without wait, a worker stops once nothing is pending or running; while jobs of other
+        workers are running it keeps polling, since their leases may run out.
+    poll_interval (float): Seconds between polls of an empty queue (default: 10)
+    delete_twd, retries, retry_backoff, quarantine_dir: Same as for synthesizer.run_synth_lte_batch
+    worker_name (str): Name of this worker in the queue (default: hostname:pid)
+
+    Returns:
+    dict: Number of jobs this worker finished (done) and failed.
+    """
+    if not isinstance(queue, WorkQueue):
+        queue = WorkQueue(queue)
+    if worker_name is None:
+        worker_name = f"{socket.gethostname()}:{os.getpid()}"
+    stats = dict(done=0, failed=0)
+    lock = threading.Lock()
+    claimed = [0]
+
+    def next_job(worker):
+        while True:
+            with lock:
+                if max_jobs is not None and claimed[0] >= max_jobs: return None
+                claim = queue.claim(worker)
+                if claim is not None:
+                    claimed[0] += 1
+                    return claim
+            counts = queue.counts()
+            if not wait and counts[JOB_PENDING] == 0 and counts[JOB_RUNNING] == 0: return None
+            time.sleep(poll_interval)
+
+    def work(ithread):
+        worker = f"{worker_name}:{ithread}"
+        while True:
+            claim = next_job(worker)
+            if claim is None: return
+            job_id, job = claim
+            print(f"Worker {worker} running job {job_id}")
+            stop = threading.Event()
+            renewer = threading.Thread(target=_renew_lease, args=(queue, job_id, worker, stop), daemon=True)
+            renewer.start()
+            try:
+                result = _run_synth_lte_job(job, delete_twd=delete_twd, retries=retries,
+                                            retry_backoff=retry_backoff, quarantine_dir=quarantine_dir)
+            finally:
+                stop.set()
+                renewer.join()
+            if isinstance(result, Exception):
+                queue.fail(job_id, worker, "".join(traceback.format_exception(type(result), result,
+                                                                             result.__traceback__)))
+                key = "failed"
+            else:
+                queue.complete(job_id, worker, result)
+                key = "done"
+            with lock:
+                stats[key] += 1
+
+    threads = [threading.Thread(target=work, args=(i,), name=f"tssynth-worker-{i}") for i in range(n_threads)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    print(f"Worker {worker_name} finished: {stats['done']} done, {stats['failed']} failed")
+    return stats
+
+def _renew_lease(queue, job_id, worker, stop):
+    while not stop.wait(queue.lease_seconds/3):
+        try:
+            if not queue.renew(job_id, worker):
+                print(f"Worker {worker} lost the lease of job {job_id}")
+                return
+        except sqlite3.Error as e:
+            print(f"Worker {worker} could not renew the lease of job {job_id}: {e}")
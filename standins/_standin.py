@@ -0,0 +1,189 @@
+"""
+Stand-in versions of the Turbospectrum programs babsma_lu and bsyn_lu and of the MARCS
+interpolator interpol_modeles, for testing the orchestration in tssynth without the Fortran
+codes or the MARCS grid. Only the standard library is used, so starting one is cheap.
+
+They read the same control files on stdin as the real programs, check that the files they
+name exist, spend a configurable amount of time, and write outputs of the right shape:
+  babsma_lu         writes MODELOPAC, with one line per depth point of the model atmosphere
+  bsyn_lu           writes RESULTFILE with wave, norm, flux for every wavelength step,
+                    with a Gaussian absorption line for each line in the line lists
+  interpol_modeles  writes the interpolated model in the babsma format, with the
+                    structure of the first of the 8 input models
+The spectra are not physical.
+
+Behaviour is set with environment variables. Each can also be given for one program,
+e.g. TSSTANDIN_BSYN_LU_SLEEP overrides TSSTANDIN_SLEEP for bsyn_lu only.
+  TSSTANDIN_SLEEP      seconds to sleep (default 0)
+  TSSTANDIN_CPU        seconds of CPU to burn (default 0)
+  TSSTANDIN_FAIL       exit with this status without writing output
+  TSSTANDIN_FAIL_RATE  fraction of runs that fail with status 1, at random
+"""
+import os, sys, re, time, math, random
+
+def setting(program, name, default=None):
+    value = os.environ.get(f"TSSTANDIN_{program.upper()}_{name}")
+    if value is None:
+        value = os.environ.get(f"TSSTANDIN_{name}", default)
+    return value
+
+def spend_time(program):
+    """
+    Sleep and burn CPU as configured, then fail if configured to.
+    """
+    sleep = float(setting(program, "SLEEP", 0))
+    if sleep > 0:
+        time.sleep(sleep)
+    cpu = float(setting(program, "CPU", 0))
+    if cpu > 0:
+        start = time.process_time()
+        x = 0.0
+        while time.process_time() - start < cpu:
+            for i in range(10000):
+                x += math.sqrt(i)
+    fail = setting(program, "FAIL")
+    if fail:
+        print(f"{program}: failing with status {fail} (TSSTANDIN_FAIL)", file=sys.stderr)
+        sys.exit(int(fail))
+    fail_rate = float(setting(program, "FAIL_RATE", 0))
+    if fail_rate > 0 and random.random() < fail_rate:
+        print(f"{program}: failing at random (TSSTANDIN_FAIL_RATE={fail_rate})", file=sys.stderr)
+        sys.exit(1)
+
+def parse_control(text):
+    """
+    Keys and values of a babsma_lu/bsyn_lu control file, e.g. 'LAMBDA_MIN:'  '5000.000'.
+    Lines that follow a key with a count (individual abundances, isotopes, line lists) are
+    returned in a list under that key.
+    """
+    control = {}
+    lines = text.splitlines()
+    i = 0
+    while i < len(lines):
+        match = re.match(r"\s*'([^']*)'\s*'([^']*)'", lines[i])
+        i += 1
+        if match is None: continue
+        key, value = match.group(1).strip().rstrip(":").strip(), match.group(2).strip()
+        control[key] = value
+        if key in ("INDIVIDUAL ABUNDANCES", "ISOTOPES", "NFILES"):
+            n = int(value)
+            control[key + " LINES"] = [line.strip() for line in lines[i:i+n]]
+            i += n
+    for key in ("LAMBDA_MIN", "LAMBDA_MAX", "LAMBDA_STEP"):
+        if key not in control:
+            raise ValueError(f"Control file has no {key}")
+    return control
+
+def check_exists(program, fname):
+    if not os.path.exists(fname):
+        print(f"{program}: {fname} does not exist", file=sys.stderr)
+        sys.exit(2)
+
+def model_depths(fname, marcsfile):
+    """
+    Number of depth points of a MARCS .mod file or an interpolated model.
+    """
+    with open(fname) as fp:
+        lines = fp.readlines()
+    if marcsfile:
+        for line in lines:
+            if line.strip().endswith("Number of depth points"):
+                return int(line.split()[0])
+        raise ValueError(f"{fname} is not a MARCS model")
+    return int(lines[0].split()[1])
+
+def npixels(control):
+    wmin, wmax, dw = (float(control[key]) for key in ("LAMBDA_MIN", "LAMBDA_MAX", "LAMBDA_STEP"))
+    return wmin, dw, int(round((wmax - wmin)/dw)) + 1
+
+def main_babsma_lu():
+    program = "babsma_lu"
+    control = parse_control(sys.stdin.read())
+    modelfilename, modelopacname = control["MODELINPUT"], control["MODELOPAC"]
+    check_exists(program, modelfilename)
+    ndepth = model_depths(modelfilename, control.get("MARCS-FILE", ".true.").lower() == ".true.")
+    spend_time(program)
+    wmin, dw, npix = npixels(control)
+    with open(modelopacname, "w") as fp:
+        fp.write(f"standin-babsma_lu {ndepth} {wmin:.3f} {dw:.3f} {npix} {control.get('METALLICITY', '0.0')}\n")
+        for k in range(ndepth):
+            tau = -5.0 + 7.0*k/max(ndepth - 1, 1)
+            fp.write(f"{k+1:4d} {tau:8.4f} {1e-3*10**tau:12.5E}\n")
+    return 0
+
+def read_lines(linelist_filename, wmin, wmax):
+    """
+    Wavelengths and log gf of the lines in [wmin, wmax] of a Turbospectrum line list.
+    """
+    lines = []
+    expect_comment = False
+    with open(linelist_filename) as fp:
+        for line in fp:
+            if expect_comment:
+                expect_comment = False
+            elif line.startswith("'"):
+                expect_comment = True
+            elif line.strip():
+                cols = line.split()
+                wave = float(cols[0])
+                if wmin <= wave <= wmax:
+                    try: loggf = float(cols[2])
+                    except (IndexError, ValueError): loggf = 0.0
+                    lines.append((wave, loggf))
+    return lines
+
+def main_bsyn_lu():
+    program = "bsyn_lu"
+    control = parse_control(sys.stdin.read())
+    check_exists(program, control["MODELOPAC"])
+    linelist_filenames = control.get("NFILES LINES", [])
+    for linelist_filename in linelist_filenames:
+        check_exists(program, linelist_filename)
+    spend_time(program)
+    wmin, dw, npix = npixels(control)
+    wmax = wmin + (npix - 1)*dw
+    norm = [1.0]*npix
+    width = 0.05 # A
+    for linelist_filename in linelist_filenames:
+        for wave, loggf in read_lines(linelist_filename, wmin - 5*width, wmax + 5*width):
+            depth = 0.8/(1 + math.exp(-(loggf + 2.0)))
+            lo = max(int((wave - 5*width - wmin)/dw), 0)
+            hi = min(int((wave + 5*width - wmin)/dw) + 1, npix)
+            for i in range(lo, hi):
+                norm[i] *= 1 - depth*math.exp(-0.5*((wmin + i*dw - wave)/width)**2)
+    with open(control["RESULTFILE"], "w") as fp:
+        for i in range(npix):
+            wave = wmin + i*dw
+            fp.write("%11.3f %10.5f %12.5E\n" % (wave, norm[i], 1e15*(5000.0/wave)**2*norm[i]))
+    return 0
+
+def main_interpol_modeles():
+    program = "interpol_modeles"
+    lines = [line.strip() for line in sys.stdin.read().splitlines() if line.strip()]
+    values = [line.strip("'") for line in lines]
+    model_filenames = values[:8]
+    outfilename = values[8]
+    logg = float(values[11])
+    for fname in model_filenames:
+        check_exists(program, fname)
+    spend_time(program)
+    with open(model_filenames[0]) as fp:
+        model = fp.readlines()
+    spherical = float(model[7].split()[0]) > 1
+    for i, line in enumerate(model):
+        if line.strip().endswith("Number of depth points"):
+            ndepth = int(line.split()[0])
+            structure = [line.split() for line in model[i+3:i+3+ndepth]]
+            break
+    else:
+        raise ValueError(f"{model_filenames[0]} is not a MARCS model")
+    with open(outfilename, "w") as fp:
+        name = "sphINTERPOL" if spherical else "ppINTERPOL"
+        fp.write(f"'{name}' {ndepth:3d}{5000.0:8.0f}  {logg:4.2f} 0 0.00\n")
+        for row in structure:
+            lgTauR, lgTau5, depth, T, Pe, Pg = (float(x) for x in row[1:7])
+            fp.write(f"{lgTau5:8.4f} {T:8.2f} {math.log10(Pe):8.4f} {math.log10(Pg):8.4f} {2.0:8.4f} "
+                     f"{depth:15.6E} {lgTauR:8.4f}\n")
+        for fname in model_filenames:
+            fp.write(f"{fname}\n")
+    return 0
@@ -0,0 +1,59 @@
+from tssynth import broadening
+from tssynth.utils import SPEED_OF_LIGHT
+import numpy as np
+
+def line_spectrum(wave, centers, depth=0.5, sigma=0.005):
+    norm = np.ones_like(wave)
+    for center in centers:
+        norm -= depth*np.exp(-0.5*((wave - center)/sigma)**2)
+    return norm
+
+def fwhm(wave, norm):
+    depth = 1 - norm
+    above = wave[depth >= depth.max()/2]
+    return above[-1] - above[0]
+
+def test_gaussian_broadening():
+    wave = np.arange(5000, 5020, 0.001)
+    norm = line_spectrum(wave, [5010.0])
+    R = 20000
+    broad = broadening.broaden(wave, norm, R=R)
+    # Equivalent width is conserved and the line gets the instrumental width
+    assert np.isclose(np.sum(1 - broad), np.sum(1 - norm), rtol=1e-3)
+    expected = np.sqrt((5010/R)**2 + (2.3548*0.005)**2)
+    assert np.isclose(fwhm(wave, broad), expected, rtol=0.02)
+    # Per-pixel R that is constant gives the same answer
+    broad_var = broadening.broaden(wave, norm, R=np.full(len(wave), R))
+    assert np.allclose(broad_var, broad, atol=1e-4)
+    # Continuum stays at 1 at the edges
+    assert np.allclose(broad[:100], 1) and np.allclose(broad[-100:], 1)
+
+def test_broaden_batch():
+    wave = np.arange(5000, 5020, 0.01)
+    batch = np.array([line_spectrum(wave, [5005.0 + i, 5012.0]) for i in range(5)])
+    broad = broadening.broaden(wave, batch, R=30000, vsini=8.0, vmacro=3.0)
+    assert broad.shape == batch.shape
+    for i in range(len(batch)):
+        assert np.allclose(broad[i], broadening.broaden(wave, batch[i], R=30000, vsini=8.0, vmacro=3.0))
+    R = np.linspace(20000, 40000, len(wave))
+    broad = broadening.broaden(wave, batch, R=R)
+    assert np.allclose(broad[2], broadening.broaden(wave, batch[2], R=R))
+
+def test_kernels():
+    dv = 0.1
+    for kernel in [broadening.gaussian_kernel(dv, 5.0), broadening.rotation_kernel(dv, 10.0),
+                   broadening.macroturbulence_kernel(dv, 4.0)]:
+        assert len(kernel) % 2 == 1
+        assert np.isclose(kernel.sum(), 1)
+        assert np.allclose(kernel, kernel[::-1])
+        assert np.all(kernel >= 0)
+    # Rotation kernel goes to zero at vsini
+    v = dv*(np.arange(len(broadening.rotation_kernel(dv, 10.0))) - 100)
+    assert np.all(broadening.rotation_kernel(dv, 10.0)[np.abs(v) >= 10.0] < 1e-3)
+    # FFT convolution matches direct convolution away from the edges
+    rng = np.random.default_rng(1)
+    flux = 1 + 0.1*rng.standard_normal(2000)
+    kernel = broadening.rotation_kernel(dv, 10.0)
+    direct = np.convolve(flux, kernel, mode="same")
+    fft = broadening.convolve_fft(flux, kernel)
+    assert np.allclose(fft[200:-200], direct[200:-200])
@@ -0,0 +1,123 @@
+from tssynth import cache, utils, synthesizer
+import os, shutil, time
+import numpy as np
+
+model_atmosphere_file = os.path.join(os.path.dirname(__file__), "model_atmospheres",
+    "s5000_g+2.0_m1.0_t02_st_z-2.00_a+0.40_c+0.00_n+0.00_o+0.40_r+0.00_s+0.00.mod")
+
+def test_mopac_cache_key():
+    twd = utils.mkdtemp()
+    kws = dict(wmin=5000, wmax=5100, dw=0.1, costheta=None,
+               modelfilename=model_atmosphere_file, marcsfile=True,
+               metals=-2.0, alphafe=0.4, vmicro=2.0, spherical=True,
+               resultfilename=None, isotopes=None, linelistfilenames=None, bsyn=False)
+    fname1, fname2, fname3 = [os.path.join(twd, f"babsma{i}.par") for i in range(3)]
+    synthesizer._write_script(fname1, modelopacname=os.path.join(twd, "mopac1"), indiv_abu={}, **kws)
+    synthesizer._write_script(fname2, modelopacname=os.path.join(twd, "mopac2"), indiv_abu={}, **kws)
+    synthesizer._write_script(fname3, modelopacname=os.path.join(twd, "mopac3"), indiv_abu={26: -2.2}, **kws)
+    key1 = cache.mopac_cache_key(fname1, model_atmosphere_file, True)
+    key2 = cache.mopac_cache_key(fname2, model_atmosphere_file, True)
+    key3 = cache.mopac_cache_key(fname3, model_atmosphere_file, True)
+    assert key1 == key2
+    assert key1 != key3
+    assert key1 != cache.mopac_cache_key(fname1, model_atmosphere_file, False)
+    shutil.rmtree(twd)
+
+def test_mopac_cache_lru():
+    twd = utils.mkdtemp()
+    mopac_cache = cache.MopacCache(os.path.join(twd, "cache"), max_entries=2)
+    src = os.path.join(twd, "mopac")
+    with open(src, "w") as fp: fp.write("opacity")
+    dest = os.path.join(twd, "mopac_copy")
+    assert not mopac_cache.get("a", dest)
+    mopac_cache.put("a", src)
+    time.sleep(0.01)
+    mopac_cache.put("b", src)
+    time.sleep(0.01)
+    assert mopac_cache.get("a", dest) # a is now more recently used than b
+    with open(dest) as fp: assert fp.read() == "opacity"
+    time.sleep(0.01)
+    mopac_cache.put("c", src)
+    assert len(mopac_cache.entries()) == 2
+    assert not mopac_cache.get("b", dest)
+    assert mopac_cache.get("a", dest)
+    shutil.rmtree(twd)
+
+def test_cache_eviction_is_batched():
+    twd = utils.mkdtemp()
+    mopac_cache = cache.MopacCache(os.path.join(twd, "cache"), max_entries=100)
+    src = os.path.join(twd, "mopac")
+    with open(src, "w") as fp: fp.write("opacity")
+    listings = []
+    entries = mopac_cache.entries
+    mopac_cache.entries = lambda: listings.append(1) or entries()
+    for i in range(300):
+        mopac_cache.put(f"key{i}", src)
+        assert len(entries()) <= 100
+    assert len(listings) < 30 # not once per put
+    mopac_cache.max_entries = 5
+    mopac_cache.evict()
+    assert len(entries()) == 5
+    shutil.rmtree(twd)
+
+def test_spectrum_cache():
+    twd = utils.mkdtemp()
+    spectrum_cache = cache.SpectrumCache(os.path.join(twd, "cache"), max_memory_entries=1, max_entries=2)
+    wave = np.linspace(5000, 5100, 101)
+    spectrum = (wave, np.ones_like(wave), 1e15*np.ones_like(wave))
+    assert spectrum_cache.get("a") is None
+    spectrum_cache.put("a", spectrum)
+    time.sleep(0.01)
+    spectrum_cache.put("b", spectrum)
+    time.sleep(0.01)
+    spectrum_cache.get("b")[1][:] = 0 # changing the result does not change the cache
+    assert np.all(spectrum_cache.get("b")[1] == 1) # memory
+    assert np.all(spectrum_cache.get("a")[0] == wave) # disk, now more recently used than b on disk
+    time.sleep(0.01)
+    stats = spectrum_cache.stats()
+    assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (2, 1, 1)
+    spectrum_cache.put("c", spectrum)
+    assert len(spectrum_cache.entries()) == 2
+    # Other processes only see the disk
+    other = cache.SpectrumCache(os.path.join(twd, "cache"))
+    assert other.get("b") is None
+    assert other.get("c") is not None
+    with open(other._path("d"), "w") as fp: fp.write("not a npz file")
+    assert other.get("d") is None
+    assert not os.path.exists(other._path("d"))
+    shutil.rmtree(twd)
+
+def test_spectrum_cache_key():
+    twd = utils.mkdtemp()
+    linelist = os.path.join(twd, "linelist")
+    with open(linelist, "w") as fp: fp.write("'  26.000              '    1         0\n'FeI'\n")
+    def key(**kws):
+        args = dict(wmin=5000, wmax=5100, dw=0.01, Teff=None, logg=None, vt=2.0, MH=None, aFe=None,
+                    model_atmosphere_file=model_atmosphere_file, linelist_filenames=[linelist],
+                    trim_linelists=False, linelist_margin=10.0, XFedict=None, modelopac_file=None, spherical=None)
+        args.update(kws)
+        _, key, _ = synthesizer._check_spectrum_cache(os.path.join(twd, "cache"), **args)
+        return key
+    assert key() == key(wmin=5000.0, linelist_filenames=linelist)
+    assert key() != key(dw=0.02)
+    assert key(XFedict={"Eu": 0.5}) == key(XFedict={63: 0.5})
+    assert key(XFedict={"Eu": 0.5}) != key(XFedict={"Eu": 0.6})
+    interp = dict(model_atmosphere_file=None, Teff=5000, logg=2.0, MH=-2.0)
+    assert key(**interp) == key(**interp, aFe=0.4, spherical=True)
+    assert key(**interp) != key(**interp, aFe=0.2)
+    key1 = key()
+    with open(linelist, "a") as fp: fp.write("'  63.000              '    1         0\n'EuI'\n")
+    assert key() != key1
+    shutil.rmtree(twd)
+
+def test_shared_cache():
+    twd = utils.mkdtemp()
+    path = os.path.join(twd, "cache")
+    spectrum_cache = cache.SpectrumCache.shared(path)
+    assert cache.SpectrumCache.shared(path + "/") is spectrum_cache
+    assert cache.MopacCache.shared(path) is not spectrum_cache
+    wave = np.linspace(5000, 5100, 101)
+    spectrum_cache.put("a", (wave, np.ones_like(wave), np.ones_like(wave)))
+    assert cache.SpectrumCache.shared(path).get("a") is not None
+    assert spectrum_cache.stats()["memory_hits"] == 1
+    shutil.rmtree(twd)
@@ -0,0 +1,52 @@
+from tssynth import grid, utils
+from tssynth.emulator import SpectralEmulator
+import os, shutil
+import numpy as np
+
+def make_linear_grid(outdir):
+    """ Grid whose spectra are linear in the parameters, so multilinear interpolation is exact """
+    axes = grid._normalize_axes(dict(Teff=[4500, 4750, 5000], logg=[1.0, 2.0], MH=[-2.0, -3.0], Eu=[0.0]))
+    metadata = dict(version=grid.GRID_VERSION, axes=axes, wmin=5000.0, wmax=5010.0, dw=0.01,
+                    npix=1001, dtype=np.dtype(np.float64).str, kwargs={})
+    grid._create_grid(outdir, metadata)
+    spectral_grid = grid.SpectralGrid(outdir, mode="r+")
+    for i in range(len(spectral_grid)):
+        p = spectral_grid.params(i)
+        spectral_grid.norm[i] = linear_spectrum(spectral_grid.wave, p["Teff"], p["logg"], p["MH"])
+        spectral_grid.status[i] = grid.GRID_STATUS_DONE
+    spectral_grid.norm.flush()
+    spectral_grid.status.flush()
+    return spectral_grid
+
+def linear_spectrum(wave, Teff, logg, MH):
+    return 1 - 1e-5*Teff*np.sin(wave) + 0.01*logg + 0.05*MH*np.cos(wave)
+
+def test_emulator():
+    twd = utils.mkdtemp()
+    outdir = os.path.join(twd, "grid")
+    spectral_grid = make_linear_grid(outdir)
+    emulator = SpectralEmulator(outdir)
+    assert emulator.names == ["Teff", "logg", "MH", "Eu"]
+    # One query
+    norm = emulator([4600, 1.3, -2.2, 0.0])
+    assert norm.shape == emulator.wave.shape
+    assert np.allclose(norm, linear_spectrum(emulator.wave, 4600, 1.3, -2.2))
+    # Grid points and a batch of queries
+    rng = np.random.default_rng(42)
+    N = 200
+    params = np.array([rng.uniform(4500, 5000, N), rng.uniform(1.0, 2.0, N), rng.uniform(-3.0, -2.0, N), np.zeros(N)]).T
+    params[0] = [5000, 2.0, -3.0, 0.0]
+    norms = emulator(params)
+    assert norms.shape == (N, len(emulator.wave))
+    for i in range(N):
+        assert np.allclose(norms[i], linear_spectrum(emulator.wave, *params[i, :3]))
+    assert np.allclose(emulator(Teff=params[:,0], logg=params[:,1], MH=params[:,2], Eu=0.0), norms)
+    # Outside the grid, or next to a missing cell
+    assert np.all(np.isnan(emulator([5100, 1.5, -2.5, 0.0])))
+    assert np.all(np.isnan(emulator([4600, 1.5, -2.5, 0.2])))
+    spectral_grid.status[spectral_grid.index(Teff=4750, logg=2.0, MH=-2.0, Eu=0.0)] = grid.GRID_STATUS_MISSING
+    spectral_grid.status.flush()
+    emulator = SpectralEmulator(outdir, in_memory=False)
+    assert np.all(np.isnan(emulator([4600, 1.5, -2.5, 0.0])))
+    assert np.all(np.isfinite(emulator([4600, 1.0, -2.5, 0.0]))) # the missing cell has zero weight
+    shutil.rmtree(twd)
@@ -0,0 +1,150 @@
+from tssynth import synthesizer, utils, workdir
+import os, json, time, shutil, errno, threading
+
+STANDINS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "standins")
+model_atmosphere_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_atmospheres",
+                                     "s5000_g+2.0_m1.0_t02_st_z-2.00_a+0.40_c+0.00_n+0.00_o+0.40_r+0.00_s+0.00.mod")
+linelist_filename = os.path.join(os.path.dirname(STANDINS_PATH), "data", "linelists", "vald-3700-3800-for-grid-nlte-04sep2023")
+job = dict(wmin=3750, wmax=3751, dw=0.01, model_atmosphere_file=model_atmosphere_file,
+           linelist_filenames=[linelist_filename])
+
+def run_with_standins(func, exec_path=STANDINS_PATH, **env):
+    old_path, old_env = synthesizer.TSEXEC_PATH, dict(os.environ)
+    synthesizer.TSEXEC_PATH = exec_path
+    os.environ.update(env)
+    try:
+        return func()
+    finally:
+        synthesizer.TSEXEC_PATH = old_path
+        os.environ.clear()
+        os.environ.update(old_env)
+
+def test_exit_code_is_checked():
+    twd = utils.mkdtemp()
+    try:
+        run_with_standins(lambda: synthesizer.run_synth_lte(twd=twd, **job), TSSTANDIN_BSYN_LU_FAIL="2")
+        assert False, "should have raised"
+    except utils.TurbospectrumError as e:
+        assert e.executable == "bsyn_lu"
+        assert e.returncode == 2
+        assert not e.timed_out and not e.transient
+    shutil.rmtree(twd)
+
+def test_stage_timeout_kills():
+    twd = utils.mkdtemp()
+    start = time.time()
+    try:
+        run_with_standins(lambda: synthesizer.run_synth_lte(twd=twd, stage_timeout={"babsma_lu": 0.5}, **job),
+                          TSSTANDIN_BABSMA_LU_SLEEP="30")
+        assert False, "should have raised"
+    except utils.TurbospectrumError as e:
+        assert e.executable == "babsma_lu"
+        assert e.timed_out and e.transient
+    assert time.time() - start < 10
+    shutil.rmtree(twd)
+
+def test_batch_retry_and_quarantine():
+    base = utils.mkdtemp()
+    quarantine_dir = os.path.join(base, "quarantine")
+    ## bsyn_lu that is killed by a signal the first time it runs in a twd
+    exec_path = os.path.join(base, "exec")
+    os.makedirs(exec_path)
+    os.symlink(os.path.join(STANDINS_PATH, "babsma_lu"), os.path.join(exec_path, "babsma_lu"))
+    with open(os.path.join(exec_path, "bsyn_lu"), "w") as fp:
+        fp.write("#!/bin/sh\n"
+                 "if [ ! -e crashed ]; then touch crashed; kill -9 $$; fi\n"
+                 f"exec {os.path.join(STANDINS_PATH, 'bsyn_lu')}\n")
+    os.chmod(os.path.join(exec_path, "bsyn_lu"), 0o755)
+
+    results = run_with_standins(lambda: synthesizer.run_synth_lte_batch([job, job], n_workers=2, retries=1,
+                                                                        retry_backoff=0.01,
+                                                                        quarantine_dir=quarantine_dir),
+                                exec_path=exec_path)
+    for result in results:
+        assert not isinstance(result, Exception), result
+        assert len(result[0]) == 101
+    assert not os.path.exists(quarantine_dir)
+
+    ## Without retries the crash is quarantined
+    results = run_with_standins(lambda: synthesizer.run_synth_lte_batch([job], retries=0,
+                                                                        quarantine_dir=quarantine_dir),
+                                exec_path=exec_path)
+    assert isinstance(results[0], utils.TurbospectrumError)
+    assert results[0].returncode == -9
+    quarantined = os.listdir(quarantine_dir)
+    assert len(quarantined) == 1
+    with open(os.path.join(quarantine_dir, quarantined[0], "failure.json")) as fp:
+        failure = json.load(fp)
+    assert failure["executable"] == "bsyn_lu"
+    assert failure["attempts"] == 1
+    assert os.path.exists(os.path.join(quarantine_dir, quarantined[0], "bsyn.par"))
+    shutil.rmtree(base)
+
+def test_batch_does_not_retry_errors():
+    base = utils.mkdtemp()
+    quarantine_dir = os.path.join(base, "quarantine")
+    start = time.time()
+    results = run_with_standins(lambda: synthesizer.run_synth_lte_batch([job], retries=3, retry_backoff=5,
+                                                                        quarantine_dir=quarantine_dir),
+                                TSSTANDIN_BSYN_LU_FAIL="1")
+    assert isinstance(results[0], utils.TurbospectrumError)
+    assert time.time() - start < 5
+    with open(os.path.join(quarantine_dir, os.listdir(quarantine_dir)[0], "failure.json")) as fp:
+        assert json.load(fp)["attempts"] == 1
+    shutil.rmtree(base)
+
+def test_batch_pool_ignores_delete_twd():
+    base = utils.mkdtemp()
+    pool = workdir.WorkdirPool(base=base)
+    results = run_with_standins(lambda: synthesizer.run_synth_lte_batch([dict(job, delete_twd=True)]*2, n_workers=1,
+                                                                        twd_pool=pool))
+    for result in results:
+        assert not isinstance(result, Exception), result
+    assert len(pool._idle) == 1 and os.path.isdir(pool._idle[0])
+    pool.close()
+    shutil.rmtree(base)
+
+def test_batch_does_not_retry_missing_files():
+    start = time.time()
+    results = run_with_standins(lambda: synthesizer.run_synth_lte_batch(
+        [dict(job, linelist_filenames=["/nonexistent/linelist"])], retries=2, retry_backoff=5))
+    assert isinstance(results[0], FileNotFoundError)
+    assert time.time() - start < 5
+    assert synthesizer._is_transient(OSError(errno.EIO, "Input/output error"))
+    assert not synthesizer._is_transient(PermissionError(errno.EACCES, "Permission denied"))
+
+def test_batch_does_not_retry_missing_output():
+    ## Like a Fortran STOP: exit status 0 without writing the output
+    base = utils.mkdtemp()
+    quarantine_dir = os.path.join(base, "quarantine")
+    start = time.time()
+    results = run_with_standins(lambda: synthesizer.run_synth_lte_batch([job], retries=2, retry_backoff=5,
+                                                                        quarantine_dir=quarantine_dir),
+                                TSSTANDIN_FAIL="0")
+    assert isinstance(results[0], utils.TurbospectrumError)
+    assert results[0].returncode == 0 and not results[0].transient
+    assert time.time() - start < 5
+    with open(os.path.join(quarantine_dir, os.listdir(quarantine_dir)[0], "failure.json")) as fp:
+        assert json.load(fp)["attempts"] == 1
+    shutil.rmtree(base)
+
+def test_pipeline_survives_failing_pool():
+    from tssynth.pipeline import SynthesisPipeline
+    class FailingPool(workdir.WorkdirPool):
+        def release(self, twd, keep=False):
+            if keep: raise OSError("cannot move the twd")
+            return super().release(twd, keep=keep)
+    base = utils.mkdtemp()
+    pool = FailingPool(base=base)
+    pipeline = SynthesisPipeline(n_workers=1, twd_pool=pool)
+    results = []
+    thread = threading.Thread(target=lambda: results.extend(
+        run_with_standins(lambda: pipeline.run([job]*6), TSSTANDIN_BSYN_LU_FAIL="1")), daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), "pipeline hangs"
+    assert len(results) == 6
+    assert all(isinstance(result, utils.TurbospectrumError) for result in results)
+    assert pipeline.stats["bsyn"]["failed"] == 6
+    pool.close()
+    shutil.rmtree(base)
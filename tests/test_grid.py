@@ -0,0 +1,48 @@
+from tssynth import grid, utils
+import os, shutil
+import numpy as np
+
+def test_grid_layout():
+    twd = utils.mkdtemp()
+    axes = grid._normalize_axes(dict(Teff=[4500, 4600], logg=2.0, MH=[-2.0, -2.5, -3.0], Eu=[0.0, 0.5]))
+    metadata = dict(version=grid.GRID_VERSION, axes=axes, wmin=5000.0, wmax=5010.0, dw=0.05,
+                    npix=201, dtype=np.dtype(np.float32).str, kwargs={})
+    grid._create_grid(os.path.join(twd, "grid"), metadata)
+    spectral_grid = grid.SpectralGrid(os.path.join(twd, "grid"))
+    assert len(spectral_grid) == 12
+    assert spectral_grid.shape == (2, 1, 3, 2)
+    assert spectral_grid.flux.shape == (12, 201)
+    assert len(spectral_grid.missing()) == 12
+    for i in range(len(spectral_grid)):
+        assert spectral_grid.index(**spectral_grid.params(i)) == i
+    job = spectral_grid.job(spectral_grid.index(Teff=4600, logg=2.0, MH=-2.5, Eu=0.5), XFedict={"Ba": -1.0})
+    assert job["Teff"] == 4600 and job["logg"] == 2.0 and job["MH"] == -2.5
+    assert job["XFedict"] == {"Ba": -1.0, "Eu": 0.5}
+    try:
+        grid._normalize_axes(dict(Teff=[4500], Foo=[1.0]))
+        assert False, "should have rejected the axis"
+    except ValueError:
+        pass
+    shutil.rmtree(twd)
+
+def test_build_grid():
+    twd = utils.mkdtemp()
+    outdir = os.path.join(twd, "grid")
+    axes = dict(Teff=[5000, 5050], logg=[2.0], MH=[-2.0])
+    spectral_grid = grid.build_grid(outdir, axes, 5090, 5100, 0.05, n_workers=2)
+    assert np.all(spectral_grid.status == grid.GRID_STATUS_DONE)
+    flux = np.array(spectral_grid.flux)
+    # Resume after losing a cell
+    status = np.load(os.path.join(outdir, "status.npy"), mmap_mode="r+")
+    status[1] = grid.GRID_STATUS_MISSING
+    status.flush()
+    del status
+    spectral_grid = grid.build_grid(outdir, axes, 5090, 5100, 0.05, n_workers=2)
+    assert np.all(spectral_grid.status == grid.GRID_STATUS_DONE)
+    assert np.allclose(spectral_grid.flux, flux)
+    try:
+        grid.build_grid(outdir, axes, 5090, 5101, 0.05)
+        assert False, "should not resume a different grid"
+    except ValueError:
+        pass
+    shutil.rmtree(twd)
@@ -0,0 +1,60 @@
+from tssynth import linelists, utils
+import os, shutil
+
+linelist_dir = os.path.join(os.path.dirname(__file__), "..", "data", "linelists")
+vald_linelist = os.path.join(linelist_dir, "vald-9300-9800-for-grid-nlte-04sep2023")
+
+def test_build_linelist_catalog():
+    catalog = linelists.build_linelist_catalog(os.path.join(linelist_dir, "Hlinedata"))
+    assert len(catalog["blocks"]) == 1
+    assert catalog["blocks"][0]["nlines"] == 133
+    assert catalog["blocks"][0]["species"] == "01.000000"
+
+    catalog = linelists.build_linelist_catalog(vald_linelist)
+    for block in catalog["blocks"]:
+        assert block["nlines"] == int(block["header"].split()[-1]), block["header"]
+    wmin, wmax = linelists.get_linelist_wavelength_range(vald_linelist)
+    assert 9300 <= wmin < wmax <= 9800
+
+def test_trim_linelist():
+    twd = utils.mkdtemp()
+    wmin, wmax = 9400, 9410
+    outfname = os.path.join(twd, "trimmed")
+    N = linelists.trim_linelist(vald_linelist, wmin, wmax, outfname)
+    N_expected = 0
+    with open(vald_linelist) as fp:
+        for line in fp:
+            if line.startswith("'"): continue
+            N_expected += wmin <= float(line.split()[0]) <= wmax
+    assert N == N_expected
+    catalog = linelists.build_linelist_catalog(outfname)
+    assert sum(block["nlines"] for block in catalog["blocks"]) == N
+    for block in catalog["blocks"]:
+        assert block["nlines"] == int(block["header"].split()[-1]), block["header"]
+        assert wmin <= block["wmin"] and block["wmax"] <= wmax
+
+    staged = linelists.stage_trimmed_linelists([os.path.join(linelist_dir, "Hlinedata"), vald_linelist,
+                                                os.path.join(linelist_dir, "vald-3700-3800-for-grid-nlte-04sep2023")],
+                                               wmin, wmax, twd)
+    assert len(staged) == 2 # H is always kept, 3700-3800 has no lines here
+    shutil.rmtree(twd)
+
+def test_linelist_store():
+    twd = utils.mkdtemp()
+    store_directory = os.path.join(twd, "store")
+    linelists.compile_linelist_store([os.path.join(linelist_dir, "Hlinedata"), vald_linelist], store_directory)
+    store = linelists.LineListStore(store_directory)
+    wmin, wmax = 9400, 9410
+    N_trimmed = linelists.trim_linelist(vald_linelist, wmin, wmax, os.path.join(twd, "trimmed"))
+    selected = store.query(wmin, wmax)
+    assert sum(len(lines) for group, lines in selected) == N_trimmed
+    for group, lines in store.query(wmin, wmax, species=26, loggf_min=-2):
+        assert int(float(group["species"])) == 26
+        assert (lines["loggf"] >= -2).all()
+        assert (lines["wave"] >= wmin).all() and (lines["wave"] <= wmax).all()
+    outfname = os.path.join(twd, "subset")
+    N = store.write_turbospectrum(outfname, wmin, wmax)
+    assert N == N_trimmed + 133 # all the hydrogen lines are kept
+    catalog = linelists.build_linelist_catalog(outfname)
+    assert sum(block["nlines"] for block in catalog["blocks"]) == N
+    shutil.rmtree(twd)
@@ -1,4 +1,6 @@
-from tssynth import marcs
+from tssynth import marcs, utils
+import numpy as np
+import os, json, time, shutil
 
 model_atmosphere_file_1 = "/Users/alexji/lib/tssynth/tests/model_atmospheres/s5000_g+2.0_m1.0_t02_st_z-2.00_a+0.40_c+0.00_n+0.00_o+0.40_r+0.00_s+0.00.mod"
 model_atmosphere_file_2 = "/Users/alexji/lib/tssynth/tests/model_atmospheres/p4000_g+4.5_m0.0_t01_st_z+0.00_a+0.00_c+0.00_n+0.00_o+0.00_r+0.00_s+0.00.mod"
@@ -53,7 +55,24 @@ def test_parse_marcs_model_3():
     "s8000_g+2.0_m1.0_t02_st_z-3.00_a+0.40_c+0.00_n+0.00_o+0.40_r+0.00_s+0.00.mod"]
     for fname in fnames:
         header, model_structure = marcs.parse_marcs_model("/Users/alexji/lib/tssynth/tests/model_atmospheres/" + fname)
-        
+
+def test_read_structure_block():
+    ## The bulk reader gives the same numbers as reading line by line, including the edge cases above
+    model_atmospheres = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_atmospheres")
+    for fname in sorted(os.listdir(model_atmospheres)):
+        with open(os.path.join(model_atmospheres, fname)) as fp:
+            lines = [x[:-1] for x in fp.readlines()]
+        for start, widths in [(25, marcs._STRUCTURE_WIDTHS_1), (25 + 57, marcs._STRUCTURE_WIDTHS_2)]:
+            block = lines[start:start + 56]
+            expected = np.array([marcs._read_structure_line(line, widths) for line in block])
+            assert np.array_equal(marcs._read_structure_block(block, widths), expected, equal_nan=True), fname
+    ## ****** becomes nan, and a row that does not follow the widths falls back to split()
+    block = ["  1" + " -5.00" + " -4.8948" + " 3.8265E+08" + "  3546.8" + " 1.0547E-02" + " 4.1476E+00" + "     ******" + " 0.0000E+00",
+             "  2 -4.80  -4.6961 3.6881E+08  3562.8 1.1735E-02 4.6082E+00  9.9999E-01 0.0000E+00"]
+    values = marcs._read_structure_block(block, marcs._STRUCTURE_WIDTHS_1)
+    assert np.isnan(values[0, 7]) and values[0, 6] == 4.1476
+    assert np.array_equal(values[1], [2, -4.80, -4.6961, 3.6881e8, 3562.8, 1.1735e-2, 4.6082, 0.99999, 0.0])
+
 def test_interpolation_1():
     ## interpolate away from any grid points
     # Teff, logg, MH
@@ -69,6 +88,208 @@ def test_interpolation_2():
     new_model_atmosphere_file = marcs.interpolate_marcs_model(5000, 2.0, -2.0, "/dev/null", spherical=True)
     new_model_atmosphere_file = marcs.interpolate_marcs_model(5000, 4.5, -0.25, "/dev/null", spherical=False)
 
+def _model_list_points(prefix="s", tag="_m1.0_t02_st_"):
+    model_list = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "model_list.txt")
+    with open(model_list) as fp:
+        fnames = [line.strip() for line in fp if line.startswith(prefix) and tag in line]
+    return np.array([[float(fname[1:5]), float(fname[7:11]), float(fname.split("_z")[1][:5])] for fname in fnames])
+
 def test__find_surrounding_points():
-    ## TODO: check the case that is failing, i.e. when there is a missing model and it's not expanding properly
-    pass
\ No newline at end of file
+    points = _model_list_points()
+    existing = set(map(tuple, points))
+    ## The spherical grid is missing models at MH=-4.0 around this point, so the cuboid has to be expanded
+    corners = marcs._find_surrounding_points(points, 5502, 3.21, -3.95)
+    assert len(corners) == 8
+    assert all(tuple(corner) in existing for corner in corners)
+    assert len(set(map(tuple, corners))) == 8
+    for i, x in enumerate([5502, 3.21, -3.95]):
+        assert corners[:, i].min() <= x <= corners[:, i].max()
+    ## At a grid point the model itself is one of the corners
+    corners = marcs._find_surrounding_points(points, 5000, 2.0, -2.0)
+    assert np.any(np.all(corners == [5000, 2.0, -2.0], axis=1))
+    ## Outside the grid
+    try:
+        marcs._find_surrounding_points(points, 10000, 2.0, -2.0)
+        assert False, "should have raised"
+    except ValueError:
+        pass
+
+def test_find_surrounding_points_batch():
+    points = _model_list_points()
+    cube = marcs.OccupancyCube(points)
+    rng = np.random.default_rng(42)
+    Teff = rng.uniform(4000, 6000, 50)
+    logg = rng.uniform(1.0, 3.4, 50)
+    MH = rng.uniform(-2.4, 0.4, 50)
+    corners = marcs.find_surrounding_points_batch(cube, Teff, logg, MH)
+    assert corners.shape == (50, 8, 3)
+    for i in range(50):
+        assert np.all(corners[i] == marcs._find_surrounding_points(points, Teff[i], logg[i], MH[i]))
+
+def _interpolation_cube(prefixes):
+    model_atmospheres = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_atmospheres")
+    fnames = [os.path.join(model_atmospheres, fname) for prefix in prefixes
+              for fname in os.listdir(model_atmospheres) if fname.startswith(prefix)]
+    return (fnames*8)[:8]
+
+def test_python_interpolation_matches_fortran():
+    ## Corners that interpol_modeles can read (it fails on the files with merged columns)
+    twd = utils.mkdtemp()
+    for prefixes, Teff, logg, MH, spherical in [(["s5000", "s6750", "s7000"], 6000, 2.4, -1.3, True),
+                                                (["p3300", "p4000"], 3600, 4.5, -1.0, False)]:
+        marcs_model_list = _interpolation_cube(prefixes)
+        fortran_file = marcs._run_interpolator_lte(Teff, logg, MH, marcs_model_list, os.path.join(twd, "fortran"))
+        models = marcs.interpolate_marcs_models([Teff], [logg], [MH], marcs_model_lists=[marcs_model_list])
+        python_file = marcs.write_interpolated_model(os.path.join(twd, "python"), models[0], logg, spherical, marcs_model_list)
+        with open(fortran_file) as fp1, open(python_file) as fp2:
+            assert fp1.readline() == fp2.readline()
+        fortran = np.loadtxt(fortran_file, skiprows=1, max_rows=56)
+        python = np.loadtxt(python_file, skiprows=1, max_rows=56)
+        ## interpol_modeles is single precision, so the last digit can differ
+        assert np.allclose(fortran[:, [0, 2, 3, 4, 6]], python[:, [0, 2, 3, 4, 6]], rtol=0, atol=1.5e-4)
+        assert np.allclose(fortran[:, 1], python[:, 1], rtol=0, atol=0.015)
+        assert np.allclose(fortran[:, 5], python[:, 5], rtol=1e-5)
+    shutil.rmtree(twd)
+
+def test_python_interpolation_vectorized():
+    marcs_model_list = _interpolation_cube(["s5000", "s6750", "s7000"])
+    Teffs, loggs, MHs = np.array([5200, 6000, 6900]), np.array([2.1, 2.4, 2.9]), np.array([-1.9, -1.3, -0.2])
+    models = marcs.interpolate_marcs_models(Teffs, loggs, MHs, marcs_model_lists=[marcs_model_list]*3)
+    assert models.shape == (3, 56)
+    for i in range(3):
+        model = marcs.interpolate_marcs_models(Teffs[i], loggs[i], MHs[i], marcs_model_lists=[marcs_model_list])
+        assert np.array_equal(models[i], model[0])
+    ## At a corner the interpolation gives that model back
+    header, model_structure = marcs.parse_marcs_model(marcs_model_list[0])
+    model = marcs.interpolate_marcs_models(5000, 2.0, -2.0, marcs_model_lists=[marcs_model_list])[0]
+    assert np.allclose(model["T"], model_structure["T"])
+    assert np.allclose(model["lgPg"], np.log10(model_structure["Pg"]))
+
+def test_interpolation_python_method():
+    new_model_atmosphere_file = marcs.interpolate_marcs_model(5050, 2.1, -2.1, "/dev/null", spherical=True, method="python")
+    twd = utils.mkdtemp()
+    outpath = marcs.interpolate_marcs_model(5000, 4.5, -0.25, os.path.join(twd, "model.interpol"), spherical=False,
+                                            method="python")
+    with open(outpath) as fp:
+        lines = fp.readlines()
+    assert lines[0].startswith("'ppINTERPOL'  56   5000.  4.50")
+    assert len(lines) == 1 + 56 + 8
+    shutil.rmtree(twd)
+
+def test_marcs_grid_store():
+    twd = utils.mkdtemp()
+    model_atmospheres = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_atmospheres")
+    store = marcs.compress_marcs_standard_models(twd, marcs_path=model_atmospheres, n_workers=2, chunksize=2)
+    assert len(store) == 11 and store.meta["failed"] == []
+    ## Reading the models in parallel gives the same store as reading them in this process
+    os.makedirs(os.path.join(twd, "serial"))
+    serial = marcs.compress_marcs_standard_models(os.path.join(twd, "serial"), marcs_path=model_atmospheres, n_workers=1)
+    for name in ["headers", "structures", "partial_pressures"]:
+        for field in getattr(store, name).dtype.names:
+            assert np.array_equal(getattr(store, name)[field], getattr(serial, name)[field],
+                                  equal_nan=getattr(store, name)[field].dtype.kind == "f")
+    assert np.array_equal(store.abundances, serial.abundances)
+    assert isinstance(store.structures, np.memmap)
+    assert store.structures.shape == (11, 56) and store.abundances.shape == (11, 92)
+
+    ## Lookups by parameters match the .mod files, including the edge cases of test_parse_marcs_model_3
+    for fname in sorted(os.listdir(model_atmospheres)):
+        header, model_structure, abundances, partial_pressures_lines = marcs.parse_marcs_model(
+            os.path.join(model_atmospheres, fname), get_all=True)
+        header2, model_structure2, abundances2, partial_pressures = store.get(
+            header["Teff"], header["logg"], header["feh"], spherical=header["spherical"],
+            vturb=header["vturb"], mass=header["mass"], get_all=True)
+        assert header2["filename"] == fname
+        assert {key: header2[key] for key in header} == header
+        for name in model_structure.dtype.names:
+            assert np.array_equal(model_structure[name], model_structure2[name], equal_nan=True)
+        assert abundances2 == abundances
+        assert partial_pressures.shape == (56,) and len(partial_pressures.dtype.names) == 33
+        assert np.array_equal(partial_pressures["lgPgas"][:2], [float(line.split()[1]) for line in partial_pressures_lines[2:4]],
+                              equal_nan=True)
+    try:
+        store.get(5000, 2.0, -1.0)
+        assert False, "should have raised"
+    except ValueError:
+        pass
+
+    ## Interpolating in a grid of one model gives that model back
+    grid = os.path.join(twd, "grid")
+    os.makedirs(os.path.join(grid, "store"))
+    fname = "s5000_g+2.0_m1.0_t02_st_z-2.00_a+0.40_c+0.00_n+0.00_o+0.40_r+0.00_s+0.00.mod"
+    os.symlink(os.path.join(model_atmospheres, fname), os.path.join(grid, fname))
+    marcs.compress_marcs_standard_models(os.path.join(grid, "store"), marcs_path=grid)
+    model = marcs.interpolate_marcs_models(5000, 2.0, -2.0, store=os.path.join(grid, "store"))[0]
+    header, model_structure = store.get(5000, 2.0, -2.0)
+    assert np.allclose(model["T"], model_structure["T"])
+    outpath = marcs.interpolate_marcs_model(5000, 2.0, -2.0, os.path.join(twd, "model.interpol"), method="python",
+                                            store=os.path.join(grid, "store"))
+    with open(outpath) as fp:
+        lines = fp.readlines()
+    assert lines[-1].strip() == os.path.join(grid, fname)
+
+    ## Stores of another version are refused
+    with open(os.path.join(twd, "marcs_store.json")) as fp:
+        meta = json.load(fp)
+    meta["version"] = 0
+    with open(os.path.join(twd, "marcs_store.json"), "w") as fp:
+        json.dump(meta, fp)
+    try:
+        marcs.MarcsGridStore(twd)
+        assert False, "should have raised"
+    except ValueError:
+        pass
+    shutil.rmtree(twd)
+
+def test_marcs_grid_index():
+    twd = utils.mkdtemp()
+    grid, cache_dir = os.path.join(twd, "grid"), os.path.join(twd, "cache")
+    os.makedirs(grid)
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "model_list.txt")) as fp:
+        fnames = [line.strip() for line in fp if line.startswith("s") and ("_z-2.00_" in line or "_z-1.50_" in line)]
+    for fname in fnames:
+        open(os.path.join(grid, fname), "w").close()
+    open(os.path.join(grid, "README"), "w").close()
+    model_list = os.path.join(twd, "model_list.txt")
+    with open(model_list, "w") as fp:
+        fp.write("\n".join(fnames))
+
+    index = marcs.MarcsGridIndex.load(grid, cache_dir=cache_dir, model_list=model_list)
+    assert len(index) == len(fnames)
+    assert len(os.listdir(cache_dir)) == 1
+    assert index.path(5000, 2.0, -2.0) == os.path.join(grid, "s5000_g+2.0_m1.0_t02_st_z-2.00_a+0.40_c+0.00_n+0.00_o+0.40_r+0.00_s+0.00.mod")
+    assert index.path(5000, 2.0, -2.0, mass=2.0, vturb=5).startswith(os.path.join(grid, "s5000_g+2.0_m2.0_t05_st_z-2.00"))
+    points = index.marcs_points(spherical=True)
+    assert len(points) == len(set(map(tuple, points.tolist())))
+    assert set(points[:, 2]) == {-2.0, -1.5}
+
+    ## Loaded from the cache while nothing changes, rebuilt when the directory or model_list.txt change
+    cache_file = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    mtime = os.stat(cache_file).st_mtime_ns
+    time.sleep(0.01)
+    index = marcs.MarcsGridIndex.load(grid, cache_dir=cache_dir, model_list=model_list)
+    assert os.stat(cache_file).st_mtime_ns == mtime
+    os.remove(index.path(5000, 2.0, -2.0))
+    index = marcs.MarcsGridIndex.load(grid, cache_dir=cache_dir, model_list=model_list)
+    assert len(index) == len(fnames) - 1
+    try:
+        index.path(5000, 2.0, -2.0)
+        assert False, "should have raised"
+    except ValueError:
+        pass
+    with open(model_list, "a") as fp:
+        fp.write("\n")
+    time.sleep(0.01)
+    marcs.MarcsGridIndex.load(grid, cache_dir=cache_dir, model_list=model_list)
+    assert os.stat(cache_file).st_mtime_ns > mtime
+
+    ## find_marcs_models uses the index of ALLMARCS_PATH
+    old = os.environ["ALLMARCS_PATH"]
+    os.environ["ALLMARCS_PATH"] = grid
+    try:
+        selected_files = marcs.find_marcs_models(4900, 2.6, -1.8)
+    finally:
+        os.environ["ALLMARCS_PATH"] = old
+    assert [os.path.basename(fname)[:30] for fname in selected_files] == [
+        f"s{T}_g+{g}_m1.0_t02_st_z{m}" for T in (4750, 5000) for g in ("2.5", "3.0") for m in ("-2.00", "-1.50")]
+    shutil.rmtree(twd)
@@ -109,3 +109,119 @@ def test_run_synth_lte_quick_3():
 #         errors += f"fluxes do not match, max relerr {(np.abs(ratio).max())}, {np.sum(np.abs(ratio)>0.005)}/{len(ratio)} pixels failed; "
 #     assert check_wave and check_norm and check_flux, errors
 #     shutil.rmtree(twd)
+
+def test_run_synth_lte_batch():
+    wmin, wmax, dw = 5090, 5100, 0.05
+    jobs = [dict(wmin=wmin, wmax=wmax, dw=dw, model_atmosphere_file=model_atmosphere_file),
+            dict(wmin=wmin, wmax=wmax, dw=dw, model_atmosphere_file=model_atmosphere_file,
+                 XFedict={"Mg": 0.5}),
+            dict(wmin=wmin, wmax=wmax, dw=dw, model_atmosphere_file="does_not_exist.mod")]
+    results = synthesizer.run_synth_lte_batch(jobs, n_workers=2)
+    assert len(results) == 3
+    for wave, norm, flux in results[:2]:
+        assert len(wave) == len(norm) == len(flux) == round((wmax-wmin)/dw) + 1
+    assert isinstance(results[2], Exception)
+
+def test_run_synth_lte_chunked():
+    wmin, wmax, dw = 5000, 5100, 0.05
+    wave, norm, flux = synthesizer.run_synth_lte_chunked(wmin, wmax, dw, chunk_width=30, overlap=5,
+                                                         model_atmosphere_file=model_atmosphere_file)
+    assert len(wave) == len(norm) == len(flux) == round((wmax-wmin)/dw) + 1
+    twd = tssynth.utils.mkdtemp()
+    wavecomp, normcomp, fluxcomp = synthesizer.run_synth_lte(wmin, wmax, dw,
+                                                             model_atmosphere_file=model_atmosphere_file,
+                                                             twd=twd)
+    assert np.allclose(wave, wavecomp, atol=0.001)
+    assert np.allclose(norm, normcomp, atol=0.005)
+    shutil.rmtree(twd)
+
+def test_run_synth_lte_abundance_sweep():
+    wmin, wmax, dw = 5090, 5100, 0.05
+    XFedicts = [None, {"Ba": -1.2}, {"Ba": 0.0}, {"Mg": 6.5, "Ba": -1.2}]
+    results = synthesizer.run_synth_lte_abundance_sweep(wmin, wmax, dw, XFedicts,
+                                                        model_atmosphere_file=model_atmosphere_file)
+    assert len(results) == len(XFedicts)
+    for wave, norm, flux in results:
+        assert len(wave) == len(norm) == len(flux) == round((wmax-wmin)/dw) + 1
+    twd = tssynth.utils.mkdtemp()
+    wavecomp, normcomp, fluxcomp = synthesizer.run_synth_lte(wmin, wmax, dw, XFedict=XFedicts[3],
+                                                             model_atmosphere_file=model_atmosphere_file,
+                                                             twd=twd)
+    assert np.allclose(results[3][1], normcomp, atol=0.005)
+    shutil.rmtree(twd)
+
+def test_synthesis_pipeline():
+    from tssynth.pipeline import SynthesisPipeline, PIPELINE_STAGES
+    wmin, wmax, dw = 5090, 5100, 0.05
+    jobs = [dict(wmin=wmin, wmax=wmax, dw=dw, model_atmosphere_file=model_atmosphere_file),
+            dict(wmin=wmin, wmax=wmax, dw=dw, Teff=5050, logg=2.05, MH=-2.05),
+            dict(wmin=wmin, wmax=wmax, dw=dw, model_atmosphere_file="does_not_exist.mod")]
+    pipeline = SynthesisPipeline(n_workers=2)
+    results = pipeline.run(jobs)
+    for wave, norm, flux in results[:2]:
+        assert len(wave) == len(norm) == len(flux) == round((wmax-wmin)/dw) + 1
+    assert isinstance(results[2], Exception)
+    assert pipeline.stats["atmosphere"]["jobs"] == 3
+    assert pipeline.stats["atmosphere"]["failed"] == 1
+    assert all(pipeline.stats[stage]["jobs"] == 2 for stage in PIPELINE_STAGES[1:])
+    twd = tssynth.utils.mkdtemp()
+    wavecomp, normcomp, fluxcomp = synthesizer.run_synth_lte(**jobs[0], twd=twd)
+    assert np.allclose(results[0][1], normcomp)
+    shutil.rmtree(twd)
+
+def test_async_run_synth_lte():
+    import asyncio
+    from tssynth.async_synthesizer import async_run_synth_lte, async_run_synth_lte_batch
+    wmin, wmax, dw = 5090, 5100, 0.05
+    twd = tssynth.utils.mkdtemp()
+    wave, norm, flux = asyncio.run(async_run_synth_lte(wmin, wmax, dw,
+                                                       model_atmosphere_file=model_atmosphere_file,
+                                                       twd=twd))
+    wavecomp, normcomp, fluxcomp = synthesizer.run_synth_lte(wmin, wmax, dw,
+                                                             model_atmosphere_file=model_atmosphere_file,
+                                                             twd=twd)
+    assert np.allclose(norm, normcomp)
+    shutil.rmtree(twd)
+
+    jobs = [dict(wmin=wmin, wmax=wmax, dw=dw, Teff=5050, logg=2.05, MH=-2.05),
+            dict(wmin=wmin, wmax=wmax, dw=dw, model_atmosphere_file="does_not_exist.mod")]
+    results = asyncio.run(async_run_synth_lte_batch(jobs, max_concurrency=2))
+    wave, norm, flux = results[0]
+    assert len(wave) == len(norm) == len(flux) == round((wmax-wmin)/dw) + 1
+    assert isinstance(results[1], Exception)
+
+def test_run_synth_lte_timing():
+    from tssynth import timing
+    collector = timing.EventCollector()
+    timing.add_hook(collector)
+    try:
+        wave, norm, flux = synthesizer.run_synth_lte(5090, 5100, 0.05, Teff=5050, logg=2.05, MH=-2.05,
+                                                     delete_twd=True)
+    finally:
+        timing.remove_hook(collector)
+    stages = [event["stage"] for event in collector.events]
+    for stage in timing.STAGES:
+        assert stage in stages, stage
+    assert all(event["Teff"] == 5050 for event in collector.events)
+
+def test_read_bsyn_output():
+    twd = tssynth.utils.mkdtemp()
+    outfilename = os.path.join(twd, "bsyn.out")
+    wmin, wmax, dw = 5000, 5100, 0.01
+    wave = wmin + dw*np.arange(round((wmax-wmin)/dw) + 1)
+    norm = 1 - 0.5*np.abs(np.sin(wave))
+    np.savetxt(outfilename, np.array([wave, norm, 1e15*norm]).T, fmt=["%11.3f", "%10.5f", "%12.5E"])
+    expected = np.loadtxt(outfilename)
+    wave, norm, flux = synthesizer.read_bsyn_output(outfilename, wmin, wmax, dw)
+    assert np.allclose(wave, expected[:,0], rtol=1e-12)
+    assert np.allclose(norm, expected[:,1], rtol=1e-12)
+    assert np.allclose(flux, expected[:,2], rtol=1e-12)
+    wave, flux = synthesizer.read_bsyn_output(outfilename, columns=("wave", "flux"), dtype=np.float32)
+    assert flux.dtype == np.float32
+    assert np.allclose(flux, expected[:,2])
+    try:
+        synthesizer.read_bsyn_output(outfilename, wmin, wmax + 1, dw)
+        assert False, "should have failed the length check"
+    except RuntimeError:
+        pass
+    shutil.rmtree(twd)
@@ -0,0 +1,52 @@
+from tssynth import resampling
+from tssynth.utils import SPEED_OF_LIGHT
+import numpy as np
+
+def test_resample_conserves_flux():
+    wave = np.arange(5000, 5010, 0.01)
+    rng = np.random.default_rng(3)
+    flux = 1 + 0.2*rng.standard_normal(len(wave))
+    # Same grid is the identity
+    assert np.allclose(resampling.resample(wave, flux, wave), flux)
+    # Coarser irregular grid conserves the integral over the covered range
+    target = np.sort(rng.uniform(5001, 5009, 300))
+    target = target[np.concatenate([[True], np.diff(target) > 0.005])]
+    out = resampling.resample(wave, flux, target, gap_factor=np.inf)
+    lower, upper = resampling.target_bin_edges(target, gap_factor=np.inf)
+    edges = np.concatenate([[wave[0] - 0.005], 0.5*(wave[1:] + wave[:-1]), [wave[-1] + 0.005]])
+    cumulative = np.concatenate([[0], np.cumsum(flux*np.diff(edges))])
+    integral = np.interp(upper[-1], edges, cumulative) - np.interp(lower[0], edges, cumulative)
+    assert np.isclose(np.sum(out*(upper - lower)), integral)
+    # Constant spectra stay constant
+    assert np.allclose(resampling.resample(wave, np.full(len(wave), 3.0), target), 3.0)
+
+def test_resample_gaps_and_edges():
+    wave = np.arange(5000, 5010, 0.01)
+    flux = np.ones(len(wave))
+    target = np.concatenate([np.arange(4999.5, 5003, 0.05), np.arange(5006, 5012, 0.05)])
+    lower, upper = resampling.target_bin_edges(target)
+    assert np.allclose(upper - lower, 0.05)
+    out = resampling.resample(wave, flux, target)
+    assert np.all(np.isnan(out[target < 5000.0])) and np.all(np.isnan(out[target > 5010 - 0.01]))
+    inside = (target > 5000.05) & (target < 5009.9)
+    assert np.allclose(out[inside], 1)
+
+def test_resample_batch_and_rv():
+    wave = np.arange(5000, 5010, 0.01)
+    center = 5005.0
+    flux = 1 - 0.5*np.exp(-0.5*((wave - center)/0.05)**2)
+    batch = np.array([flux, flux**2, flux**3])
+    targets = [np.arange(5001, 5004, 0.03), np.arange(5004, 5008, 0.03)]
+    outs = resampling.resample(wave, batch, targets, rv=10.0)
+    assert len(outs) == 2 and outs[1].shape == (3, len(targets[1]))
+    for i in range(len(batch)):
+        assert np.allclose(resampling.resample(wave, batch[i], targets[1], rv=10.0), outs[1][i])
+    # The line moves by rv
+    depth = 1 - outs[1][0]
+    centroid = np.sum(depth*targets[1])/np.sum(depth)
+    assert np.isclose(centroid, center*(1 + 10.0/SPEED_OF_LIGHT), atol=2e-3)
+    # One rv per spectrum
+    rvs = np.array([0.0, 10.0, 0.0])
+    out = resampling.resample(wave, batch, targets[1], rv=rvs)
+    assert np.allclose(out[1], outs[1][1])
+    assert np.allclose(out[0], resampling.resample(wave, batch[0], targets[1]))
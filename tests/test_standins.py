@@ -0,0 +1,58 @@
+from tssynth import synthesizer, marcs, utils
+import numpy as np
+import os, shutil, subprocess
+
+STANDINS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "standins")
+model_atmospheres = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_atmospheres")
+model_atmosphere_file = os.path.join(model_atmospheres, "s5000_g+2.0_m1.0_t02_st_z-2.00_a+0.40_c+0.00_n+0.00_o+0.40_r+0.00_s+0.00.mod")
+linelist_filename = os.path.join(os.path.dirname(STANDINS_PATH), "data", "linelists", "vald-3700-3800-for-grid-nlte-04sep2023")
+
+def test_standin_run_synth_lte():
+    old = synthesizer.TSEXEC_PATH
+    synthesizer.TSEXEC_PATH = STANDINS_PATH
+    try:
+        wave, norm, flux = synthesizer.run_synth_lte(3750, 3760, 0.01, model_atmosphere_file=model_atmosphere_file,
+                                                     linelist_filenames=[linelist_filename], delete_twd=True)
+    finally:
+        synthesizer.TSEXEC_PATH = old
+    assert len(wave) == 1001
+    assert np.allclose(wave[[0, -1]], [3750, 3760])
+    assert np.all(norm <= 1) and np.min(norm) < 0.9
+    ii = norm > 0.1
+    assert np.allclose(flux[ii]/norm[ii], 1e15*(5000/wave[ii])**2, rtol=1e-3)
+
+def test_standin_interpol_modeles():
+    twd = utils.mkdtemp()
+    models = sorted(os.path.join(model_atmospheres, fname) for fname in os.listdir(model_atmospheres)
+                    if fname.startswith("s"))[:8]
+    models = (models*8)[:8]
+    outpath = os.path.join(twd, "marcs.interp")
+    old = os.environ.get("TSINTERP_PATH")
+    os.environ["TSINTERP_PATH"] = STANDINS_PATH
+    try:
+        marcs._run_interpolator_lte(5000, 2.0, -2.0, models, outpath)
+    finally:
+        os.environ["TSINTERP_PATH"] = old
+    with open(outpath) as fp:
+        lines = fp.readlines()
+    assert lines[0].startswith("'sphINTERPOL'  56")
+    assert len(lines) == 1 + 56 + 8
+    shutil.rmtree(twd)
+
+def test_standin_failure():
+    twd = utils.mkdtemp()
+    scriptfilename = os.path.join(twd, "babsma.par")
+    synthesizer._write_script(scriptfilename, 5000, 5010, 0.01, None, model_atmosphere_file, True,
+                              os.path.join(twd, "mopac"), -2.0, 0.4, {}, 2.0, True, None, None, None)
+    env = dict(os.environ, TSSTANDIN_BABSMA_LU_FAIL="3")
+    with open(scriptfilename) as fp:
+        p = subprocess.run([os.path.join(STANDINS_PATH, "babsma_lu")], stdin=fp, cwd=twd, env=env,
+                           capture_output=True)
+    assert p.returncode == 3
+    assert not os.path.exists(os.path.join(twd, "mopac"))
+    with open(scriptfilename) as fp:
+        p = subprocess.run([os.path.join(STANDINS_PATH, "babsma_lu")], stdin=fp, cwd=twd)
+    assert p.returncode == 0
+    with open(os.path.join(twd, "mopac")) as fp:
+        assert fp.readline().split()[:2] == ["standin-babsma_lu", "56"]
+    shutil.rmtree(twd)
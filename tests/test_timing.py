@@ -0,0 +1,45 @@
+from tssynth import timing, utils, synthesizer
+import os, json, shutil
+import numpy as np
+
+def test_timing_disabled():
+    timing.clear_hooks()
+    assert not timing.enabled()
+    assert timing.timed("babsma_lu") is timing.timed("bsyn_lu")
+    assert timing.job_context(Teff=5000) is timing.timed("bsyn_lu")
+
+def test_timing_events():
+    twd = utils.mkdtemp()
+    collector = timing.EventCollector()
+    jsonfile = os.path.join(twd, "timing.jsonl")
+    timing.add_hook(collector)
+    timing.add_hook(timing.JSONLinesHook(jsonfile))
+    try:
+        outfilename = os.path.join(twd, "bsyn.out")
+        wave = 5000 + 0.01*np.arange(1001)
+        np.savetxt(outfilename, np.array([wave, np.ones_like(wave), 1e15*np.ones_like(wave)]).T,
+                   fmt=["%11.3f", "%10.5f", "%12.5E"])
+        with timing.job_context(Teff=5000, logg=2.0):
+            synthesizer.read_bsyn_output(outfilename, 5000, 5010, 0.01)
+            with timing.timed("bsyn_lu", twd=twd):
+                pass
+        try:
+            with timing.timed("babsma_lu"):
+                raise RuntimeError("failed")
+        except RuntimeError:
+            pass
+    finally:
+        timing.clear_hooks()
+    synthesizer.read_bsyn_output(outfilename, 5000, 5010, 0.01)
+    assert [event["stage"] for event in collector.events] == ["read_bsyn_output", "bsyn_lu", "babsma_lu"]
+    event = collector.events[0]
+    assert event["Teff"] == 5000 and event["logg"] == 2.0
+    assert event["wall"] > 0 and event["cpu"] >= 0 and event["error"] is None
+    assert collector.events[1]["twd"] == twd
+    assert "Teff" not in collector.events[2]
+    assert collector.events[2]["error"] == "RuntimeError"
+    with open(jsonfile) as fp:
+        lines = [json.loads(line) for line in fp]
+    assert [line["stage"] for line in lines] == ["read_bsyn_output", "bsyn_lu", "babsma_lu"]
+    assert "read_bsyn_output" in collector.summary()
+    shutil.rmtree(twd)
@@ -0,0 +1,67 @@
+from tssynth import workdir, utils
+import os, shutil
+
+def test_workdir_pool_reuse():
+    base = utils.mkdtemp()
+    pool = workdir.WorkdirPool(base=base)
+    with pool.lease() as twd:
+        assert os.path.islink(os.path.join(twd, "DATA"))
+        with open(os.path.join(twd, "bsyn.out"), "w") as fp: fp.write("spectrum")
+    with pool.lease() as twd2:
+        assert twd2 == twd
+        assert os.listdir(twd2) == ["DATA"]
+    try:
+        with pool.lease() as twd3:
+            raise RuntimeError("failed job")
+    except RuntimeError:
+        pass
+    assert os.path.exists(twd3) # kept for inspection, not reused
+    with pool.lease() as twd4:
+        assert twd4 != twd3
+    pool.close()
+    shutil.rmtree(base)
+
+def test_workdir_pool_tmpfs_cap():
+    base = utils.mkdtemp()
+    tmpfs_base = os.path.join(base, "tmpfs")
+    os.makedirs(tmpfs_base)
+    pool = workdir.WorkdirPool(base=base, tmpfs_base=tmpfs_base, tmpfs_max_bytes=1500)
+    twd1 = pool.acquire()
+    assert os.path.dirname(twd1) == tmpfs_base
+    with open(os.path.join(twd1, "mopac"), "w") as fp: fp.write("x"*1000)
+    pool.release(twd1)
+    twd1 = pool.acquire()
+    twd2 = pool.acquire() # a second 1000 byte directory would go over the cap
+    assert os.path.dirname(twd2) == base
+    pool.release(twd1)
+    pool.release(twd2)
+    pool.close()
+    shutil.rmtree(base)
+
+def test_workdir_pool_tmpfs_reserve():
+    base = utils.mkdtemp()
+    tmpfs_base = os.path.join(base, "tmpfs")
+    os.makedirs(tmpfs_base)
+    ## Before anything is measured, only one directory goes on tmpfs
+    pool = workdir.WorkdirPool(base=base, tmpfs_base=tmpfs_base, tmpfs_max_bytes=1500)
+    twds = [pool.acquire() for _ in range(3)]
+    assert [os.path.dirname(twd) for twd in twds] == [tmpfs_base, base, base]
+    for twd in twds: pool.release(twd)
+    pool.close()
+    ## With a reservation, leased directories count against the cap
+    pool = workdir.WorkdirPool(base=base, tmpfs_base=tmpfs_base, tmpfs_max_bytes=1500, tmpfs_reserve_bytes=500)
+    twds = [pool.acquire() for _ in range(4)]
+    assert [os.path.dirname(twd) for twd in twds] == [tmpfs_base]*3 + [base]
+    for twd in twds: pool.release(twd)
+    pool.close()
+    shutil.rmtree(base)
+
+def test_workdir_pool_release_deleted():
+    base = utils.mkdtemp()
+    pool = workdir.WorkdirPool(base=base)
+    twd = pool.acquire()
+    shutil.rmtree(twd)
+    assert pool.release(twd) is None
+    assert pool.acquire() != twd
+    pool.close()
+    shutil.rmtree(base)
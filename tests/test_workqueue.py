@@ -0,0 +1,94 @@
+from tssynth import utils
+from tssynth.workqueue import WorkQueue, run_worker
+import numpy as np
+import os, sys, time, shutil, subprocess
+
+STANDINS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "standins")
+model_atmosphere_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_atmospheres",
+                                     "s5000_g+2.0_m1.0_t02_st_z-2.00_a+0.40_c+0.00_n+0.00_o+0.40_r+0.00_s+0.00.mod")
+linelist_filename = os.path.join(os.path.dirname(STANDINS_PATH), "data", "linelists", "vald-3700-3800-for-grid-nlte-04sep2023")
+
+def make_job(wmin):
+    return dict(wmin=wmin, wmax=wmin+1, dw=0.01, model_atmosphere_file=model_atmosphere_file,
+                linelist_filenames=[linelist_filename])
+
+def test_claim_complete_fail():
+    twd = utils.mkdtemp()
+    queue = WorkQueue(os.path.join(twd, "queue.db"))
+    ids = queue.submit([make_job(3750), make_job(3760), dict(make_job(3770), XFedict={6: 0.5, 8: 0.4})])
+    assert queue.counts() == dict(pending=3, running=0, done=0, failed=0)
+
+    job_id, job = queue.claim("a")
+    assert job_id == ids[0] and job == make_job(3750)
+    assert queue.complete(job_id, "a", (np.arange(3.), np.ones(3), np.ones(3)))
+    wave, norm, flux = queue.result(job_id)
+    assert np.all(wave == np.arange(3.))
+
+    job_id, job = queue.claim("b")
+    assert not queue.fail(job_id, "a", "wrong worker")
+    assert queue.fail(job_id, "b", "bsyn_lu failed")
+    ## XFedict keys come back as atomic numbers
+    job_id, job = queue.claim("a")
+    assert job["XFedict"] == {6: 0.5, 8: 0.4}
+    assert queue.claim("a") is None
+    assert queue.counts() == dict(pending=0, running=1, done=1, failed=1)
+    assert queue.jobs("failed")[0]["error"] == "bsyn_lu failed"
+
+    assert queue.retry_failed() == 1
+    assert queue.claim("a")[0] == ids[1]
+    try:
+        queue.submit([dict(make_job(3750), twd=twd)])
+        assert False, "should have raised"
+    except ValueError:
+        pass
+    shutil.rmtree(twd)
+
+def test_lease_expiry():
+    twd = utils.mkdtemp()
+    queue = WorkQueue(os.path.join(twd, "queue.db"), lease_seconds=0.2, max_attempts=2)
+    job_id, = queue.submit([make_job(3750)])
+    assert queue.claim("dead")[0] == job_id
+    assert queue.claim("alive") is None
+    time.sleep(0.3)
+    ## The lease of the dead worker ran out, so the job goes to the next worker
+    assert queue.claim("alive")[0] == job_id
+    assert not queue.renew(job_id, "dead")
+    assert not queue.complete(job_id, "dead", (np.arange(3.), np.ones(3), np.ones(3)))
+    time.sleep(0.3)
+    ## Second expiry reaches max_attempts
+    assert queue.claim("other") is None
+    job, = queue.jobs()
+    assert job["status"] == "failed" and job["attempts"] == 2
+    assert "lease expired" in job["error"]
+    shutil.rmtree(twd)
+
+def test_workers_in_processes():
+    twd = utils.mkdtemp()
+    dbname = os.path.join(twd, "queue.db")
+    queue = WorkQueue(dbname)
+    ids = queue.submit([make_job(3700 + i) for i in range(12)])
+    env = dict(os.environ, TSEXEC_PATH=STANDINS_PATH, TSSTANDIN_SLEEP="0.05",
+               PATH=STANDINS_PATH + os.pathsep + os.environ["PATH"])
+    procs = [subprocess.Popen([sys.executable, "-m", "tssynth.cli", "worker", dbname, "--threads", "2",
+                               "--poll-interval", "0.1"], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+             for i in range(3)]
+    for proc in procs:
+        output = proc.communicate(timeout=300)[0].decode()
+        assert proc.returncode == 0, output
+    assert queue.counts() == dict(pending=0, running=0, done=12, failed=0)
+    for job in queue.jobs():
+        assert job["attempts"] == 1
+    for i, job_id in enumerate(ids):
+        wave, norm, flux = queue.result(job_id)
+        assert len(wave) == 101 and np.isclose(wave[0], 3700 + i)
+    shutil.rmtree(twd)
+
+def test_run_worker_records_failures():
+    twd = utils.mkdtemp()
+    queue = WorkQueue(os.path.join(twd, "queue.db"))
+    queue.submit([dict(make_job(3750), model_atmosphere_file=os.path.join(twd, "missing.mod"))])
+    stats = run_worker(queue, poll_interval=0.1)
+    assert stats == dict(done=0, failed=1)
+    job, = queue.jobs()
+    assert job["status"] == "failed" and job["error"]
+    shutil.rmtree(twd)